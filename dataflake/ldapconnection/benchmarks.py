@@ -0,0 +1,372 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Benchmarks for the connection operations
+
+The benchmarks run against a synthetic tree in the fake directory of
+``dataflake.fakeldap``. Records have wide multi-valued attributes and
+their names mix ASCII, ISO-8859-1 and Greek characters. Each case
+reports the operations per second, latency percentiles and the peak
+memory allocated per operation.
+
+Run them with ``python -m dataflake.ldapconnection.benchmarks``, see
+``--help`` for the options. Results are written as JSON and can be
+compared with the results of an earlier run.
+"""
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+from timeit import default_timer
+
+import ldap
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover Python 2
+    tracemalloc = None
+
+from dataflake.ldapconnection.connection import LDAPConnection
+from dataflake.ldapconnection.connection import connection_cache
+from dataflake.ldapconnection.testing import AsyncFakeLDAPConnection
+
+
+BASE = u'ou=people,dc=bench'
+GROUPS = u'ou=groups,dc=bench'
+
+# Name prefixes for ASCII, ISO-8859-1 and Greek record names
+PREFIXES = (u'user', u'm\xfcller', u'\u03b1\u03b2\u03b3')
+
+
+def percentile(samples, pct):
+    """ Return the `pct` percentile of a sorted list of samples
+
+    Uses the nearest-rank method.
+    """
+    if not samples:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(samples)))
+    return samples[min(max(rank, 1), len(samples)) - 1]
+
+
+def record_name(i):
+    """ Return the common name of the synthetic record number `i`
+    """
+    return u'%s%i' % (PREFIXES[i % len(PREFIXES)], i)
+
+
+def make_record(name, values=20, groups=1000, rnd=random):
+    """ Return the attributes of a synthetic record as text mapping
+    """
+    return {'objectClass': [u'top', u'person', u'inetOrgPerson'],
+            'cn': [name],
+            'sn': [u'%s \u0394\xe9lta' % name],
+            'mail': [u'%s.%i@example.org' % (name, x) for x in range(3)],
+            'memberOf': [u'cn=group%i,%s' % (x, GROUPS)
+                         for x in rnd.sample(range(groups),
+                                             min(values, groups))]}
+
+
+def build_tree(size, values=20, groups=1000, seed=0):
+    """ Fill the fake directory with `size` synthetic records
+
+    Anything already in the fake directory is removed. Records are
+    created below `BASE`, each with `values` group memberships.
+    """
+    from dataflake.fakeldap import TREE
+
+    rnd = random.Random(seed)
+    TREE.clear()
+    TREE.addTreeItems(GROUPS.encode('UTF-8'))
+    people = TREE.addTreeItems(BASE.encode('UTF-8'))
+
+    for i in range(size):
+        attrs = make_record(record_name(i), values, groups, rnd)
+        record = dict((key.encode('UTF-8'), [x.encode('UTF-8') for x in vals])
+                      for key, vals in attrs.items())
+        people[b'cn=' + record[b'cn'][0]] = record
+
+
+class Benchmark(object):
+    """ Run benchmark cases against a synthetic tree
+
+    - `size` is the number of records in the tree
+
+    - `values` is the number of values of the multi-valued attribute
+
+    - `iterations` is the number of timed calls per case
+
+    - `memory_iterations` is the number of extra calls per case traced
+      for memory allocations, tracing is too slow for timing them
+    """
+
+    def __init__(self, size=10000, values=20, iterations=200,
+                 memory_iterations=10, seed=0):
+        self.size = size
+        self.values = values
+        self.iterations = iterations
+        self.memory_iterations = memory_iterations
+        self.random = random.Random(seed)
+
+        started = default_timer()
+        build_tree(size, values, seed=seed)
+        self.tree_seconds = default_timer() - started
+
+        self.conn = LDAPConnection('localhost', 389, 'ldap',
+                                   AsyncFakeLDAPConnection)
+        self.unicode_conn = LDAPConnection('localhost', 389, 'ldap',
+                                           AsyncFakeLDAPConnection,
+                                           api_encoding=None)
+
+    def dn(self, i=None):
+        """ Return the DN of a record, a random one if `i` is None
+        """
+        if i is None:
+            i = self.random.randrange(self.size)
+        return u'cn=%s,%s' % (record_name(i), BASE)
+
+    def run(self, cases=None):
+        """ Run the named cases, or all, and return the results mapping
+        """
+        results = {'python': platform.python_version(),
+                   'implementation': platform.python_implementation(),
+                   'created': time.time(),
+                   'size': self.size,
+                   'values': self.values,
+                   'iterations': self.iterations,
+                   'tree_seconds': self.tree_seconds,
+                   'cases': {}}
+
+        for name, case in CASES:
+            if cases and name not in cases:
+                continue
+            results['cases'][name] = self.measure(case)
+
+        return results
+
+    def measure(self, case):
+        """ Time a case and trace its memory allocations
+        """
+        samples = []
+        for i in range(self.iterations):
+            call = case(self, i)
+            started = default_timer()
+            call()
+            samples.append(default_timer() - started)
+
+        peak = None
+        if tracemalloc is not None and self.memory_iterations:
+            peak = 0
+            for i in range(self.iterations,
+                           self.iterations + self.memory_iterations):
+                call = case(self, i)
+                tracemalloc.start()
+                try:
+                    call()
+                    peak = max(peak, tracemalloc.get_traced_memory()[1])
+                finally:
+                    tracemalloc.stop()
+
+        samples.sort()
+        total = sum(samples)
+        return {'iterations': len(samples),
+                'ops_per_sec': len(samples) / total if total else 0.0,
+                'mean': total / len(samples) if samples else 0.0,
+                'p50': percentile(samples, 50),
+                'p90': percentile(samples, 90),
+                'p99': percentile(samples, 99),
+                'max': samples[-1] if samples else 0.0,
+                'peak_memory': peak}
+
+
+# Each case is called with the benchmark and the iteration number. It
+# prepares the call and returns a callable doing the timed operation.
+
+def _connect(bench, i):
+    return bench.conn.connect
+
+
+def _search(bench, i):
+    fltr = u'(cn=%s)' % record_name(bench.random.randrange(bench.size))
+    return lambda: bench.conn.search(BASE, ldap.SCOPE_ONELEVEL, fltr)
+
+
+def _search_record(bench, i):
+    dn = bench.dn()
+    return lambda: bench.conn.search(dn, ldap.SCOPE_BASE)
+
+
+def _search_raw(bench, i):
+    dn = bench.dn()
+    return lambda: bench.conn.search(dn, ldap.SCOPE_BASE, raw=True)
+
+
+def _search_unicode(bench, i):
+    dn = bench.dn()
+    return lambda: bench.unicode_conn.search(dn, ldap.SCOPE_BASE)
+
+
+def _lookup_many(bench, i):
+    dns = [bench.dn() for x in range(20)]
+    return lambda: bench.conn.lookup_many(dns)
+
+
+def _insert(bench, i):
+    name = u'new-%s' % record_name(i)
+    attrs = make_record(name, bench.values, rnd=bench.random)
+    return lambda: bench.conn.insert(BASE, u'cn=%s' % name, attrs)
+
+
+def _insert_many(bench, i):
+    records = []
+    for x in range(10):
+        name = u'bulk-%s' % record_name(i * 10 + x)
+        attrs = make_record(name, bench.values, rnd=bench.random)
+        records.append((BASE, u'cn=%s' % name, attrs))
+    return lambda: bench.conn.insert_many(records)
+
+
+def _modify(bench, i):
+    dn = bench.dn()
+    attrs = make_record(record_name(i), bench.values, rnd=bench.random)
+    return lambda: bench.conn.modify(dn, attrs={'memberOf':
+                                                attrs['memberOf']})
+
+
+def _modify_many(bench, i):
+    changes = [(bench.dn(), {'sn': u'\u03b4\xe9 %i' % i}) for x in range(10)]
+    return lambda: bench.conn.modify_many(changes)
+
+
+def _delete(bench, i):
+    name = u'gone-%s' % record_name(i)
+    bench.conn.insert(BASE, u'cn=%s' % name,
+                      make_record(name, bench.values, rnd=bench.random))
+    dn = u'cn=%s,%s' % (name, BASE)
+    return lambda: bench.conn.delete(dn)
+
+
+CASES = (('connect', _connect),
+         ('search', _search),
+         ('search_record', _search_record),
+         ('search_raw', _search_raw),
+         ('search_unicode', _search_unicode),
+         ('lookup_many', _lookup_many),
+         ('insert', _insert),
+         ('insert_many', _insert_many),
+         ('modify', _modify),
+         ('modify_many', _modify_many),
+         ('delete', _delete))
+
+
+def compare(previous, current, threshold=0.1):
+    """ Compare two results mappings case by case
+
+    Returns a list of (case, previous ops/sec, current ops/sec, change)
+    tuples for the cases found in both, where `change` is the relative
+    change of the throughput, and the list of cases that got slower by
+    more than `threshold`.
+    """
+    rows = []
+    regressions = []
+
+    for name, case in CASES:
+        if name not in previous['cases'] or name not in current['cases']:
+            continue
+        before = previous['cases'][name]['ops_per_sec']
+        after = current['cases'][name]['ops_per_sec']
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change))
+        if change < -threshold:
+            regressions.append(name)
+
+    return rows, regressions
+
+
+def report(results, out=None):
+    """ Print a results mapping as table
+    """
+    out = out or sys.stdout
+    out.write('%i records, %i values, Python %s, tree built in %.2fs\n' % (
+              results['size'], results['values'], results['python'],
+              results['tree_seconds']))
+    out.write('%-16s %10s %10s %10s %10s %12s\n' % (
+              'case', 'ops/sec', 'p50 ms', 'p90 ms', 'p99 ms', 'peak KiB'))
+    for name, case in CASES:
+        data = results['cases'].get(name)
+        if data is None:
+            continue
+        peak = data['peak_memory']
+        out.write('%-16s %10.1f %10.3f %10.3f %10.3f %12s\n' % (
+                  name, data['ops_per_sec'], data['p50'] * 1000,
+                  data['p90'] * 1000, data['p99'] * 1000,
+                  '-' if peak is None else '%.1f' % (peak / 1024.0)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                prog='python -m dataflake.ldapconnection.benchmarks',
+                description='Benchmark the LDAPConnection operations '
+                            'against a synthetic fake directory.')
+    parser.add_argument('-s', '--size', type=int, default=10000,
+                        help='number of records in the tree')
+    parser.add_argument('-v', '--values', type=int, default=20,
+                        help='values of the multi-valued attribute')
+    parser.add_argument('-n', '--iterations', type=int, default=200,
+                        help='timed calls per case')
+    parser.add_argument('-c', '--case', action='append', dest='cases',
+                        choices=[name for name, case in CASES],
+                        help='run only this case, may be repeated')
+    parser.add_argument('-o', '--output',
+                        help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as regression, '
+                             'default 0.1 for 10%%')
+    args = parser.parse_args(argv)
+
+    try:
+        bench = Benchmark(size=args.size, values=args.values,
+                          iterations=args.iterations)
+        results = bench.run(args.cases)
+    finally:
+        connection_cache.invalidate()
+
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            previous = json.load(fp)
+        rows, regressions = compare(previous, results, args.threshold)
+        sys.stdout.write('\n%-16s %12s %12s %8s\n' % (
+                         'case', 'before', 'after', 'change'))
+        for name, before, after, change in rows:
+            sys.stdout.write('%-16s %12.1f %12.1f %+7.1f%%%s\n' % (
+                             name, before, after, change * 100,
+                             ' !' if name in regressions else ''))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,579 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Search result cache
+
+A `ResultCache` set as the `result_cache` attribute of an `LDAPConnection`
+stores search results for a limited time. Cached results are dropped as
+soon as a write through the same connection touches a record they may
+contain. Changes made by other clients are picked up with a
+`dataflake.ldapconnection.listener.ChangeListener` or a syncrepl
+`dataflake.ldapconnection.sync.SyncMirror`.
+
+Results can be kept in a `SQLiteCache` instead of process memory, so a
+restarted process finds them right away. Processes on the same host can
+share results through a `CacheServer` they reach with a `SocketCache`.
+
+A `BindCache` set as the `bind_cache` attribute remembers successful
+password checks made with `LDAPConnection.authenticate` for a short
+time.
+"""
+
+from collections import OrderedDict
+from copy import deepcopy
+from hashlib import pbkdf2_hmac
+from hashlib import sha1
+import hmac
+import logging
+import os
+import socket
+import sqlite3
+import struct
+import threading
+import time
+
+import ldap
+import six
+from six.moves import cPickle
+from six.moves import socketserver
+from zope.interface import implementer
+
+from dataflake.cache.interfaces import ITimeoutCache
+from dataflake.cache.timeout import LockingTimeoutCache
+
+from dataflake.ldapconnection.utils import dn_in_scope
+from dataflake.ldapconnection.utils import normalize_dn
+
+
+logger = logging.getLogger('dataflake.ldapconnection')
+HEADER = struct.Struct('!I')
+SHARED_METHODS = frozenset(('set', 'get', 'invalidate', 'keys', 'values',
+                            'items', 'setTimeout', 'getTimeout'))
+# Keys of the entries telling the base and scope of a cached search
+INDEX_PREFIX = 'index:'
+
+
+def _send(sock, data):
+    data = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _receive(sock):
+    """ Read one message, return None if the other side is gone
+    """
+    header = _read(sock, HEADER.size)
+    if header is None:
+        return None
+    data = _read(sock, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return cPickle.loads(data)
+
+
+def _read(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _index_key(key, base_parts, scope):
+    """ The key of the index entry for a cached search result
+
+    The normalized base is last, it may contain colons. Joining its
+    parts gives a DN that normalizes to the same parts again.
+    """
+    return '%s%i:%s:%s' % (INDEX_PREFIX, scope, key, u','.join(base_parts))
+
+
+class ResultCache(object):
+    """ Cache for search results with invalidation by DN
+
+    - `storage` is any cache implementing the ``dataflake.cache``
+      ``ITimeoutCache`` interface, by default a ``LockingTimeoutCache``
+
+    - `timeout` is the number of seconds after which results expire
+      even if no change notification arrived
+
+    Storages with a true `shared` attribute are used by several
+    processes at once. Invalidating a DN then looks at all stored
+    results instead of only those stored by this process. Their search
+    base and scope are read from the keys of small index entries
+    stored next to each result, so the results are not loaded.
+    """
+
+    # Clean expired searches out of the index above this size
+    max_searches = 10000
+
+    def __init__(self, storage=None, timeout=600):
+        if storage is None:
+            storage = LockingTimeoutCache()
+        storage.setTimeout(timeout)
+        self.storage = storage
+        self.timeout = timeout
+        self.searches = {}
+        self.lock = threading.Lock()
+
+        # Results kept by a persistent storage are still valid
+        expires = time.time() + timeout
+        for key, base_parts, scope in self._stored():
+            self.searches[key] = (base_parts, scope, expires)
+
+    def key(self, *args):
+        """ Compute the cache key for a set of search arguments
+
+        Callers include everything deciding which records a search
+        finds, like the bind DN and the servers asked.
+        """
+        return sha1(repr(args).encode('UTF-8')).hexdigest()
+
+    def get(self, key):
+        """ Return a copy of a cached result or None
+        """
+        cached = self.storage.get(key)
+        if cached is not None:
+            return deepcopy(cached[2])
+        return None
+
+    def set(self, key, base, scope, result, encoding='UTF-8'):
+        """ Cache a search result
+
+        `base` and `scope` describe the search, they decide which
+        changes invalidate the result.
+        """
+        base_parts = normalize_dn(base, encoding)
+        with self.lock:
+            if len(self.searches) >= self.max_searches:
+                self._prune()
+            self.searches[key] = (base_parts, scope,
+                                  time.time() + self.timeout)
+        self.storage.set(key, (base_parts, scope, deepcopy(result)))
+        self.storage.set(_index_key(key, base_parts, scope), True)
+
+    def invalidate(self, key=None):
+        """ Drop a cached result, or all cached results if `key` is None
+        """
+        search = None
+        with self.lock:
+            if key is None:
+                self.searches.clear()
+            else:
+                search = self.searches.pop(key, None)
+        self.storage.invalidate(key)
+        if search is not None:
+            self.storage.invalidate(_index_key(key, search[0], search[1]))
+
+    def invalidate_dn(self, dn, subtree=False, encoding='UTF-8'):
+        """ Drop all cached results that may include the record at `dn`
+
+        If `subtree` is true all records below `dn` are considered
+        changed as well, for example after a subtree deletion.
+        """
+        dn_parts = normalize_dn(dn, encoding)
+        if getattr(self.storage, 'shared', False):
+            # Other processes store results this process does not know of
+            searches = list(self._stored())
+        else:
+            with self.lock:
+                searches = [(key, base_parts, scope) for key, (
+                            base_parts, scope, expires)
+                            in self.searches.items()]
+
+        found = [(key, base_parts, scope)
+                 for key, base_parts, scope in searches
+                 if dn_in_scope(dn_parts, base_parts, scope) or
+                 (subtree and dn_in_scope(base_parts, dn_parts,
+                                          ldap.SCOPE_SUBTREE))]
+        with self.lock:
+            for key, base_parts, scope in found:
+                self.searches.pop(key, None)
+
+        for key, base_parts, scope in found:
+            self.storage.invalidate(key)
+            self.storage.invalidate(_index_key(key, base_parts, scope))
+
+    def _stored(self):
+        """ Read key, base and scope of all stored results from the index
+        """
+        for name in self.storage.keys():
+            if name.startswith(INDEX_PREFIX):
+                scope, key, base = name[len(INDEX_PREFIX):].split(':', 2)
+                yield key, normalize_dn(base), int(scope)
+
+    def _prune(self):
+        """ Remove expired searches from the index
+        """
+        now = time.time()
+        for key, (base_parts, scope, expires) in list(self.searches.items()):
+            if expires < now:
+                del self.searches[key]
+
+
+class BindCache(object):
+    """ Cache for successful password checks by DN
+
+    Only a salted PBKDF2 fingerprint of the password is kept, never the
+    password itself. A cached check stays valid for `timeout` seconds,
+    so a password changed or an account locked by another client is
+    only noticed after that time. Changes through the same connection
+    drop the entry right away.
+
+    - `max_size` is the maximum number of DNs kept, the least recently
+      used DN is dropped first
+
+    - `iterations` is the number of PBKDF2-SHA256 iterations per check
+    """
+
+    def __init__(self, timeout=60, max_size=1000, iterations=10000):
+        self.timeout = timeout
+        self.max_size = max_size
+        self.iterations = iterations
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check(self, dn, password, encoding='UTF-8'):
+        """ Find out if `password` was checked for `dn` not long ago
+        """
+        key = normalize_dn(dn, encoding)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return False
+
+        salt, fingerprint, expires = entry
+        if expires < time.time():
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+            return False
+
+        if not hmac.compare_digest(self._fingerprint(password, salt),
+                                   fingerprint):
+            return False
+
+        with self.lock:
+            if self.entries.get(key) is entry:
+                self.entries[key] = self.entries.pop(key)
+        return True
+
+    def set(self, dn, password, encoding='UTF-8'):
+        """ Remember that `password` is valid for `dn`
+        """
+        key = normalize_dn(dn, encoding)
+        salt = os.urandom(16)
+        entry = (salt, self._fingerprint(password, salt),
+                 time.time() + self.timeout)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, dn=None, subtree=False, encoding='UTF-8'):
+        """ Forget the check for `dn`, or all checks if `dn` is None
+
+        If `subtree` is true checks for all DNs below `dn` are dropped
+        as well.
+        """
+        with self.lock:
+            if dn is None:
+                self.entries.clear()
+                return
+
+            dn_parts = normalize_dn(dn, encoding)
+            if not subtree:
+                self.entries.pop(dn_parts, None)
+                return
+
+            for key in list(self.entries):
+                if dn_in_scope(key, dn_parts, ldap.SCOPE_SUBTREE):
+                    del self.entries[key]
+
+    def _fingerprint(self, password, salt):
+        if isinstance(password, six.text_type):
+            password = password.encode('UTF-8')
+        return pbkdf2_hmac('sha256', password, salt, self.iterations)
+
+
+@implementer(ITimeoutCache)
+class SQLiteCache(object):
+    """ Timeout cache kept in a SQLite database file
+
+    Values are pickled. Several processes can share the same file, which
+    is opened in write-ahead logging mode so readers do not wait for
+    writers. Expired values are removed when the file is opened.
+    """
+    shared = True
+
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=30,
+                                  check_same_thread=False)
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            # Losing the last writes in a power failure is fine for a
+            # cache, and saves a sync on every cache miss
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                            'key TEXT PRIMARY KEY, value BLOB, '
+                            'expires REAL)')
+            self._purge()
+
+    def set(self, key, object):
+        """ Store a key/value pair
+        """
+        value = sqlite3.Binary(cPickle.dumps(object,
+                                             cPickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                            (key.lower(), value, time.time() + self.timeout))
+            self.db.commit()
+
+    def get(self, key, default=None):
+        """ Get the value for the given key unless it has expired
+        """
+        with self.lock:
+            row = self.db.execute('SELECT value FROM cache '
+                                  'WHERE key = ? AND expires > ?',
+                                  (key.lower(), time.time())).fetchone()
+        if row is None:
+            return default
+        return cPickle.loads(bytes(row[0]))
+
+    def invalidate(self, key=None):
+        """ Invalidate the given key, or all key/values if no key is passed
+        """
+        with self.lock:
+            if key is None:
+                self.db.execute('DELETE FROM cache')
+            else:
+                self.db.execute('DELETE FROM cache WHERE key = ?',
+                                (key.lower(),))
+            self.db.commit()
+
+    def keys(self):
+        """ Return all cache keys
+        """
+        return [key for key, value in self._rows('key, NULL')]
+
+    def values(self):
+        """ Return all cached values
+        """
+        return [value for key, value in self.items()]
+
+    def items(self):
+        """ Return all cached keys and values as (key, value) tuples
+        """
+        return [(key, cPickle.loads(bytes(value)))
+                for key, value in self._rows('key, value')]
+
+    def setTimeout(self, timeout):
+        """ Set a timeout value in seconds
+        """
+        self.timeout = timeout
+
+    def getTimeout(self):
+        """ Get the timeout value
+        """
+        return self.timeout
+
+    def close(self):
+        """ Close the database file
+        """
+        with self.lock:
+            self.db.close()
+
+    def _rows(self, columns):
+        with self.lock:
+            return self.db.execute('SELECT %s FROM cache WHERE expires > ?'
+                                   % columns, (time.time(),)).fetchall()
+
+    def _purge(self):
+        self.db.execute('DELETE FROM cache WHERE expires <= ?',
+                        (time.time(),))
+        self.db.commit()
+
+
+@implementer(ITimeoutCache)
+class SocketCache(object):
+    """ Client for a `CacheServer` listening on a UNIX domain socket
+
+    All processes using the same socket path share the cached values.
+    If the server cannot be reached the cache behaves as if it were
+    empty, so callers fall back to asking the LDAP server.
+    """
+    shared = True
+
+    def __init__(self, path, connect_timeout=1):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.pid = None
+        self.timeout = 600
+
+    def _call(self, method, *args, **kw):
+        default = kw.get('default')
+        with self.lock:
+            # Sockets must not be shared with a forked child process
+            if self.sock is not None and self.pid != os.getpid():
+                self.sock = None
+            try:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_UNIX,
+                                              socket.SOCK_STREAM)
+                    self.sock.settimeout(self.connect_timeout)
+                    self.sock.connect(self.path)
+                    self.sock.settimeout(None)
+                    self.pid = os.getpid()
+                _send(self.sock, (method, args))
+                response = _receive(self.sock)
+                if response is None:
+                    raise socket.error('Connection closed by cache server')
+            except (socket.error, EnvironmentError) as e:
+                logger.warning('Shared cache unavailable: %s' % str(e))
+                self._close()
+                return default
+
+        status, value = response
+        if status != 'ok':
+            raise RuntimeError(value)
+        return value
+
+    def set(self, key, object):
+        """ Store a key/value pair
+        """
+        self._call('set', key, object)
+
+    def get(self, key, default=None):
+        """ Get the value for the given key unless it has expired
+        """
+        return self._call('get', key, default, default=default)
+
+    def invalidate(self, key=None):
+        """ Invalidate the given key, or all key/values if no key is passed
+        """
+        self._call('invalidate', key)
+
+    def keys(self):
+        """ Return all cache keys
+        """
+        return self._call('keys', default=[])
+
+    def values(self):
+        """ Return all cached values
+        """
+        return self._call('values', default=[])
+
+    def items(self):
+        """ Return all cached keys and values as (key, value) tuples
+        """
+        return self._call('items', default=[])
+
+    def setTimeout(self, timeout):
+        """ Set the timeout value in seconds for values stored from now on
+        """
+        self.timeout = timeout
+        self._call('setTimeout', timeout)
+
+    def getTimeout(self):
+        """ Get the timeout value
+        """
+        return self.timeout
+
+    def close(self):
+        """ Close the connection to the server
+        """
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class _CacheRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        storage = self.server.storage
+        while True:
+            request = _receive(self.request)
+            if request is None:
+                return
+
+            method, args = request
+            if method not in SHARED_METHODS:
+                _send(self.request, ('error', 'Bad method %s' % method))
+                continue
+
+            try:
+                _send(self.request, ('ok', getattr(storage, method)(*args)))
+            except Exception as e:
+                _send(self.request, ('error', str(e)))
+
+
+class CacheServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    """ Serve a cache to `SocketCache` clients on a UNIX domain socket
+
+    A prefork server starts it in the parent process before forking its
+    workers. The socket is only accessible to the user running the
+    server, as clients send pickled data.
+
+    - `storage` is the cache holding the values, by default a
+      ``LockingTimeoutCache``
+    """
+    daemon_threads = True
+
+    def __init__(self, path, storage=None):
+        if storage is None:
+            storage = LockingTimeoutCache()
+        self.storage = storage
+        self.path = path
+        self._thread = None
+
+        if os.path.exists(path):
+            os.unlink(path)
+        old_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path,
+                                                   _CacheRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def start(self):
+        """ Serve requests from a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop serving and remove the socket file
+        """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -16,27 +16,80 @@ Instances of this class offer a simplified API to do searches, insertions,
 deletions or modifications.
 """
 
+from collections import deque
 import ldap
+from ldap.controls import LDAPControl
+from ldap.controls import SimplePagedResultsControl
+from ldap.controls.libldap import AssertionControl
+from ldap.controls.readentry import PostReadControl
+from ldap.controls.readentry import PreReadControl
 from ldap.dn import str2dn
 from ldap.ldapobject import ReconnectLDAPObject
 import ldapurl
 import logging
 from random import random
 import six
+import time
 
 from zope.interface import implementer
 
 from dataflake.cache.simple import LockingSimpleCache
+from dataflake.ldapconnection.filters import Equality
+from dataflake.ldapconnection.filters import Filter
+from dataflake.ldapconnection.filters import Or
 from dataflake.ldapconnection.interfaces import ILDAPConnection
-from dataflake.ldapconnection.utils import BINARY_ATTRIBUTES
+from dataflake.ldapconnection.metrics import instrumented
+from dataflake.ldapconnection.metrics import MetricsRegistry
+from dataflake.ldapconnection.observers import _pop
+from dataflake.ldapconnection.observers import _push
+from dataflake.ldapconnection.observers import current_event
+from dataflake.ldapconnection.observers import OperationEvent
 from dataflake.ldapconnection.utils import dn2str
 from dataflake.ldapconnection.utils import escape_dn
+from dataflake.ldapconnection.utils import has_binary_values
 
 
+TREE_DELETE_CONTROL = '1.2.840.113556.1.4.805'
+
 default_logger = logging.getLogger('dataflake.ldapconnection')
 connection_cache = LockingSimpleCache()
 _marker = ()
 
+# Asynchronous variants of the synchronous connection methods
+_async_methods = {'search_s': 'search_ext', 'add_s': 'add_ext',
+                  'modify_s': 'modify_ext', 'delete_s': 'delete_ext',
+                  'modrdn_s': 'rename'}
+
+
+def _deadline(timeout):
+    """ The time an operation must be finished by, None without a limit
+    """
+    if timeout is None:
+        return None
+    return time.time() + timeout
+
+
+def _remaining(deadline):
+    """ The seconds left until `deadline`, raise TIMEOUT if it has passed
+    """
+    if deadline is None:
+        return None
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise ldap.TIMEOUT({'desc': 'Timed out', 'info': 'Deadline exceeded'})
+    return remaining
+
+
+def _changes_password(attrs):
+    """ Find out if a modification touches the userPassword attribute
+    """
+    for key in attrs or ():
+        if isinstance(key, six.binary_type):
+            key = key.decode('UTF-8')
+        if key.split(';')[0].lower() == 'userpassword':
+            return True
+    return False
+
 
 @implementer(ILDAPConnection)
 class LDAPConnection(object):
@@ -44,6 +97,42 @@ class LDAPConnection(object):
 
     See `interfaces.py` for interface documentation.
     """
+    # Maximum number of outstanding asynchronous operations per connection
+    pipeline_window = 32
+
+    # Maximum number of RDN terms in a single lookup_many search filter
+    lookup_chunk_size = 50
+
+    # Default number of records per page for paged searches
+    page_size = 500
+
+    # A SyncMirror answering searches within its subtree locally
+    mirror = None
+
+    # A ResultCache for search results, invalidated by our own writes
+    result_cache = None
+
+    # The MetricsRegistry recording operation timings and counts
+    metrics = None
+
+    # Registered IOperationObserver objects, see addObserver
+    observers = ()
+
+    # A profiler from the profiling module profiling some operations
+    profiler = None
+
+    # A RetryPolicy retrying operations after transient errors
+    retry_policy = None
+
+    # An AttributeSchema telling which attributes have binary values
+    schema = None
+
+    # A BindCache remembering successful password checks for a while
+    bind_cache = None
+
+    # Replace all values of an attribute instead of sending the added and
+    # removed values if their number reaches this fraction of the values
+    replace_threshold = 0.5
 
     def __init__(self, host='', port=389, protocol='ldap',
                  c_factory=ReconnectLDAPObject, rdn_attr='',
@@ -64,11 +153,25 @@ class LDAPConnection(object):
         self.ldap_encoding = ldap_encoding
         self.api_encoding = api_encoding
         self.hash = id(self) + random()
+        self.metrics = MetricsRegistry()
 
         self.servers = {}
         if host:
             self.addServer(host, port, protocol, conn_timeout, op_timeout)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Observers, profilers, retry policies, result caches and mirrors
+        # are added at runtime and need not be picklable, password checks
+        # are not persisted
+        state.pop('observers', None)
+        state.pop('profiler', None)
+        state.pop('retry_policy', None)
+        state.pop('result_cache', None)
+        state.pop('mirror', None)
+        state.pop('bind_cache', None)
+        return state
+
     def logger(self):
         """ Get the logger
         """
@@ -77,6 +180,52 @@ class LDAPConnection(object):
 
         return self._logger
 
+    def addObserver(self, observer):
+        """ Register an operation observer
+        """
+        self.observers = self.observers + (observer,)
+
+    def removeObserver(self, observer):
+        """ Unregister an operation observer
+        """
+        self.observers = tuple(x for x in self.observers if x is not observer)
+
+    def _startEvent(self, operation, server=None, **kw):
+        """ Tell the observers about an operation, return the event
+
+        Returns None if there are no observers.
+        """
+        if not self.observers:
+            return None
+
+        event = OperationEvent(operation, server, **kw)
+        _push(event)
+        self._notifyObservers('started', event)
+        return event
+
+    def _finishEvent(self, event, result=None, exception=None):
+        """ Tell the observers an operation has finished
+        """
+        if event is not None:
+            event.finish(result, exception)
+            _pop(event)
+            self._notifyObservers('finished', event)
+
+    def _phase(self, name, started):
+        """ Add the time since `started` to a phase of the current event
+        """
+        if self.observers:
+            event = current_event()
+            if event is not None:
+                event.addPhase(name, time.time() - started)
+
+    def _notifyObservers(self, method, event):
+        for observer in self.observers:
+            try:
+                getattr(observer, method)(event)
+            except Exception:
+                self.logger().exception('Operation observer failed')
+
     def addServer(self, host, port, protocol, conn_timeout=-1, op_timeout=-1):
         """ Add a server definition to the list of servers used
         """
@@ -101,7 +250,7 @@ class LDAPConnection(object):
         if server_url in self.servers.keys():
             del self.servers[server_url]
 
-    def connect(self, bind_dn=None, bind_pwd=None):
+    def connect(self, bind_dn=None, bind_pwd=None, timeout=None):
         """ initialize an ldap server connection
 
         This method returns an instance of the underlying `pyldap`
@@ -111,6 +260,91 @@ class LDAPConnection(object):
         if not self.servers:
             raise RuntimeError('No servers defined')
 
+        deadline = _deadline(timeout)
+        bind_dn, bind_pwd = self._bindCredentials(bind_dn, bind_pwd)
+
+        conn = self._getConnection()
+        new = conn is None
+        if new:
+            conn = self._connectServer(deadline=deadline)
+            connection_cache.set(self.hash, conn)
+
+        last_bind = getattr(conn, '_last_bind', None)
+        if not last_bind or \
+           last_bind[1][0] != bind_dn or \
+           last_bind[1][1] != bind_pwd:
+            try:
+                self._bind(conn, bind_dn, bind_pwd, deadline)
+            except ldap.TIMEOUT:
+                # The connection state is unknown, start over next time
+                connection_cache.invalidate(self.hash)
+                raise
+
+        if new and deadline is not None:
+            self._resetNetworkTimeout(conn)
+
+        if self.retry_policy is not None:
+            self.retry_policy.connected()
+
+        return conn
+
+    def _newConnection(self, bind_dn=None, bind_pwd=None, c_factory=None):
+        """ Open and bind an additional connection that is not cached
+
+        Used for long-running operations that would block the shared
+        connection, like persistent searches.
+        """
+        if not self.servers:
+            raise RuntimeError('No servers defined')
+
+        conn = self._connectServer(c_factory=c_factory)
+        self._bind(conn, *self._bindCredentials(bind_dn, bind_pwd))
+
+        return conn
+
+    def _bind(self, conn, bind_dn, bind_pwd, deadline=None):
+        """ Bind a server connection with encoded credentials
+        """
+        if self.metrics is None and not self.observers:
+            return self._simpleBind(conn, bind_dn, bind_pwd, deadline)
+
+        server = getattr(conn, 'server_url', None)
+        event = self._startEvent('bind', server, base=bind_dn)
+        started = time.time()
+        try:
+            self._simpleBind(conn, bind_dn, bind_pwd, deadline)
+        except Exception as e:
+            self._countBind('failure', server, started)
+            self._finishEvent(event, exception=e)
+            raise
+        self._countBind('success', server, started)
+        self._finishEvent(event)
+
+    def _simpleBind(self, conn, bind_dn, bind_pwd, deadline=None):
+        """ Bind, waiting for the answer no longer than the deadline allows
+
+        Binds cannot be abandoned, the operations timeout of the
+        connection is lowered for the bind instead.
+        """
+        if deadline is None:
+            return conn.simple_bind_s(bind_dn, bind_pwd)
+
+        op_timeout = getattr(conn, 'timeout', -1)
+        conn.timeout = self._timeout(conn, deadline)
+        try:
+            return conn.simple_bind_s(bind_dn, bind_pwd)
+        finally:
+            conn.timeout = op_timeout
+
+    def _countBind(self, result, server, started):
+        if self.metrics is not None:
+            self.metrics.increment('binds_total', result=result)
+            self.metrics.observe('operation_seconds', time.time() - started,
+                                 operation='bind', server=server or '')
+
+    def _bindCredentials(self, bind_dn=None, bind_pwd=None):
+        """ Encode the given credentials, or the configured credentials
+        """
         if bind_dn is None:
             bind_dn = escape_dn(self._encode_incoming(self.bind_dn),
                                 self.ldap_encoding)
@@ -120,50 +354,95 @@ class LDAPConnection(object):
                                 self.ldap_encoding)
             bind_pwd = self._encode_incoming(bind_pwd)
 
-        conn = self._getConnection()
-        if conn is None:
-            for server in self.servers.values():
-                try:
-                    conn = self._connect(server['url'],
-                                         conn_timeout=server['conn_timeout'],
-                                         op_timeout=server['op_timeout'])
-                    if server.get('start_tls', None):
-                        conn.start_tls_s()
-                    break
-                except (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.LOCAL_ERROR) as e:
-                    conn = None
-                    exc = e
-                    continue
+        return bind_dn, bind_pwd
 
-            if conn is None:
-                msg = 'Failure connecting, last attempt: %s (%s)' % (
-                            server['url'], str(exc) or 'no exception')
-                self.logger().critical(msg, exc_info=1)
+    def _connectServer(self, c_factory=None, deadline=None):
+        """ Connect to the first server definition that works
 
-                if exc:
-                    raise exc
+        With a deadline, the network timeout is lowered to the time left
+        and no more servers are tried once it has passed. A retry policy
+        decides about the order of the servers.
+        """
+        servers = self.servers.values()
+        if self.retry_policy is not None:
+            servers = self.retry_policy.order(servers)
+
+        for server in servers:
+            conn_timeout = server['conn_timeout']
+            remaining = _remaining(deadline)
+            if remaining is not None and \
+                    (conn_timeout <= 0 or remaining < conn_timeout):
+                conn_timeout = remaining
+            event = self._startEvent('connect', server['url'])
+            started = time.time()
+            try:
+                conn = self._connect(server['url'],
+                                     conn_timeout=conn_timeout,
+                                     op_timeout=server['op_timeout'],
+                                     c_factory=c_factory)
+                if server.get('start_tls', None):
+                    conn.start_tls_s()
+                conn.server_url = server['url']
+                self._countConnect(server['url'], 'success', started)
+                self._finishEvent(event)
+                break
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.LOCAL_ERROR) as e:
+                self._countConnect(server['url'], 'failure', started)
+                if self.retry_policy is not None:
+                    self.retry_policy.serverFailed(server['url'])
+                self._finishEvent(event, exception=e)
+                conn = None
+                exc = e
+                continue
+            except Exception as e:
+                self._countConnect(server['url'], 'failure', started)
+                self._finishEvent(event, exception=e)
+                raise
 
-            connection_cache.set(self.hash, conn)
+        if conn is None:
+            msg = 'Failure connecting, last attempt: %s (%s)' % (
+                        server['url'], str(exc) or 'no exception')
+            self.logger().critical(msg, exc_info=1)
 
-        last_bind = getattr(conn, '_last_bind', None)
-        if not last_bind or \
-           last_bind[1][0] != bind_dn or \
-           last_bind[1][1] != bind_pwd:
-            conn.simple_bind_s(bind_dn, bind_pwd)
+            if exc:
+                raise exc
 
         return conn
 
+    def _countConnect(self, server_url, result, started):
+        if self.metrics is not None:
+            self.metrics.increment('connects_total', server=server_url,
+                                   result=result)
+            self.metrics.observe('operation_seconds', time.time() - started,
+                                 operation='connect', server=server_url)
+
     def _getConnection(self):
         """ Private helper to get my connection out of the cache
         """
         return connection_cache.get(self.hash)
 
-    def _connect(self, connection_string, conn_timeout=5, op_timeout=-1):
+    def _serverUrl(self):
+        """ The URL of the server the cached connection talks to
+        """
+        return getattr(self._getConnection(), 'server_url', None)
+
+    def _updateGauges(self, metrics):
+        metrics.gauge('connections_open',
+                      int(self._getConnection() is not None))
+        metrics.gauge('servers', len(self.servers))
+        if self.result_cache is not None:
+            metrics.gauge('result_cache_entries',
+                          len(self.result_cache.searches))
+        if self.mirror is not None:
+            metrics.gauge('mirror_entries', len(self.mirror.entries))
+
+    def _connect(self, connection_string, conn_timeout=5, op_timeout=-1,
+                 c_factory=None):
         """ Factored out to allow usage by other pieces
 
         user_dn is assumed to have been encoded/escaped correctly
         """
-        connection = self.c_factory(connection_string)
+        connection = (c_factory or self.c_factory)(connection_string)
 
         # Deny auto-chasing of referrals to be safe, we handle them instead
         try:
@@ -181,6 +460,104 @@ class LDAPConnection(object):
 
         return connection
 
+    def _resetNetworkTimeout(self, conn):
+        """ Restore the configured network timeout after connecting
+
+        The timeout may have been lowered to meet a deadline, it would be
+        kept for reconnecting otherwise.
+        """
+        server = self.servers.get(getattr(conn, 'server_url', None))
+        conn_timeout = server['conn_timeout'] if server else -1
+        try:
+            conn.set_option(ldap.OPT_NETWORK_TIMEOUT,
+                            conn_timeout if conn_timeout > 0 else -1)
+        except (ValueError, ldap.LDAPError):
+            pass
+
+    def _timeout(self, connection, deadline):
+        """ The time to wait for an answer given the deadline
+
+        The operations timeout configured for the server still applies
+        if it is shorter.
+        """
+        remaining = _remaining(deadline)
+        op_timeout = getattr(connection, 'timeout', -1)
+        if op_timeout is not None and 0 < op_timeout < remaining:
+            return op_timeout
+        return remaining
+
+    def _call(self, connection, deadline, method, *args):
+        """ Call a synchronous connection method like ``search_s``
+
+        With a deadline its asynchronous variant is used instead. If the
+        server does not answer in time, the operation is abandoned on the
+        server and TIMEOUT is raised.
+        """
+        if deadline is None:
+            return getattr(connection, method)(*args)
+
+        msgid = getattr(connection, _async_methods[method])(*args)
+        return self._result(connection, msgid, deadline)[1]
+
+    def _result(self, connection, msgid, deadline=None):
+        """ Wait for the result of an asynchronous operation
+
+        Returns the `result3` tuple. Operations still running when the
+        deadline passes are abandoned on the server.
+        """
+        if deadline is None:
+            return connection.result3(msgid)
+
+        try:
+            return connection.result3(msgid,
+                                      timeout=self._timeout(connection,
+                                                            deadline))
+        except ldap.TIMEOUT:
+            try:
+                connection.abandon_ext(msgid)
+            except ldap.LDAPError:
+                pass
+            if self.metrics is not None:
+                self.metrics.increment('abandons_total')
+            raise
+
+    @instrumented('authenticate')
+    def authenticate(self, dn, password, timeout=None):
+        """ Check a password by binding as `dn`
+
+        Returns True if the bind succeeded and False for invalid
+        credentials.
+        """
+        if not password:
+            # The server would accept an unauthenticated bind
+            return False
+
+        bind_dn, bind_pwd = self._bindCredentials(dn, password)
+        if self.bind_cache is not None:
+            hit = self.bind_cache.check(bind_dn, bind_pwd,
+                                        self.ldap_encoding)
+            self._countCache('bind_cache', hit)
+            if hit:
+                return True
+
+        # The shared connection stays bound with the configured
+        # credentials, other threads keep using it meanwhile
+        deadline = _deadline(timeout)
+        conn = self._connectServer(deadline=deadline)
+        try:
+            self._bind(conn, bind_dn, bind_pwd, deadline)
+        except ldap.INVALID_CREDENTIALS:
+            return False
+        finally:
+            try:
+                conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+
+        if self.bind_cache is not None:
+            self.bind_cache.set(bind_dn, bind_pwd, self.ldap_encoding)
+        return True
+
     def disconnect(self):
         """ Unbind the connection and invalidate the cache
         """
@@ -189,30 +566,142 @@ class LDAPConnection(object):
             connection_cache.invalidate(self.hash)
             conn.unbind_s()
 
+    @instrumented('search')
     def search(self, base, scope=ldap.SCOPE_SUBTREE, fltr='(objectClass=*)',
                attrs=None, convert_filter=True, bind_dn=None, bind_pwd=None,
-               raw=False):
+               raw=False, timeout=None):
         """ Search for entries in the database
         """
-        result = {'size': 0, 'results': [], 'exception': ''}
-        if convert_filter:
-            fltr = self._encode_incoming(fltr)
+        deadline = _deadline(timeout)
+        fltr = self._encode_filter(fltr, convert_filter)
         base = escape_dn(self._encode_incoming(base),
                          self.ldap_encoding)
-        connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
+
+        if self.mirror is not None and bind_dn is None:
+            res = self.mirror.search(base, scope, fltr, attrs)
+            self._countCache('mirror', res is not None)
+            if res is not None:
+                return self._process_results(res, raw=raw)
+
+        cache_key = None
+        if self.result_cache is not None and bind_dn is None:
+            # Connections sharing a storage may see different records
+            cache_key = self.result_cache.key(base, scope, fltr, attrs, raw,
+                                              self.api_encoding,
+                                              self.ldap_encoding,
+                                              self._bindCredentials()[0],
+                                              sorted(self.servers))
+            result = self.result_cache.get(cache_key)
+            self._countCache('result_cache', result is not None)
+            if result is not None:
+                return result
+
+        res = self._searchServer(base, scope, fltr, attrs, bind_dn, bind_pwd,
+                                 deadline)
+        started = time.time()
+        result = self._process_results(res, raw=raw)
+        self._phase('decode', started)
+
+        if cache_key is not None:
+            self.result_cache.set(cache_key, base, scope, result,
+                                  encoding=self.ldap_encoding)
+
+        return result
+
+    def _searchServer(self, base, scope, fltr, attrs, bind_dn=None,
+                      bind_pwd=None, deadline=None):
+        """ Search on the server with encoded arguments, return raw results
+        """
+        connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd,
+                                  timeout=_remaining(deadline))
+        started = time.time()
 
         try:
-            res = connection.search_s(base, scope, fltr, attrs)
+            res = self._call(connection, deadline, 'search_s', base, scope,
+                             fltr, attrs)
         except ldap.PARTIAL_RESULTS:
             res_type, res = connection.result(all=0)
         except ldap.REFERRAL as e:
-            connection = self._handle_referral(e)
+            connection = self._handle_referral(e, deadline)
 
             try:
-                res = connection.search_s(base, scope, fltr, attrs)
+                res = self._call(connection, deadline, 'search_s', base,
+                                 scope, fltr, attrs)
             except ldap.PARTIAL_RESULTS:
                 res_type, res = connection.result(all=0)
 
+        self._phase('network', started)
+        return res
+
+    def search_paged(self, base, scope=ldap.SCOPE_SUBTREE,
+                     fltr='(objectClass=*)', attrs=None, convert_filter=True,
+                     bind_dn=None, bind_pwd=None, raw=False, page_size=None,
+                     cookie=None):
+        """ Search for entries, returning results one page at a time
+        """
+        fltr = self._encode_filter(fltr, convert_filter)
+        base = escape_dn(self._encode_incoming(base), self.ldap_encoding)
+        page_size = page_size or self.page_size
+        connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
+
+        while True:
+            res, cookie = self._searchPage(connection, base, scope, fltr,
+                                           attrs, page_size, cookie)
+            started = time.time()
+            page = self._process_results(res, raw=raw)
+            self._phase('decode', started)
+            page['cookie'] = cookie
+            yield page
+
+            if not cookie:
+                break
+
+    @instrumented('search_page')
+    def _searchPage(self, connection, base, scope, fltr, attrs, page_size,
+                    cookie):
+        """ Fetch one page of a paged search, return results and cookie
+        """
+        page_control = SimplePagedResultsControl(True, size=page_size,
+                                                 cookie=cookie or '')
+        started = time.time()
+        msgid = connection.search_ext(base, scope, fltr, attrs,
+                                      serverctrls=[page_control])
+        res_type, res, res_msgid, res_ctrls = connection.result3(msgid)
+        self._phase('network', started)
+
+        cookie = ''
+        for res_ctrl in res_ctrls or ():
+            if res_ctrl.controlType == page_control.controlType:
+                cookie = res_ctrl.cookie
+
+        return res, cookie
+
+    def _countCache(self, cache, hit):
+        if self.metrics is not None:
+            self.metrics.increment('cache_requests_total', cache=cache,
+                                   result=hit and 'hit' or 'miss')
+
+    def _isBinary(self, key):
+        """ Find out if the values of an attribute are binary
+        """
+        if self.schema is not None:
+            return self.schema.isBinary(key)
+        return has_binary_values(key)
+
+    def _encode_filter(self, fltr, convert_filter=True):
+        """ Turn a filter string or filter object into a LDAP filter string
+        """
+        if isinstance(fltr, Filter):
+            return fltr.encode(self)
+        elif convert_filter:
+            return self._encode_incoming(fltr)
+        return fltr
+
+    def _process_results(self, res, raw=False):
+        """ Transcode raw search results into the search result mapping
+        """
+        result = {'size': 0, 'results': [], 'exception': ''}
+
         for rec_dn, rec_dict in res:
             # When used against Active Directory, "rec_dict" may not be
             # be a dictionary in some cases (instead, it can be a list)
@@ -234,7 +723,7 @@ class LDAPConnection(object):
                 for key, value in items:
                     if key == b'dn':
                         del rec_dict[key]
-                    elif key.lower() not in BINARY_ATTRIBUTES:
+                    elif not self._isBinary(key):
                         if isinstance(value, (list, tuple)):
                             for i in range(len(value)):
                                 value[i] = self._encode_outgoing(value[i])
@@ -248,7 +737,118 @@ class LDAPConnection(object):
 
         return result
 
-    def insert(self, base, rdn, attrs=None, bind_dn=None, bind_pwd=None):
+    @instrumented('lookup_many')
+    def lookup_many(self, dns, attrs=None, bind_dn=None, bind_pwd=None,
+                    raw=False, chunk_size=None):
+        """ Fetch many records by DN with as few searches as possible
+        """
+        chunk_size = chunk_size or self.lookup_chunk_size
+        by_parent = {}
+        single = []
+        wanted = {}
+
+        for dn in dns:
+            escaped = escape_dn(self._encode_incoming(dn), self.ldap_encoding)
+            wanted[self._normalize_dn(escaped)] = dn
+            dn_parts = str2dn(escaped)
+
+            if len(dn_parts) < 2 or len(dn_parts[0]) != 1:
+                # Multi-valued or top-level RDNs are looked up one by one
+                single.append(escaped)
+                continue
+
+            attr_name, attr_val, flag = dn_parts[0][0]
+            if isinstance(attr_name, six.binary_type):
+                attr_name = attr_name.decode(self.ldap_encoding or 'UTF-8')
+            if isinstance(attr_val, six.binary_type):
+                attr_val = attr_val.decode(self.ldap_encoding or 'UTF-8')
+            parent = ldap.dn.dn2str(dn_parts[1:])
+            if isinstance(parent, six.text_type) and self.ldap_encoding:
+                parent = parent.encode(self.ldap_encoding)
+            by_parent.setdefault(parent, []).append(
+                Equality(attr_name, attr_val))
+
+        operations = []
+        any_filter = self._encode_incoming('(objectClass=*)')
+        connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
+
+        for parent, rdn_filters in by_parent.items():
+            for i in range(0, len(rdn_filters), chunk_size):
+                fltr = Or(*rdn_filters[i:i + chunk_size]).encode(self)
+                operations.append((parent, connection.search_ext,
+                                   (parent, ldap.SCOPE_ONELEVEL, fltr,
+                                    attrs)))
+
+        for escaped in single:
+            operations.append((escaped, connection.search_ext,
+                               (escaped, ldap.SCOPE_BASE, any_filter, attrs)))
+
+        found = {}
+        for key, outcome in self._pipeline(connection, operations):
+            if isinstance(outcome, ldap.NO_SUCH_OBJECT):
+                continue
+            elif isinstance(outcome, ldap.LDAPError):
+                raise outcome
+
+            for rec_dn, rec_dict in outcome[1]:
+                if rec_dn is None:
+                    continue
+                requested = wanted.get(self._normalize_dn(rec_dn))
+                if requested is not None:
+                    records = self._process_results([(rec_dn, rec_dict)],
+                                                    raw=raw)['results']
+                    if records:
+                        found[requested] = records[0]
+
+        return found
+
+    def _normalize_dn(self, dn):
+        """ Normalize an encoded DN for use as comparison key
+        """
+        return escape_dn(dn, self.ldap_encoding or 'UTF-8').lower()
+
+    def _pipeline(self, connection, operations, window=None):
+        """ Run asynchronous operations with a bounded number outstanding
+
+        `operations` is an iterable of (key, method, args) tuples where
+        `method` is an asynchronous connection method returning a message
+        ID. If `method` is None, `args` is taken as the outcome itself.
+        Yields (key, outcome) tuples in submission order. The outcome
+        is the result tuple returned by `result3` or the LDAPError raised
+        for that operation.
+        """
+        window = window or self.pipeline_window
+        pending = deque()
+
+        for key, method, args in operations:
+            if method is None:
+                pending.append((key, None, args))
+            else:
+                try:
+                    pending.append((key, method(*args), None))
+                except ldap.LDAPError as e:
+                    pending.append((key, None, e))
+
+            if len(pending) >= window:
+                yield self._pipeline_result(connection, *pending.popleft())
+
+        while pending:
+            yield self._pipeline_result(connection, *pending.popleft())
+
+    def _pipeline_result(self, connection, key, msgid, outcome=None):
+        """ Collect the outcome of a single pipelined operation
+        """
+        if msgid is None:
+            return key, outcome
+
+        try:
+            return key, connection.result3(msgid)
+        except ldap.LDAPError as e:
+            return key, e
+
+    @instrumented('insert')
+    def insert(self, base, rdn, attrs=None, bind_dn=None, bind_pwd=None,
+               timeout=None):
         """ Insert a new record
 
         attrs is expected to be a mapping where the value may be a string
@@ -259,6 +859,69 @@ class LDAPConnection(object):
         as UTF-8, by appending ';binary' to the key.
         """
         self._complainIfReadOnly()
+        deadline = _deadline(timeout)
+        dn, attribute_list = self._prepare_insert(base, rdn, attrs)
+
+        try:
+            connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd,
+                                      timeout=_remaining(deadline))
+            self._call(connection, deadline, 'add_s', dn, attribute_list)
+        except ldap.REFERRAL as e:
+            connection = self._handle_referral(e, deadline)
+            self._call(connection, deadline, 'add_s', dn, attribute_list)
+
+        self._invalidate(dn)
+
+    @instrumented('insert_many')
+    def insert_many(self, records, bind_dn=None, bind_pwd=None,
+                    window=None):
+        """ Insert many new records using pipelined add operations
+        """
+        self._complainIfReadOnly()
+        entries = (self._prepare_insert(base, rdn, attrs)
+                   for base, rdn, attrs in records)
+
+        return self._add_many(entries, bind_dn=bind_dn, bind_pwd=bind_pwd,
+                              window=window)
+
+    def _add_many(self, entries, bind_dn=None, bind_pwd=None, window=None):
+        """ Pipeline add operations for (dn, attribute_list) tuples
+        """
+        started = time.time()
+        connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
+        operations = ((dn, connection.add_ext, (dn, attribute_list))
+                      for dn, attribute_list in entries)
+
+        report = self._bulk_report(
+                    self._pipeline(connection, operations, window), started)
+        self._invalidate()
+        return report
+
+    def _bulk_report(self, outcomes, started):
+        """ Summarize the outcomes of pipelined write operations
+        """
+        report = {'size': 0, 'succeeded': 0, 'failed': 0, 'results': []}
+
+        for dn, outcome in outcomes:
+            report['size'] += 1
+            if isinstance(outcome, ldap.LDAPError):
+                report['failed'] += 1
+                report['results'].append((self._encode_outgoing(dn), outcome))
+            else:
+                report['succeeded'] += 1
+                report['results'].append((self._encode_outgoing(dn), None))
+
+        report['seconds'] = time.time() - started
+        if report['seconds'] > 0:
+            report['rate'] = report['size'] / report['seconds']
+        else:
+            report['rate'] = 0.0
+
+        return report
+
+    def _prepare_insert(self, base, rdn, attrs):
+        """ Compute the DN and attribute list for adding a record
+        """
         base = escape_dn(self._encode_incoming(base), self.ldap_encoding)
         rdn = escape_dn(self._encode_incoming(rdn), self.ldap_encoding)
 
@@ -271,54 +934,335 @@ class LDAPConnection(object):
                 is_binary = True
                 attr_key = attr_key[:-7]
             else:
-                is_binary = False
+                is_binary = self._isBinary(attr_key)
 
             if not isinstance(attr_key, six.binary_type):
                 attr_key = self._encode_incoming(attr_key)
 
-            if isinstance(values, six.string_types) and not is_binary:
+            if is_binary:
+                if isinstance(values, (six.binary_type, six.text_type)):
+                    values = [values]
+            elif isinstance(values, six.string_types):
                 values = [x.strip() for x in values.split(';')]
-            elif isinstance(values, six.binary_type) and not is_binary:
+            elif isinstance(values, six.binary_type):
                 values = [x.strip() for x in values.split(b';')]
 
             if values != ['']:
-                if not is_binary:
+                if is_binary:
+                    values = [self._encode_binary(x) for x in values]
+                else:
                     values = [self._encode_incoming(x) for x in values]
                 attribute_list.append((attr_key, values))
 
-        try:
-            connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
-            connection.add_s(dn, attribute_list)
-        except ldap.REFERRAL as e:
-            connection = self._handle_referral(e)
-            connection.add_s(dn, attribute_list)
+        return dn, attribute_list
 
-    def delete(self, dn, bind_dn=None, bind_pwd=None):
+    @instrumented('delete')
+    def delete(self, dn, bind_dn=None, bind_pwd=None, timeout=None):
         """ Delete a record
         """
         self._complainIfReadOnly()
+        deadline = _deadline(timeout)
 
         dn = escape_dn(self._encode_incoming(dn), self.ldap_encoding)
 
         try:
-            connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
-            connection.delete_s(dn)
+            connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd,
+                                      timeout=_remaining(deadline))
+            self._call(connection, deadline, 'delete_s', dn)
         except ldap.REFERRAL as e:
-            connection = self._handle_referral(e)
-            connection.delete_s(dn)
+            connection = self._handle_referral(e, deadline)
+            self._call(connection, deadline, 'delete_s', dn)
+
+        self._invalidate(dn)
+        self._invalidateBind(dn)
 
+    @instrumented('delete_subtree')
+    def delete_subtree(self, dn, bind_dn=None, bind_pwd=None, window=None):
+        """ Delete a record and all records below it
+        """
+        self._complainIfReadOnly()
+        started = time.time()
+        dn = escape_dn(self._encode_incoming(dn), self.ldap_encoding)
+        connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
+
+        supported = self._supportedControls(bind_dn, bind_pwd)
+        if TREE_DELETE_CONTROL.encode('ascii') in supported:
+            control = LDAPControl(TREE_DELETE_CONTROL, True)
+            operations = [(dn, connection.delete_ext, (dn, [control]))]
+            report = self._bulk_report(
+                        self._pipeline(connection, operations), started)
+            self._invalidate(dn, subtree=True)
+            self._invalidateBind(dn, subtree=True)
+            return report
+
+        # Collect the DNs by depth, the search results are in no
+        # particular order but children must be deleted before parents
+        by_depth = {}
+        for page in self.search_paged(dn, ldap.SCOPE_SUBTREE, attrs=['1.1'],
+                                      bind_dn=bind_dn, bind_pwd=bind_pwd,
+                                      raw=True):
+            for record in page['results']:
+                rec_dn = record['dn']
+                by_depth.setdefault(len(str2dn(rec_dn)), []).append(rec_dn)
+
+        outcomes = []
+        for depth in sorted(by_depth, reverse=True):
+            operations = [(x, connection.delete_ext, (x,))
+                          for x in by_depth[depth]]
+            outcomes.extend(self._pipeline(connection, operations, window))
+
+        self._invalidate(dn, subtree=True)
+        self._invalidateBind(dn, subtree=True)
+        return self._bulk_report(outcomes, started)
+
+    def _supportedControls(self, bind_dn=None, bind_pwd=None):
+        """ Get the encoded control OIDs listed in the server's root DSE
+        """
+        try:
+            res = self.search('', ldap.SCOPE_BASE,
+                              attrs=['supportedControl'], bind_dn=bind_dn,
+                              bind_pwd=bind_pwd, raw=True)
+        except ldap.LDAPError:
+            return []
+
+        controls = []
+        for record in res['results']:
+            for key, values in record.items():
+                if key != 'dn' and key.lower() == b'supportedcontrol':
+                    controls.extend(values)
+
+        return controls
+
+    @instrumented('modify')
     def modify(self, dn, mod_type=None, attrs=None, bind_dn=None,
-               bind_pwd=None):
+               bind_pwd=None, cur_rec=None, assertion=None, pre_read=None,
+               post_read=None, timeout=None):
         """ Modify a record
         """
         self._complainIfReadOnly()
+        deadline = _deadline(timeout)
 
         unescaped_dn = self._encode_incoming(dn)
+        if cur_rec is None:
+            if mod_type in (ldap.MOD_ADD, ldap.MOD_REPLACE):
+                # No diff needed, the DN provides the current RDN value
+                cur_rec = self._rdn_record(unescaped_dn)
+            else:
+                # Bypass the mirror and result cache, they may be stale
+                res = self._searchServer(
+                            escape_dn(unescaped_dn, self.ldap_encoding),
+                            ldap.SCOPE_BASE,
+                            self._encode_incoming('(objectClass=*)'), None,
+                            bind_dn=bind_dn, bind_pwd=bind_pwd,
+                            deadline=deadline)
+                cur_rec = self._process_results(res, raw=True)['results'][0]
+        dn, new_rdn, new_dn, mod_list = self._prepare_modify(
+                    unescaped_dn, mod_type, attrs, cur_rec)
+
+        controls = []
+        if assertion is not None:
+            fltr = self._encode_filter(assertion)
+            if six.PY3 and isinstance(fltr, six.binary_type):
+                fltr = fltr.decode(self.ldap_encoding or 'UTF-8')
+            controls.append(AssertionControl(True, fltr))
+        if pre_read is not None:
+            controls.append(PreReadControl(True, list(pre_read)))
+        if post_read is not None:
+            controls.append(PostReadControl(True, list(post_read)))
+
+        result = {'pre_read': None, 'post_read': None}
+        try:
+            connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd,
+                                      timeout=_remaining(deadline))
+
+            if new_rdn is not None:
+                self._call(connection, deadline, 'modrdn_s', dn, new_rdn)
+                self._invalidate(dn, subtree=True)
+                self._invalidateBind(dn, subtree=True)
+                dn = new_dn
+
+            if mod_list:
+                self._modify(connection, dn, mod_list, controls, result,
+                             deadline)
+            else:
+                debug_msg = 'Nothing to modify: %s' % dn
+                self.logger().debug(debug_msg)
+
+        except ldap.REFERRAL as e:
+            connection = self._handle_referral(e, deadline)
+            self._modify(connection, dn, mod_list, controls, result,
+                         deadline)
+
+        self._invalidate(dn)
+        if _changes_password(attrs):
+            self._invalidateBind(dn)
+        return result
+
+    def _modify(self, connection, dn, mod_list, controls, result,
+                deadline=None):
+        """ Send a modification, with request controls if there are any
+
+        The entries returned in read entry response controls are stored
+        in `result` under ``pre_read`` and ``post_read``.
+        """
+        if not controls:
+            self._call(connection, deadline, 'modify_s', dn, mod_list)
+            return
+
+        msgid = connection.modify_ext(dn, mod_list, serverctrls=controls)
+        res_type, res_data, res_msgid, res_ctrls = self._result(
+                    connection, msgid, deadline)
+        for ctrl in res_ctrls or ():
+            if ctrl.controlType == PreReadControl.controlType:
+                result['pre_read'] = self._read_entry(ctrl)
+            elif ctrl.controlType == PostReadControl.controlType:
+                result['post_read'] = self._read_entry(ctrl)
+
+    def _read_entry(self, control):
+        """ Turn a read entry response control into a search record
+        """
+        record = {}
+        for key, values in control.entry.items():
+            key = self._encode_incoming(key)
+            if self._isBinary(key):
+                record[key] = values
+            else:
+                record[key] = [self._encode_outgoing(x) for x in values]
+        record['dn'] = self._encode_outgoing(control.dn)
+
+        return record
+
+    def _diff_values(self, key, cur_values, values):
+        """ Compute the modifications turning one value list into another
+
+        Only values that were added or removed are sent, unless their
+        number reaches `replace_threshold` times the number of new values
+        or values only differ by case. Servers usually compare values
+        case-insensitively, in that case only a replace works.
+        """
+        if not isinstance(values, list) or \
+                not isinstance(cur_values, (list, tuple)):
+            return [(ldap.MOD_REPLACE, key, values)]
+
+        cur_set = set(cur_values)
+        new_set = set(values)
+        added = [x for x in values if x not in cur_set]
+        removed = [x for x in cur_values if x not in new_set]
+
+        if len(added) + len(removed) >= self.replace_threshold * len(values):
+            return [(ldap.MOD_REPLACE, key, values)]
+
+        if set(x.lower() for x in added) & set(x.lower() for x in removed):
+            return [(ldap.MOD_REPLACE, key, values)]
+
+        mod_list = []
+        if removed:
+            mod_list.append((ldap.MOD_DELETE, key, removed))
+        if added:
+            mod_list.append((ldap.MOD_ADD, key, added))
+        return mod_list
+
+    def _rdn_record(self, unescaped_dn):
+        """ Build a minimal current record from the RDN of a DN
+        """
+        rdn_attr, rdn_value, flag = str2dn(
+                    escape_dn(unescaped_dn, self.ldap_encoding))[0][0]
+        if isinstance(rdn_attr, six.text_type):
+            rdn_attr = self._encode_incoming(rdn_attr)
+        if isinstance(rdn_value, six.text_type):
+            rdn_value = self._encode_incoming(rdn_value)
+
+        return {rdn_attr: [rdn_value]}
+
+    @instrumented('modify_many')
+    def modify_many(self, changes, mod_type=None, bind_dn=None,
+                    bind_pwd=None, window=None):
+        """ Modify many records using batched reads and pipelined writes
+        """
+        self._complainIfReadOnly()
+        started = time.time()
+        connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
+        batch_size = self.lookup_chunk_size * self.pipeline_window
+        password_dns = []
+
+        def operations():
+            batch = []
+            for change in changes:
+                batch.append(change)
+                if len(batch) >= batch_size:
+                    for operation in self._modify_operations(
+                            connection, batch, mod_type, bind_dn, bind_pwd,
+                            password_dns):
+                        yield operation
+                    batch = []
+
+            for operation in self._modify_operations(
+                    connection, batch, mod_type, bind_dn, bind_pwd,
+                    password_dns):
+                yield operation
+
+        report = self._bulk_report(
+                    self._pipeline(connection, operations(), window), started)
+        self._invalidate()
+        for dn in password_dns:
+            self._invalidateBind(dn)
+        return report
+
+    def _modify_operations(self, connection, changes, mod_type, bind_dn,
+                           bind_pwd, password_dns):
+        """ Pre-read a batch of records and prepare their modifications
+
+        Yields operations for `_pipeline`. Renames must be finished before
+        the modifications can be applied, so they are done right away.
+        The DNs of records whose password is changed are added to
+        `password_dns`.
+        """
+        if not changes:
+            return
+
+        current = self.lookup_many([dn for dn, attrs in changes],
+                                   bind_dn=bind_dn, bind_pwd=bind_pwd,
+                                   raw=True)
+
+        for dn, attrs in changes:
+            unescaped_dn = self._encode_incoming(dn)
+            cur_rec = current.get(dn)
+            if cur_rec is None:
+                escaped = escape_dn(unescaped_dn, self.ldap_encoding)
+                exc = ldap.NO_SUCH_OBJECT({'desc': 'No such object',
+                                           'info': repr(escaped)})
+                yield escaped, None, exc
+                continue
+
+            dn, new_rdn, new_dn, mod_list = self._prepare_modify(
+                        unescaped_dn, mod_type, attrs, cur_rec)
+
+            if new_rdn is not None:
+                try:
+                    connection.modrdn_s(dn, new_rdn)
+                except ldap.LDAPError as e:
+                    yield dn, None, e
+                    continue
+                self._invalidateBind(dn, subtree=True)
+                dn = new_dn
+
+            if _changes_password(attrs):
+                password_dns.append(dn)
+
+            if mod_list:
+                yield dn, connection.modify_ext, (dn, mod_list)
+            else:
+                yield dn, None, None
+
+    def _prepare_modify(self, unescaped_dn, mod_type, attrs, cur_rec):
+        """ Compute the modifications for a record
+
+        Returns a tuple of the escaped DN, the new RDN and new DN if the
+        modification requires a rename (otherwise both are None) and the
+        modification list.
+        """
         dn = escape_dn(unescaped_dn, self.ldap_encoding)
-        res = self.search(base=unescaped_dn, scope=ldap.SCOPE_BASE,
-                          bind_dn=bind_dn, bind_pwd=bind_pwd, raw=True)
         attrs = attrs and attrs or {}
-        cur_rec = res['results'][0]
         mod_list = []
 
         for key, values in list(attrs.items()):
@@ -327,17 +1271,20 @@ class LDAPConnection(object):
                 key = key[:-7]
                 is_binary = True
             else:
-                is_binary = False
+                is_binary = self._isBinary(key)
 
             if not isinstance(key, six.binary_type):
                 key = self._encode_incoming(key)
 
-            if not is_binary:
-                if isinstance(values, six.string_types):
-                    values = [self._encode_incoming(x) for x in
-                              values.split(';')]
-                else:
-                    values = [self._encode_incoming(x) for x in values]
+            if is_binary:
+                if isinstance(values, (six.binary_type, six.text_type)):
+                    values = [values]
+                values = [self._encode_binary(x) for x in values]
+            elif isinstance(values, six.string_types):
+                values = [self._encode_incoming(x) for x in
+                          values.split(';')]
+            else:
+                values = [self._encode_incoming(x) for x in values]
 
             if isinstance(key, six.text_type):
                 key = self._encode_incoming(key)
@@ -347,7 +1294,8 @@ class LDAPConnection(object):
                     mod_list.append((ldap.MOD_ADD, key, values))
                 elif cur_rec.get(key, [b'']) != values and \
                         values not in ([b''], []):
-                    mod_list.append((ldap.MOD_REPLACE, key, values))
+                    mod_list.extend(
+                        self._diff_values(key, cur_rec[key], values))
                 elif key in cur_rec and values in ([b''], []):
                     mod_list.append((ldap.MOD_DELETE, key, None))
             elif mod_type in (ldap.MOD_ADD, ldap.MOD_DELETE) and \
@@ -361,46 +1309,33 @@ class LDAPConnection(object):
 
             attrs[key] = values
 
-        try:
-            connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
-
-            dn_parts = str2dn(dn)
-            clean_dn_parts = []
-            for dn_part in dn_parts:
-                for (attr_name, attr_val, flag) in dn_part:
-                    if isinstance(attr_name, six.text_type):
-                        attr_name = self._encode_incoming(attr_name)
-                    if isinstance(attr_val, six.text_type):
-                        attr_val = self._encode_incoming(attr_val)
-                    clean_dn_parts.append([(attr_name, attr_val, flag)])
-
-            rdn_attr = clean_dn_parts[0][0][0]
-            raw_rdn = attrs.get(rdn_attr, '')
-            if isinstance(raw_rdn, six.string_types):
-                raw_rdn = [raw_rdn]
-            new_rdn = raw_rdn[0]
-
-            if new_rdn:
-                rdn_value = self._encode_incoming(new_rdn)
-                if rdn_value != cur_rec.get(rdn_attr)[0]:
-                    clean_dn_parts[0] = [(rdn_attr, rdn_value, 1)]
-                    dn_parts[0] = [(rdn_attr, raw_rdn[0], 1)]
-                    raw_utf8_rdn = rdn_attr + b'=' + rdn_value
-                    new_rdn = escape_dn(raw_utf8_rdn, self.ldap_encoding)
-                    connection.modrdn_s(dn, new_rdn)
-                    dn = dn2str(clean_dn_parts)
-
-            if mod_list:
-                connection.modify_s(dn, mod_list)
-            else:
-                debug_msg = 'Nothing to modify: %s' % dn
-                self.logger().debug(debug_msg)
-
-        except ldap.REFERRAL as e:
-            connection = self._handle_referral(e)
-            connection.modify_s(dn, mod_list)
-
-    def _handle_referral(self, exception):
+        dn_parts = str2dn(dn)
+        clean_dn_parts = []
+        for dn_part in dn_parts:
+            for (attr_name, attr_val, flag) in dn_part:
+                if isinstance(attr_name, six.text_type):
+                    attr_name = self._encode_incoming(attr_name)
+                if isinstance(attr_val, six.text_type):
+                    attr_val = self._encode_incoming(attr_val)
+                clean_dn_parts.append([(attr_name, attr_val, flag)])
+
+        rdn_attr = clean_dn_parts[0][0][0]
+        raw_rdn = attrs.get(rdn_attr, '')
+        if isinstance(raw_rdn, six.string_types):
+            raw_rdn = [raw_rdn]
+        new_rdn = raw_rdn[0]
+
+        if new_rdn:
+            rdn_value = self._encode_incoming(new_rdn)
+            if rdn_value != cur_rec.get(rdn_attr)[0]:
+                clean_dn_parts[0] = [(rdn_attr, rdn_value, 1)]
+                raw_utf8_rdn = rdn_attr + b'=' + rdn_value
+                new_rdn = escape_dn(raw_utf8_rdn, self.ldap_encoding)
+                return dn, new_rdn, dn2str(clean_dn_parts), mod_list
+
+        return dn, None, None, mod_list
+
+    def _handle_referral(self, exception, deadline=None):
         """ Handle a referral specified in the passed-in exception
         """
         payload = exception.args[0]
@@ -409,13 +1344,49 @@ class LDAPConnection(object):
 
         if ldapurl.isLDAPUrl(ldap_url):
             conn_str = ldapurl.LDAPUrl(ldap_url).initializeUrl()
-            conn = self._connect(conn_str)
-            conn.simple_bind_s(self._encode_incoming(self.bind_dn),
-                               self._encode_incoming(self.bind_pwd))
+            event = self._startEvent('referral', conn_str)
+            try:
+                conn_timeout = 5
+                if deadline is not None:
+                    conn_timeout = min(conn_timeout, _remaining(deadline))
+                conn = self._connect(conn_str, conn_timeout=conn_timeout)
+                conn.server_url = conn_str
+                self._simpleBind(conn, self._encode_incoming(self.bind_dn),
+                                 self._encode_incoming(self.bind_pwd),
+                                 deadline)
+            except Exception as e:
+                self._finishEvent(event, exception=e)
+                raise
+            self._finishEvent(event)
             return conn
         else:
             raise ldap.CONNECT_ERROR('Bad referral "%s"' % str(exception))
 
+    def _invalidate(self, dn=None, subtree=False):
+        """ Drop cached search results a write to `dn` may have changed
+
+        `dn` is expected in the ldap_encoding. Without a DN all cached
+        results are dropped.
+        """
+        if self.result_cache is None:
+            return
+
+        if dn is None:
+            self.result_cache.invalidate()
+        else:
+            self.result_cache.invalidate_dn(dn, subtree=subtree,
+                                            encoding=self.ldap_encoding)
+
+    def _invalidateBind(self, dn=None, subtree=False):
+        """ Drop cached password checks a write to `dn` may have outdated
+
+        `dn` is expected in the ldap_encoding. Without a DN all cached
+        checks are dropped.
+        """
+        if self.bind_cache is not None:
+            self.bind_cache.invalidate(dn, subtree=subtree,
+                                       encoding=self.ldap_encoding)
+
     def _complainIfReadOnly(self):
         """ Raise RuntimeError if the connection is set to `read-only`
 
@@ -453,6 +1424,16 @@ class LDAPConnection(object):
 
         return value
 
+    def _encode_binary(self, value):
+        """ Encode a value of a binary attribute
+
+        Encoded strings are sent as they are, unicode is encoded to
+        self.ldap_encoding or UTF-8.
+        """
+        if isinstance(value, six.text_type):
+            return value.encode(self.ldap_encoding or 'UTF-8')
+        return value
+
     def _encode_outgoing(self, value):
         """ Encode a string value to the API encoding
 
@@ -0,0 +1,485 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" LDAP search filter construction
+
+Filter objects can be passed to `LDAPConnection.search` instead of a
+filter string. All assertion values are escaped as described in RFC 4515,
+so values coming from untrusted sources cannot change the filter
+structure.
+
+Filters that are built many times with different values should use a
+`Template`, which is parsed and encoded only once per encoding setup.
+
+Filter strings can be turned into filter objects with `parse_filter`,
+and filter objects can be evaluated against records held locally with
+their `match` method.
+"""
+
+import binascii
+import re
+
+import six
+from zope.interface import implementer
+
+from dataflake.cache.simple import LockingSimpleCache
+from dataflake.ldapconnection.interfaces import IFilter
+from dataflake.ldapconnection.utils import escape_filter_value
+
+
+template_cache = LockingSimpleCache()
+PLACEHOLDER_BYTES = re.compile(b'{(\\w+)}')
+PLACEHOLDER_TEXT = re.compile(u'{(\\w+)}')
+FILTER_ITEM = re.compile(u'^([\\w.;-]+)(~=|>=|<=|=)(.*)$', re.DOTALL)
+FILTER_ESCAPE = re.compile(b'\\\\([0-9a-fA-F]{2})')
+
+
+def _join(parts):
+    """ Join encoded filter fragments, which may be bytes or unicode
+    """
+    if parts and isinstance(parts[0], six.text_type):
+        return u''.join(parts)
+    return b''.join(parts)
+
+
+def _value(connection, value):
+    """ Encode and escape a single assertion value
+    """
+    if not isinstance(value, (six.binary_type, six.text_type)):
+        value = six.text_type(value)
+    return escape_filter_value(connection._encode_incoming(value))
+
+
+def _fold(value, encoding):
+    """ Turn a value into lowercase unicode for comparisons
+    """
+    if isinstance(value, six.binary_type):
+        value = value.decode(encoding or 'UTF-8', 'replace')
+    elif not isinstance(value, six.text_type):
+        value = six.text_type(value)
+    return value.lower()
+
+
+def _fold_record(record, encoding):
+    """ Map lowercase attribute names to folded values of a record
+
+    Attribute options like ``;binary`` are ignored. The ``dn`` key of
+    search result records is not an attribute and is left out.
+    """
+    folded = {}
+    for key, values in record.items():
+        if key == 'dn':
+            continue
+        key = _fold(key, 'ascii').split(u';')[0]
+        if isinstance(values, (six.binary_type, six.text_type)):
+            values = [values]
+        folded.setdefault(key, []).extend(_fold(x, encoding)
+                                          for x in values)
+    return folded
+
+
+def _ordered(value, other):
+    """ Return both values as numbers if they both are integers
+    """
+    try:
+        return int(value), int(other)
+    except ValueError:
+        return value, other
+
+
+@implementer(IFilter)
+class Filter(object):
+    """ Base class for all filter expressions
+
+    Filters can be combined using the ``&``, ``|`` and ``~`` operators.
+    Subclasses provide the encoded fragments of the filter string in
+    `_fragments` and evaluate folded records in `_match`.
+    """
+
+    def encode(self, connection):
+        """ Return the filter string in the connection's LDAP encoding
+        """
+        return _join(self._fragments(connection))
+
+    def match(self, record, encoding='UTF-8'):
+        """ Find out if a record matches the filter
+
+        `record` is a mapping of attribute names to value lists as found
+        in search results, and `encoding` is the encoding of encoded
+        values in the record and the filter. Without schema information
+        all values are compared case-insensitively, and values are
+        compared as numbers if both sides are integers.
+        """
+        return self._match(_fold_record(record, encoding), encoding)
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+class _Comparison(Filter):
+    """ Base class for filters comparing an attribute with a value
+
+    Subclasses compare folded values in `_compare`.
+    """
+    operator = None
+
+    def __init__(self, attr, value):
+        self.attr = attr
+        self.value = value
+
+    def _fragments(self, connection):
+        enc = connection._encode_incoming
+        return [enc(u'('), enc(self.attr), enc(self.operator),
+                _value(connection, self.value), enc(u')')]
+
+    def _match(self, record, encoding):
+        value = _fold(self.value, encoding)
+        for candidate in record.get(_fold(self.attr, 'ascii'), ()):
+            if self._compare(candidate, value):
+                return True
+        return False
+
+
+class Equality(_Comparison):
+    """ Equality match: (attr=value)
+    """
+    operator = u'='
+
+    def _compare(self, candidate, value):
+        return candidate == value
+
+
+class Approximate(Equality):
+    """ Approximate match: (attr~=value)
+
+    Local evaluation treats it like an equality match.
+    """
+    operator = u'~='
+
+
+class GreaterOrEqual(_Comparison):
+    """ Ordering match: (attr>=value)
+    """
+    operator = u'>='
+
+    def _compare(self, candidate, value):
+        candidate, value = _ordered(candidate, value)
+        return candidate >= value
+
+
+class LessOrEqual(_Comparison):
+    """ Ordering match: (attr<=value)
+    """
+    operator = u'<='
+
+    def _compare(self, candidate, value):
+        candidate, value = _ordered(candidate, value)
+        return candidate <= value
+
+
+class Presence(Filter):
+    """ Presence match: (attr=*)
+    """
+
+    def __init__(self, attr):
+        self.attr = attr
+
+    def _fragments(self, connection):
+        enc = connection._encode_incoming
+        return [enc(u'('), enc(self.attr), enc(u'=*)')]
+
+    def _match(self, record, encoding):
+        attr = _fold(self.attr, 'ascii')
+        # Every record has an object class, even if it was not retrieved
+        return attr == u'objectclass' or bool(record.get(attr))
+
+
+class Substring(Filter):
+    """ Substring match: (attr=initial*any*final)
+
+    `any` is a sequence of substrings that must appear in the given order
+    between `initial` and `final`.
+    """
+
+    def __init__(self, attr, initial=None, any=(), final=None):
+        if not (initial or any or final):
+            raise ValueError('Substring filter needs at least one substring')
+        self.attr = attr
+        self.initial = initial
+        self.any = tuple(any)
+        self.final = final
+
+    def _fragments(self, connection):
+        enc = connection._encode_incoming
+        star = enc(u'*')
+        fragments = [enc(u'('), enc(self.attr), enc(u'=')]
+        if self.initial:
+            fragments.append(_value(connection, self.initial))
+        fragments.append(star)
+        for value in self.any:
+            fragments.append(_value(connection, value))
+            fragments.append(star)
+        if self.final:
+            fragments.append(_value(connection, self.final))
+        fragments.append(enc(u')'))
+        return fragments
+
+    def _match(self, record, encoding):
+        initial = self.initial and _fold(self.initial, encoding) or u''
+        final = self.final and _fold(self.final, encoding) or u''
+        any = [_fold(x, encoding) for x in self.any]
+
+        for candidate in record.get(_fold(self.attr, 'ascii'), ()):
+            if not candidate.startswith(initial):
+                continue
+            pos = len(initial)
+            end = len(candidate) - len(final)
+            for value in any:
+                pos = candidate.find(value, pos, end)
+                if pos == -1:
+                    break
+                pos += len(value)
+            else:
+                if pos <= end and candidate.endswith(final):
+                    return True
+        return False
+
+
+class _Junction(Filter):
+    """ Base class for filters combining other filters
+    """
+    operator = None
+
+    def __init__(self, *filters):
+        if not filters:
+            raise ValueError('At least one filter is required')
+        self.filters = filters
+
+    def _fragments(self, connection):
+        enc = connection._encode_incoming
+        fragments = [enc(u'(' + self.operator)]
+        for fltr in self.filters:
+            fragments.extend(fltr._fragments(connection))
+        fragments.append(enc(u')'))
+        return fragments
+
+
+class And(_Junction):
+    """ All filters must match: (&(...)(...))
+    """
+    operator = u'&'
+
+    def _match(self, record, encoding):
+        for fltr in self.filters:
+            if not fltr._match(record, encoding):
+                return False
+        return True
+
+
+class Or(_Junction):
+    """ At least one filter must match: (|(...)(...))
+    """
+    operator = u'|'
+
+    def _match(self, record, encoding):
+        for fltr in self.filters:
+            if fltr._match(record, encoding):
+                return True
+        return False
+
+
+class Not(Filter):
+    """ Negation: (!(...))
+    """
+
+    def __init__(self, fltr):
+        self.filter = fltr
+
+    def _fragments(self, connection):
+        enc = connection._encode_incoming
+        return ([enc(u'(!')] + self.filter._fragments(connection) +
+                [enc(u')')])
+
+    def _match(self, record, encoding):
+        return not self.filter._match(record, encoding)
+
+
+class Template(object):
+    """ A parameterized filter string
+
+    Example: ``(&(objectClass=person)(uid={uid}))``. Placeholders are
+    written as ``{name}``. Calling the template with keyword arguments
+    returns a filter object with the escaped values substituted. The
+    template string is split and encoded only once per combination of
+    API and LDAP encoding, the compiled fragments are shared by all
+    `Template` instances with the same template string.
+    """
+
+    def __init__(self, template):
+        self.template = template
+
+    def __call__(self, **values):
+        return BoundTemplate(self, values)
+
+    def compile(self, connection):
+        """ Return the encoded literal fragments and placeholder names
+
+        The result is a sequence alternating literal fragments and
+        placeholder names, starting and ending with a literal fragment.
+        """
+        key = (self.template, connection.api_encoding,
+               connection.ldap_encoding)
+        compiled = template_cache.get(key)
+
+        if compiled is None:
+            encoded = connection._encode_incoming(self.template)
+            if isinstance(encoded, six.text_type):
+                compiled = tuple(PLACEHOLDER_TEXT.split(encoded))
+            else:
+                compiled = tuple(PLACEHOLDER_BYTES.split(encoded))
+                if six.PY3:
+                    compiled = tuple(x if i % 2 == 0 else x.decode('ascii')
+                                     for i, x in enumerate(compiled))
+            template_cache.set(key, compiled)
+
+        return compiled
+
+
+class BoundTemplate(Filter):
+    """ A filter template with values for all its placeholders
+    """
+
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+
+    def _fragments(self, connection):
+        compiled = self.template.compile(connection)
+        fragments = [compiled[0]]
+
+        for i in range(1, len(compiled), 2):
+            name = compiled[i]
+            try:
+                value = self.values[name]
+            except KeyError:
+                raise KeyError('No value for filter placeholder %s' % name)
+            fragments.append(_value(connection, value))
+            fragments.append(compiled[i + 1])
+
+        return fragments
+
+    def _match(self, record, encoding):
+        template = self.template.template
+        if isinstance(template, six.binary_type):
+            template = template.decode(encoding or 'UTF-8')
+        parts = PLACEHOLDER_TEXT.split(template)
+
+        for i in range(1, len(parts), 2):
+            value = self.values[parts[i]]
+            if isinstance(value, six.binary_type):
+                value = value.decode(encoding or 'UTF-8')
+            elif not isinstance(value, six.text_type):
+                value = six.text_type(value)
+            parts[i] = escape_filter_value(value)
+
+        return parse_filter(u''.join(parts))._match(record, encoding)
+
+
+def parse_filter(fltr, encoding='UTF-8'):
+    """ Turn a LDAP filter string into a filter object
+
+    `fltr` may be unicode or encoded in `encoding`. Raises ValueError
+    for malformed filters and for extensible match filters, which cannot
+    be evaluated locally.
+    """
+    if isinstance(fltr, six.binary_type):
+        fltr = fltr.decode(encoding or 'UTF-8')
+    fltr = fltr.strip()
+    if not fltr.startswith(u'('):
+        fltr = u'(%s)' % fltr
+
+    parsed, pos = _parse(fltr, 0, encoding)
+    if pos != len(fltr):
+        raise ValueError('Unexpected characters in filter %s' % fltr)
+
+    return parsed
+
+
+def _parse(fltr, pos, encoding):
+    """ Parse the filter starting at `pos`, return it and the next position
+    """
+    if fltr[pos:pos + 1] != u'(':
+        raise ValueError('Expected "(" at position %i in %s' % (pos, fltr))
+    pos += 1
+    operator = fltr[pos:pos + 1]
+
+    if operator in (u'&', u'|'):
+        pos += 1
+        filters = []
+        while fltr[pos:pos + 1] == u'(':
+            parsed, pos = _parse(fltr, pos, encoding)
+            filters.append(parsed)
+        parsed = (operator == u'&' and And or Or)(*filters)
+    elif operator == u'!':
+        negated, pos = _parse(fltr, pos + 1, encoding)
+        parsed = Not(negated)
+    else:
+        end = fltr.find(u')', pos)
+        if end == -1:
+            end = len(fltr)
+        parsed = _parse_item(fltr[pos:end], encoding)
+        pos = end
+
+    if fltr[pos:pos + 1] != u')':
+        raise ValueError('Expected ")" at position %i in %s' % (pos, fltr))
+
+    return parsed, pos + 1
+
+
+def _parse_item(item, encoding):
+    """ Parse a single comparison like ``cn=foo*``
+    """
+    match = FILTER_ITEM.match(item)
+    if match is None:
+        raise ValueError('Unsupported filter item %s' % item)
+    attr, operator, value = match.groups()
+
+    if operator != u'=':
+        return COMPARISONS[operator](attr, _unescape(value, encoding))
+    elif value == u'*':
+        return Presence(attr)
+    elif u'*' in value:
+        parts = [_unescape(x, encoding) for x in value.split(u'*')]
+        return Substring(attr, initial=parts[0] or None,
+                         any=[x for x in parts[1:-1] if x],
+                         final=parts[-1] or None)
+
+    return Equality(attr, _unescape(value, encoding))
+
+
+def _unescape(value, encoding):
+    """ Replace hex escapes like ``\\2a`` with the characters they encode
+    """
+    encoded = value.encode(encoding or 'UTF-8')
+    encoded = FILTER_ESCAPE.sub(lambda m: binascii.unhexlify(m.group(1)),
+                                encoded)
+    return encoded.decode(encoding or 'UTF-8', 'replace')
+
+
+COMPARISONS = {u'~=': Approximate, u'>=': GreaterOrEqual,
+               u'<=': LessOrEqual}
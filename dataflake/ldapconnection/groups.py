@@ -0,0 +1,296 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Nested group membership expansion
+
+A `GroupExpander` computes the effective (direct and nested) group
+memberships of a record. Group levels are resolved breadth-first, all
+lookups for one level are sent to the server together. The group graph
+discovered along the way is memoized, so expanding many users sharing
+the same groups gets cheaper over time.
+"""
+
+import ldap
+import six
+
+from dataflake.cache.timeout import LockingTimeoutCache
+from dataflake.ldapconnection.filters import And
+from dataflake.ldapconnection.filters import Equality
+from dataflake.ldapconnection.filters import Or
+from dataflake.ldapconnection.filters import Template
+from dataflake.ldapconnection.utils import escape_dn
+
+
+# Active Directory matching rule resolving nested memberships server-side
+IN_CHAIN_RULE = '1.2.840.113556.1.4.1941'
+
+# Active Directory rootDSE capability identifying an AD domain controller
+AD_CAPABILITY = b'1.2.840.113556.1.4.800'
+
+GROUP_CLASSES = ('groupOfNames', 'groupOfUniqueNames', 'group')
+MEMBER_ATTRS = ('member', 'uniqueMember')
+
+# Errors answering the capabilities lookup for good
+CAPABILITIES_UNAVAILABLE = (ldap.NO_SUCH_OBJECT,
+                            ldap.INSUFFICIENT_ACCESS,
+                            ldap.UNWILLING_TO_PERFORM)
+
+
+class GroupExpander(object):
+    """ Resolve nested group memberships for records in a LDAP tree
+
+    - `connection` is the `LDAPConnection` instance to use
+
+    - `base` is the DN of the subtree holding the groups
+
+    - `member_attrs` are the group attributes holding member DNs
+
+    - `group_classes` restricts matches to groups with one of these
+      object classes. An empty sequence disables the restriction.
+
+    - `memberof_attr`, if set, names an attribute maintained by the
+      server on member records, such as ``memberOf``. It is used
+      instead of searching for groups with the member DN.
+
+    - `in_chain` controls use of the Active Directory
+      LDAP_MATCHING_RULE_IN_CHAIN, which resolves the complete nesting
+      with a single search. The default `None` checks the server
+      capabilities on first use.
+
+    Memoized memberships are kept per bind DN, because the records and
+    groups visible to a search depend on the credentials used.
+
+    - `cache_timeout` is the number of seconds the memoized group graph
+      is considered valid.
+    """
+
+    def __init__(self, connection, base, member_attrs=MEMBER_ATTRS,
+                 group_classes=GROUP_CLASSES, memberof_attr=None,
+                 in_chain=None, cache_timeout=300):
+        self.connection = connection
+        self.base = base
+        self.member_attrs = tuple(member_attrs)
+        self.group_classes = tuple(group_classes)
+        self.memberof_attr = memberof_attr
+        self.in_chain = in_chain
+        self.parents = LockingTimeoutCache()
+        self.parents.setTimeout(cache_timeout)
+        self.closures = LockingTimeoutCache()
+        self.closures.setTimeout(cache_timeout)
+        self.in_chain_template = Template(
+            u'(%s:%s:={dn})' % (self.member_attrs[0], IN_CHAIN_RULE))
+
+    def getGroups(self, dn, bind_dn=None, bind_pwd=None):
+        """ Return the DNs of all groups `dn` is a direct or nested member of
+
+        Group DNs are returned in the API encoding, like the `dn` values
+        in search results.
+        """
+        key = self._key(dn)
+        bind_key = self._bindKey(bind_dn)
+        groups = self._memoized(self.closures, key, bind_key)
+
+        if groups is None:
+            if self._use_in_chain(bind_dn, bind_pwd):
+                groups = self._in_chain_groups(dn, bind_dn, bind_pwd)
+            else:
+                groups = self._expand(dn, bind_dn, bind_pwd)
+            self._memoize(self.closures, key, bind_key, groups)
+
+        return set(groups)
+
+    def invalidate(self, dn=None):
+        """ Forget memoized memberships
+
+        Changing a single group can affect the closure of any record, so
+        computed closures are always dropped. The memoized direct
+        memberships are dropped for `dn` only, or all if no DN is given,
+        for all bind DNs.
+        """
+        self.closures.invalidate()
+        if dn is None:
+            self.parents.invalidate()
+        else:
+            self.parents.invalidate(self._key(dn))
+
+    def _expand(self, dn, bind_dn, bind_pwd):
+        """ Breadth-first expansion through the group graph
+        """
+        normalize = self._key
+        seen = set([normalize(dn)])
+        groups = set()
+        frontier = [dn]
+
+        while frontier:
+            parents = self._getParents(frontier, bind_dn, bind_pwd)
+            next_level = []
+
+            for member_dn in frontier:
+                for group_dn in parents.get(normalize(member_dn), ()):
+                    group_key = normalize(group_dn)
+                    if group_key in seen:
+                        # Already expanded, this also breaks cycles
+                        continue
+                    seen.add(group_key)
+                    groups.add(group_dn)
+                    next_level.append(group_dn)
+
+            frontier = next_level
+
+        return frozenset(groups)
+
+    def _getParents(self, dns, bind_dn, bind_pwd):
+        """ Map normalized DNs to the DNs of the groups they are members of
+        """
+        parents = {}
+        missing = []
+        bind_key = self._bindKey(bind_dn)
+
+        for dn in dns:
+            key = self._key(dn)
+            known = self._memoized(self.parents, key, bind_key)
+            if known is None:
+                missing.append(dn)
+            else:
+                parents[key] = known
+
+        if missing:
+            if self.memberof_attr:
+                fetched = self._fetchByMemberOf(missing, bind_dn, bind_pwd)
+            else:
+                fetched = self._fetchByMember(missing, bind_dn, bind_pwd)
+
+            for key, group_dns in fetched.items():
+                self._memoize(self.parents, key, bind_key, group_dns)
+                parents[key] = group_dns
+
+        return parents
+
+    def _fetchByMember(self, dns, bind_dn, bind_pwd):
+        """ Search the groups containing each DN, one level at a time
+
+        One search per DN is needed to know which groups contain which
+        member, but the searches are all sent before waiting for results.
+        """
+        conn = self.connection
+        connection = conn.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
+        base = escape_dn(conn._encode_incoming(self.base), conn.ldap_encoding)
+        operations = []
+
+        for dn in dns:
+            fltr = Or(*[Equality(attr, dn) for attr in self.member_attrs])
+            if self.group_classes:
+                fltr = And(Or(*[Equality('objectClass', x)
+                                for x in self.group_classes]), fltr)
+            operations.append((self._key(dn), connection.search_ext,
+                               (base, ldap.SCOPE_SUBTREE, fltr.encode(conn),
+                                ['1.1'])))
+
+        fetched = {}
+        for key, outcome in conn._pipeline(connection, operations):
+            if isinstance(outcome, ldap.NO_SUCH_OBJECT):
+                fetched[key] = frozenset()
+                continue
+            elif isinstance(outcome, ldap.LDAPError):
+                raise outcome
+
+            records = conn._process_results(outcome[1])['results']
+            fetched[key] = frozenset(x['dn'] for x in records)
+
+        return fetched
+
+    def _fetchByMemberOf(self, dns, bind_dn, bind_pwd):
+        """ Read the membership attribute of all DNs with batched lookups
+        """
+        found = self.connection.lookup_many(dns, attrs=[self.memberof_attr],
+                                            bind_dn=bind_dn,
+                                            bind_pwd=bind_pwd)
+        fetched = {}
+
+        for dn in dns:
+            record = found.get(dn, {})
+            values = ()
+            for key, value in record.items():
+                if key != 'dn' and \
+                   self._attrName(key) == self._attrName(self.memberof_attr):
+                    values = value
+            fetched[self._key(dn)] = frozenset(values)
+
+        return fetched
+
+    def _in_chain_groups(self, dn, bind_dn, bind_pwd):
+        """ Let Active Directory resolve the nested memberships
+        """
+        fltr = self.in_chain_template(dn=dn)
+        res = self.connection.search(self.base, ldap.SCOPE_SUBTREE, fltr,
+                                     attrs=['1.1'], bind_dn=bind_dn,
+                                     bind_pwd=bind_pwd)
+        return frozenset(x['dn'] for x in res['results'])
+
+    def _use_in_chain(self, bind_dn, bind_pwd):
+        """ Find out if the server supports LDAP_MATCHING_RULE_IN_CHAIN
+
+        A rootDSE that is missing or cannot be read counts as no support.
+        Other failures, like an unreachable server, are not remembered:
+        the matching rule is not used this time and the server is asked
+        again on next use.
+        """
+        if self.in_chain is None:
+            try:
+                res = self.connection.search(
+                    '', ldap.SCOPE_BASE, attrs=['supportedCapabilities'],
+                    bind_dn=bind_dn, bind_pwd=bind_pwd, raw=True)
+            except CAPABILITIES_UNAVAILABLE:
+                res = {'results': []}
+            except ldap.LDAPError:
+                return False
+
+            capabilities = []
+            for record in res['results']:
+                for key, value in record.items():
+                    if key != 'dn' and \
+                       self._attrName(key) == 'supportedcapabilities':
+                        capabilities.extend(value)
+            self.in_chain = AD_CAPABILITY in capabilities
+
+        return self.in_chain
+
+    def _attrName(self, key):
+        """ Attribute names in results may be bytes or text
+        """
+        if isinstance(key, six.binary_type):
+            key = key.decode('ascii', 'replace')
+        return key.lower()
+
+    def _key(self, dn):
+        """ Memoization key for a DN in the API encoding
+        """
+        return self.connection._normalize_dn(
+            self.connection._encode_incoming(dn))
+
+    def _bindKey(self, bind_dn):
+        """ Memoization key for the credentials used for lookups
+        """
+        return self.connection._bindCredentials(bind_dn)[0].lower()
+
+    def _memoized(self, memo, key, bind_key):
+        """ Return a value memoized for a DN and bind DN, or None
+        """
+        return (memo.get(key) or {}).get(bind_key)
+
+    def _memoize(self, memo, key, bind_key, value):
+        """ Remember a value for a DN and bind DN
+        """
+        with memo.lock:
+            values = dict(memo.get(key) or {})
+            values[bind_key] = value
+            memo.set(key, values)
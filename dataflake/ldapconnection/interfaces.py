@@ -13,6 +13,7 @@
 """ dataflake.ldapconnnection interfaces
 """
 
+from zope.interface import Attribute
 from zope.interface import Interface
 
 
@@ -22,6 +23,32 @@ class ILDAPConnection(Interface):
     ILDAPConnection instances provide a simplified way to talk to
     a LDAP server. They allow defining one or more server connections
     for automatic failover in case one LDAP server becomes unavailable.
+
+    The `metrics` attribute holds a
+    `dataflake.ldapconnection.metrics.MetricsRegistry` with latency
+    histograms per operation and server, error, bind, connection and
+    cache counters and a few gauges. Setting it to None turns metrics
+    off.
+
+    Setting the `profiler` attribute to an `IProfiler`, like the
+    profilers in `dataflake.ldapconnection.profiling`, profiles a
+    fraction of the operations and aggregates the results per operation
+    type.
+
+    A `dataflake.ldapconnection.retry.RetryPolicy` set as the
+    `retry_policy` attribute retries operations failing with transient
+    errors on another server after a growing delay.
+
+    The `schema` attribute takes a
+    `dataflake.ldapconnection.schema.AttributeSchema`, as returned by
+    `dataflake.ldapconnection.schema.fetch_schema`. All attributes with
+    a binary syntax are then treated as if their names had the
+    ``;binary`` suffix.
+
+    A `dataflake.ldapconnection.cache.BindCache` set as the `bind_cache`
+    attribute lets `authenticate` answer repeated checks of the same
+    password without binding. Password changes, renames and deletions
+    through the connection drop the cached checks.
     """
 
     def addServer(host, port, protocol, conn_timeout=-1, op_timeout=-1):
@@ -55,7 +82,18 @@ class ILDAPConnection(Interface):
         used until it fails or until the Python process is restarted.
         """
 
-    def connect(bind_dn=None, bind_pwd=None):
+    def addObserver(observer):
+        """ Register an `IOperationObserver`
+
+        The observer is notified about all operations, server
+        connections, binds and referrals until it is removed again.
+        """
+
+    def removeObserver(observer):
+        """ Unregister an `IOperationObserver`
+        """
+
+    def connect(bind_dn=None, bind_pwd=None, timeout=None):
         """ Return a working LDAP server connection
 
         If no DN or password for binding to the LDAP server are passed in,
@@ -70,6 +108,9 @@ class ILDAPConnection(Interface):
         connection class. It does not need to be called explicitly, all
         other operations call it implicitly.
 
+        If a `timeout` in seconds is passed in, connecting and binding
+        must be done within that time, otherwise `ldap.TIMEOUT` is raised.
+
         Raises RuntimeError if no server definitions are available.
         If all defined server connections fail the LDAP exception
         thrown by the last attempted connection is re-raised.
@@ -79,9 +120,20 @@ class ILDAPConnection(Interface):
         """ Close the current LDAP server connection
         """
 
+    def authenticate(dn, password, timeout=None):
+        """ Check a password by binding with the given credentials
+
+        Returns True if the bind succeeds and False if the credentials
+        are invalid. Empty passwords are always rejected. Other errors,
+        like an unreachable server, are raised.
+
+        The bind uses a separate server connection that is closed right
+        after, the cached connection is not bound as the user.
+        """
+
     def search(base, scope=2, fltr='(objectClass=*)', attrs=None,
                convert_filter=True, bind_dn=None, bind_pwd=None,
-               raw=False):
+               raw=False, timeout=None):
         """ Perform a LDAP search
 
         The search `base` is the point in the tree to search from. `scope`
@@ -89,7 +141,9 @@ class ILDAPConnection(Interface):
         `pyldap` module (`ldap.SCOPE_BASE`, `ldap.SCOPE_ONELEVEL` or
         `ldap.SCOPE_SUBTREE`). By default, `ldap.SCOPE_SUBTREE` is used.
         What to search for is described by the `filter` argument, which
-        must be a valid LDAP search filter string. If only certain record
+        must be a valid LDAP search filter string or a filter object from
+        `dataflake.ldapconnection.filters`. Filter objects escape all
+        assertion values and ignore `convert_filter`. If only certain record
         attributes should be returned, they can be specified in the `attrs`
         sequence. If `raw` is true, results are returned in the ldap_encoding.
 
@@ -104,12 +158,62 @@ class ILDAPConnection(Interface):
         containing the full distinguished name of the record, and key/values
         representing the records' data as returned by the LDAP server.
 
+        If the `mirror` attribute is set to a
+        `dataflake.ldapconnection.sync.SyncMirror`, searches it can answer
+        are answered from the mirror without contacting the server, unless
+        other credentials are passed in.
+
+        If the `result_cache` attribute is set to a
+        `dataflake.ldapconnection.cache.ResultCache`, search results are
+        cached unless other credentials are passed in. Writes through the
+        connection drop the cached results they affect, a
+        `dataflake.ldapconnection.listener.ChangeListener` does the same
+        for changes made by other clients.
+
+        `timeout` is the number of seconds the operation may take,
+        including connecting and binding. Each step only gets the time
+        that is left. An operation the server has not answered in time
+        is abandoned on the server and `ldap.TIMEOUT` is raised. The
+        `op_timeout` of the server definition still applies if it is
+        shorter.
+
         In order to perform the operation using credentials other than the
         credentials configured on the instance a DN and password may be
         passed in.
         """
 
-    def insert(base, rdn, attrs=None, bind_dn=None, bind_pwd=None):
+    def search_paged(base, scope=2, fltr='(objectClass=*)', attrs=None,
+                     convert_filter=True, bind_dn=None, bind_pwd=None,
+                     raw=False, page_size=None, cookie=None):
+        """ Perform a LDAP search using the Simple Paged Results control
+
+        This is a generator. It yields one mapping per page of at most
+        `page_size` records, with the same keys as the `search` return
+        value and an additional `cookie` key. A search can be resumed
+        after a page by passing that page's cookie back in. The cookie
+        of the last page is empty.
+
+        All other arguments are the same as for `search`.
+        """
+
+    def lookup_many(dns, attrs=None, bind_dn=None, bind_pwd=None,
+                    raw=False, chunk_size=None):
+        """ Fetch the records for a sequence of DNs
+
+        DNs are grouped by their parent and fetched with one-level
+        searches using OR-filters on the RDN values, at most `chunk_size`
+        terms per filter. The searches are sent on a single connection
+        without waiting for each result in turn.
+
+        Returns a mapping of the DNs as passed in to the records found,
+        which have the same format as records in `search` results. DNs
+        that do not exist are missing from the mapping.
+
+        `attrs`, `raw` and the credentials are used as in `search`.
+        """
+
+    def insert(base, rdn, attrs=None, bind_dn=None, bind_pwd=None,
+               timeout=None):
         """ Insert a new record
 
         The record will be inserted at `base` with the new RDN `rdn`.
@@ -119,29 +223,69 @@ class ILDAPConnection(Interface):
         are semicolon-delimited.
         Values can be marked as binary values, meaning they are not encoded
         in the encoding specified as the server encoding before being sent
-        to the LDAP server, by appending ';binary' to the key.
+        to the LDAP server, by appending ';binary' to the key. Binary
+        values are never split at semicolons, unicode values are still
+        encoded.
+
+        `timeout` limits the time the operation may take like for
+        `search`.
 
         In order to perform the operation using credentials other than the
         credentials configured on the instance a DN and password may be
         passed in.
         """
 
-    def delete(dn, bind_dn=None, bind_pwd=None):
+    def insert_many(records, bind_dn=None, bind_pwd=None, window=None):
+        """ Insert many new records
+
+        `records` is an iterable of (base, rdn, attrs) tuples, with the
+        same meaning as the `insert` arguments. It is consumed lazily.
+        Add operations are sent without waiting for earlier ones to
+        finish, up to `window` outstanding operations at a time.
+
+        A failing record does not stop the others. Returns a mapping with
+        the number of records (`size`), `succeeded` and `failed`
+        counts, the elapsed `seconds`, the throughput in records per
+        second (`rate`) and `results`, a list of (dn, exception) tuples
+        in input order where the exception is None for success.
+        """
+
+    def delete(dn, bind_dn=None, bind_pwd=None, timeout=None):
         """ Delete the record specified by the given DN
 
+        `timeout` limits the time the operation may take like for
+        `search`.
+
         In order to perform the operation using credentials other than the
         credentials configured on the instance a DN and password may be
         passed in.
         """
 
-    def modify(dn, mod_type=None, attrs=None, bind_dn=None, bind_pwd=None):
+    def delete_subtree(dn, bind_dn=None, bind_pwd=None, window=None):
+        """ Delete the record specified by the given DN and all its children
+
+        If the server supports the Tree Delete control it is used to
+        delete the whole subtree with a single operation. Otherwise the
+        subtree is enumerated with a paged search and deleted one level at
+        a time starting with the deepest. The delete operations of a
+        level are sent without waiting for earlier ones to finish, up to
+        `window` outstanding operations at a time.
+
+        Returns the same summary mapping as `insert_many`.
+        """
+
+    def modify(dn, mod_type=None, attrs=None, bind_dn=None, bind_pwd=None,
+               cur_rec=None, assertion=None, pre_read=None, post_read=None,
+               timeout=None):
         """ Modify the record specified by the given DN
 
         `mod_type` is one of the LDAP modification types as declared by
         the `pyldap`-module, such as `ldap.MOD_ADD`,
         PUrl(urlscheme=protocol, hostport=hostport)
         provided, the modification type is guessed by comparing the
-        current record with the `attrs` mapping passed in.
+        current record with the `attrs` mapping passed in. In that case
+        only the added and removed values of an attribute are sent, unless
+        a replacement of all values is smaller.
 
         `attrs` is expected to be a key:value mapping where the value may
         be a string or a sequence of strings.
@@ -149,9 +293,126 @@ class ILDAPConnection(Interface):
         are semicolon-delimited.
         Values can be marked as binary values, meaning they are not encoded
         as UTF-8 before sending the to the LDAP server, by appending
-        ';binary' to the key.
+        ';binary' to the key. Binary values are never split at
+        semicolons, unicode values are still encoded.
+
+        The current record is read before the modification to compute the
+        changes and detect renames. This extra search is skipped if the
+        current record is passed in as `cur_rec`, in the format returned
+        by `search` with `raw` set to true, or if `mod_type` is
+        `ldap.MOD_ADD` or `ldap.MOD_REPLACE`.
+
+        `assertion` is a filter string or filter object the record must
+        match for the modification to be applied, otherwise
+        `ldap.ASSERTION_FAILED` is raised (RFC 4528). `pre_read` and
+        `post_read` are sequences of attribute names to return from the
+        record as it was before and after the modification (RFC 4527).
+
+        Returns a mapping with the `pre_read` and `post_read` records,
+        which have the same format as records in `search` results, or
+        None if they were not requested.
+
+        `timeout` limits the time the operation may take like for
+        `search`, including reading the current record.
 
         In order to perform the operation using credentials other than the
         credentials configured on the instance a DN and password may be
         passed in.
         """
+
+    def modify_many(changes, mod_type=None, bind_dn=None, bind_pwd=None,
+                    window=None):
+        """ Modify many records
+
+        `changes` is an iterable of (dn, attrs) tuples, with the same
+        meaning as the `modify` arguments. `mod_type` applies to all
+        changes. The current records are read in batches using
+        `lookup_many` instead of one search per record, and the modify
+        operations are sent without waiting for earlier ones to finish,
+        up to `window` outstanding operations at a time. Records that
+        need to be renamed are renamed before their other changes are
+        sent.
+
+        A failing record does not stop the others. Returns the same
+        summary mapping as `insert_many`, with a NO_SUCH_OBJECT exception
+        for records that do not exist.
+        """
+
+
+class IFilter(Interface):
+    """ A LDAP search filter expression
+
+    Filters are built with the classes in `dataflake.ldapconnection.filters`
+    or parsed from strings with its `parse_filter`, and can be passed to
+    `ILDAPConnection.search` instead of a filter string.
+    """
+
+    def encode(connection):
+        """ Return the filter string in the connection's LDAP encoding
+
+        All assertion values are escaped.
+        """
+
+    def match(record, encoding='UTF-8'):
+        """ Find out if a record matches the filter
+
+        `record` is a mapping of attribute names to value lists as found
+        in search results, and `encoding` is the encoding of encoded
+        values in the record and the filter.
+        """
+
+
+class IOperationObserver(Interface):
+    """ Receives notifications about connection operations
+
+    Both methods are passed a
+    `dataflake.ldapconnection.observers.OperationEvent`. Exceptions
+    raised by observers are logged and do not affect the operation.
+    """
+
+    def started(event):
+        """ Called before an operation starts
+        """
+
+    def finished(event):
+        """ Called after an operation finished or failed
+
+        The event now carries the duration, the result size and the
+        exception raised, if any.
+        """
+
+
+class IProfiler(Interface):
+    """ Profiles a fraction of the operations of a connection
+
+    Profilers are set as the `profiler` attribute of an
+    `ILDAPConnection`. Results are aggregated per operation type.
+    """
+
+    calls = Attribute('Mapping of operation types to the number of calls')
+
+    profiled = Attribute('Mapping of operation types to the number of '
+                         'profiled calls')
+
+    def run(operation, func, *args, **kw):
+        """ Call `func` with the given arguments and return its result
+
+        `operation` is the name of the operation type. The profiler
+        decides whether the call is profiled.
+        """
+
+    def reset():
+        """ Forget all profiling results
+        """
+
+    def report(out=None):
+        """ Write a summary of the results of each operation type
+
+        The summary is written to `out`, or standard output if not given.
+        """
+
+    def dump(path):
+        """ Save the results in a format profile viewers can read
+
+        Returns the path or paths written.
+        """
@@ -0,0 +1,204 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Streaming export and import of directory data
+
+Records are written as soon as each page of a paged search arrives, so
+memory usage only depends on the page size and not on the number of
+exported records. Imports read records while earlier records are still
+being added.
+"""
+
+from base64 import b64encode
+import json
+import threading
+
+import ldap
+import ldif
+import six
+from six.moves import queue
+
+from dataflake.ldapconnection.utils import escape_dn
+
+
+_done = object()
+
+
+def _native(value, encoding):
+    """ Turn bytes into the native string type
+    """
+    if six.PY3 and isinstance(value, six.binary_type):
+        return value.decode(encoding or 'UTF-8')
+    return value
+
+
+class LDIFFormatter(object):
+    """ Write records in LDIF format, see RFC 2849
+    """
+
+    def __init__(self, out, encoding):
+        self.writer = ldif.LDIFWriter(out)
+        self.encoding = encoding
+
+    def write(self, dn, record):
+        entry = {}
+        for key, values in record.items():
+            entry[_native(key, 'ascii')] = values
+        self.writer.unparse(_native(dn, self.encoding), entry)
+
+
+class JSONLinesFormatter(object):
+    """ Write one JSON object per line
+
+    Each object has a ``dn`` and an ``attributes`` mapping of attribute
+    names to lists of string values. Values that cannot be decoded are
+    base64-encoded and stored under the attribute name with ``;binary``
+    appended, matching the binary value marker used by `insert`.
+    """
+
+    def __init__(self, out, encoding):
+        self.out = out
+        self.encoding = encoding or 'UTF-8'
+
+    def write(self, dn, record):
+        attributes = {}
+        for key, values in record.items():
+            key = _native(key, 'ascii')
+            for value in values:
+                if isinstance(value, six.binary_type):
+                    try:
+                        value = value.decode(self.encoding)
+                    except UnicodeDecodeError:
+                        value = b64encode(value).decode('ascii')
+                        attributes.setdefault('%s;binary' % key,
+                                              []).append(value)
+                        continue
+                attributes.setdefault(key, []).append(value)
+
+        if isinstance(dn, six.binary_type):
+            dn = dn.decode(self.encoding)
+        line = json.dumps({'dn': dn, 'attributes': attributes},
+                          sort_keys=True)
+        self.out.write(six.text_type(line) + u'\n')
+
+
+FORMATTERS = {'ldif': LDIFFormatter, 'jsonl': JSONLinesFormatter}
+
+
+def export(connection, base, out, scope=ldap.SCOPE_SUBTREE,
+           fltr='(objectClass=*)', attrs=None, format='ldif',
+           page_size=None, cookie=None, checkpoint=None, bind_dn=None,
+           bind_pwd=None):
+    """ Write all records found by a paged search to a text file object
+
+    - `format` is ``ldif`` or ``jsonl`` (JSON Lines)
+
+    - `checkpoint`, if given, is called with the paging cookie after
+      each page has been written. An interrupted export can be resumed
+      by passing the last cookie back in as `cookie`. Servers usually
+      only accept cookies on the connection they were handed out on.
+
+    Returns a mapping with the number of exported records under
+    ``size`` and the last cookie under ``cookie``, which is empty once
+    the search is exhausted.
+    """
+    formatter = FORMATTERS[format](out, connection.ldap_encoding)
+    result = {'size': 0, 'cookie': cookie or ''}
+
+    for page in connection.search_paged(base, scope=scope, fltr=fltr,
+                                        attrs=attrs, bind_dn=bind_dn,
+                                        bind_pwd=bind_pwd, raw=True,
+                                        page_size=page_size, cookie=cookie):
+        for record in page['results']:
+            dn = record.pop('dn')
+            formatter.write(dn, record)
+            result['size'] += 1
+
+        result['cookie'] = page['cookie']
+        if checkpoint is not None:
+            checkpoint(page['cookie'])
+
+    return result
+
+
+class _QueueingParser(ldif.LDIFParser):
+    """ LDIF parser handing parsed records to a bounded queue
+
+    The parser runs in its own thread, the bounded queue makes it wait
+    while the consumer is busy so only a few records are held in memory.
+    """
+
+    def __init__(self, infile, records):
+        ldif.LDIFParser.__init__(self, infile)
+        self.records = records
+        self.stopped = False
+
+    def handle(self, dn, entry):
+        self._put((dn, entry))
+
+    def run(self):
+        try:
+            self.parse()
+        except Exception as exc:
+            self._put(exc)
+        else:
+            self._put(_done)
+
+    def _put(self, item):
+        while not self.stopped:
+            try:
+                self.records.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+def import_ldif(connection, infile, bind_dn=None, bind_pwd=None,
+                window=None):
+    """ Add all records from a LDIF file using pipelined add operations
+
+    `infile` is a text file object with LDIF content records, for
+    example created by `export`. Failing records do not stop the
+    import. The return value is the same summary mapping returned by
+    the connection's `insert_many` method.
+    """
+    connection._complainIfReadOnly()
+    window = window or connection.pipeline_window
+    records = queue.Queue(maxsize=window * 2)
+    parser = _QueueingParser(infile, records)
+    thread = threading.Thread(target=parser.run)
+    thread.daemon = True
+    thread.start()
+
+    def entries():
+        try:
+            while True:
+                item = records.get()
+                if item is _done:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+
+                dn, entry = item
+                if isinstance(dn, six.binary_type):
+                    # LDIF files are always UTF-8-encoded
+                    dn = dn.decode('UTF-8')
+                dn = escape_dn(connection._encode_incoming(dn),
+                               connection.ldap_encoding)
+                attribute_list = [(connection._encode_incoming(key), values)
+                                  for key, values in entry.items()]
+                yield dn, attribute_list
+        finally:
+            parser.stopped = True
+
+    return connection._add_many(entries(), bind_dn=bind_dn,
+                                bind_pwd=bind_pwd, window=window)
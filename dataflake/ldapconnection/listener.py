@@ -0,0 +1,207 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Change notifications from the LDAP server
+
+A `ChangeListener` keeps a search open on the server that returns records
+as they are changed, using either the Persistent Search control
+(draft-ietf-ldapext-psearch) or the Active Directory change notification
+control. Every change drops the affected results from the connection's
+`result_cache`.
+
+Servers offering the Content Synchronization Operation (RFC 4533) are
+better served by a `dataflake.ldapconnection.sync.SyncMirror`, which can
+feed the result cache as well::
+
+  mirror.subscribe(lambda change, dn, record:
+                   cache.invalidate_dn(dn, encoding=conn.ldap_encoding))
+"""
+
+import threading
+
+import ldap
+from ldap.controls import LDAPControl
+from ldap.controls.psearch import CHANGE_TYPES_INT
+from ldap.controls.psearch import EntryChangeNotificationControl
+from ldap.controls.psearch import PersistentSearchControl
+import six
+
+from dataflake.ldapconnection.utils import escape_dn
+
+
+PERSISTENT_SEARCH_CONTROL = PersistentSearchControl.controlType
+AD_NOTIFICATION_CONTROL = '1.2.840.113556.1.4.528'
+
+
+class ChangeListener(object):
+    """ Invalidate cached search results on server change notifications
+
+    - `connection` is the `LDAPConnection` providing the server
+      definitions, the credentials and the `result_cache`. The listener
+      uses a separate server connection of its own.
+
+    - `base` and `scope` describe the part of the tree to watch
+
+    - `method` is ``psearch`` for the Persistent Search control or
+      ``ad`` for Active Directory change notifications. By default the
+      method is picked from the controls the server supports.
+
+    - `retry_delay` is the number of seconds to wait before listening
+      again after the connection was lost
+
+    Active Directory notifications do not say how a record changed, a
+    renamed record only invalidates results at its new DN. Results
+    containing the old DN expire after the cache timeout.
+    """
+
+    def __init__(self, connection, base, scope=ldap.SCOPE_SUBTREE,
+                 method=None, retry_delay=30, bind_dn=None, bind_pwd=None):
+        self.connection = connection
+        self.base = escape_dn(connection._encode_incoming(base),
+                              connection.ldap_encoding)
+        self.scope = scope
+        self.method = method
+        self.retry_delay = retry_delay
+        self.bind_dn = bind_dn
+        self.bind_pwd = bind_pwd
+        self.callbacks = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        """ Register a callable notified about each change
+
+        It is called with the DN of the changed record in the
+        ldap_encoding, or with None if anything may have changed, for
+        example while the listener was not connected.
+        """
+        self.callbacks.append(callback)
+
+    def start(self):
+        """ Listen for changes in a background thread
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _detect(self):
+        """ Find the notification method supported by the server
+        """
+        if self.method is not None:
+            return self.method
+
+        supported = self.connection._supportedControls(self.bind_dn,
+                                                       self.bind_pwd)
+        if PERSISTENT_SEARCH_CONTROL.encode('ascii') in supported:
+            return 'psearch'
+        elif AD_NOTIFICATION_CONTROL.encode('ascii') in supported:
+            return 'ad'
+
+        return None
+
+    def _run(self):
+        logger = self.connection.logger()
+
+        while not self._stopped.is_set():
+            try:
+                method = self._detect()
+                if method is None:
+                    logger.warning('Server offers no change notifications')
+                else:
+                    conn = self.connection._newConnection(self.bind_dn,
+                                                          self.bind_pwd)
+                    try:
+                        self._listen(conn, method)
+                    finally:
+                        try:
+                            conn.unbind_s()
+                        except ldap.LDAPError:
+                            pass
+            except ldap.LDAPError as e:
+                logger.warning('Change listener failed: %s' % str(e))
+
+            # Changes may be missed until listening again
+            self._changed(None)
+            self._stopped.wait(self.retry_delay)
+
+    def _listen(self, conn, method):
+        """ Keep a notification search open until stopped
+        """
+        if method == 'psearch':
+            control = PersistentSearchControl(criticality=True,
+                                              changesOnly=True,
+                                              returnECs=True)
+        else:
+            control = LDAPControl(AD_NOTIFICATION_CONTROL, True)
+
+        fltr = self.connection._encode_incoming('(objectClass=*)')
+        msgid = conn.search_ext(self.base, self.scope, fltr, ['1.1'],
+                                serverctrls=[control])
+
+        # Anything changed before the search started went unnoticed
+        self._changed(None)
+
+        while not self._stopped.is_set():
+            try:
+                res_type, data, res_msgid, ctrls, _, _ = conn.result4(
+                                msgid, all=0, timeout=1, add_ctrls=1)
+            except ldap.TIMEOUT:
+                continue
+
+            if res_type is None:
+                continue
+            elif res_type == ldap.RES_SEARCH_RESULT:
+                break
+
+            for dn, attrs, entry_ctrls in data:
+                self._entryChanged(dn, entry_ctrls)
+
+    def _entryChanged(self, dn, ctrls):
+        """ Handle one change notification
+        """
+        for ctrl in ctrls or ():
+            if isinstance(ctrl, EntryChangeNotificationControl) and \
+               ctrl.changeType == CHANGE_TYPES_INT['modDN']:
+                # Records below a renamed record have new DNs, too
+                if ctrl.previousDN:
+                    self._changed(ctrl.previousDN, subtree=True)
+                self._changed(dn, subtree=True)
+                return
+
+        self._changed(dn)
+
+    def _changed(self, dn, subtree=False):
+        """ Drop affected cached results and notify the subscribers
+        """
+        if dn is not None and not isinstance(dn, six.binary_type):
+            dn = dn.encode(self.connection.ldap_encoding or 'UTF-8')
+
+        self.connection._invalidate(dn, subtree=subtree)
+
+        for callback in self.callbacks:
+            try:
+                callback(dn)
+            except Exception:
+                self.connection.logger().exception(
+                    'Change listener callback failed')
@@ -0,0 +1,304 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Operation metrics
+
+Every `LDAPConnection` records latency histograms, error and bind
+counters and a few gauges in its `metrics` registry. A registry can be
+read as a plain mapping with `snapshot` or in the Prometheus text
+exposition format with `prometheus`.
+
+Metrics are process-local, they are not kept when a connection object
+is pickled.
+"""
+
+from bisect import bisect_left
+import functools
+import inspect
+import threading
+import time
+
+import six
+
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'operation_seconds': 'Duration of LDAP operations by server',
+    'errors_total': 'Failed LDAP operations by exception class',
+    'binds_total': 'Bind operations by outcome',
+    'connects_total': 'Server connection attempts by outcome',
+    'abandons_total': 'Operations abandoned after their deadline passed',
+    'retries_total': 'Operations retried by operation and error',
+    'cache_requests_total': 'Searches answered from a local cache',
+    'connections_open': 'Open cached server connections',
+    'servers': 'Configured server definitions',
+    'result_cache_entries': 'Searches held in the result cache',
+    'mirror_entries': 'Records held in the syncrepl mirror',
+}
+
+
+class Histogram(object):
+    """ Count observations in buckets with fixed upper bounds
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ Return (upper bound, count) tuples including +Inf
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),),
+                                self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry(object):
+    """ Thread-safe store for counters, gauges and histograms
+
+    Each metric is identified by its name and a set of labels passed as
+    keyword arguments.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def __getstate__(self):
+        return {'buckets': self.buckets}
+
+    def __setstate__(self, state):
+        self.__init__(state['buckets'])
+
+    def increment(self, name, amount=1, **labels):
+        """ Add `amount` to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        """ Set a gauge to the current value
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """ Add an observation to a histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def clear(self):
+        """ Forget all recorded values
+        """
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """ Return all metrics as a mapping of plain Python objects
+
+        The mapping has ``counters``, ``gauges`` and ``histograms`` keys,
+        each mapping metric names to lists of series. A series is a
+        mapping with the ``labels`` and either the ``value`` or the
+        ``count``, ``sum`` and cumulative ``buckets`` of a histogram.
+        """
+        result = {'counters': {}, 'gauges': {}, 'histograms': {}}
+        with self.lock:
+            for kind in ('counters', 'gauges'):
+                for (name, labels), value in getattr(self, kind).items():
+                    result[kind].setdefault(name, []).append(
+                        {'labels': dict(labels), 'value': value})
+
+            for (name, labels), histogram in self.histograms.items():
+                result['histograms'].setdefault(name, []).append(
+                    {'labels': dict(labels), 'count': histogram.count,
+                     'sum': histogram.sum,
+                     'buckets': histogram.cumulative()})
+
+        for kind in result.values():
+            for series in kind.values():
+                series.sort(key=lambda x: sorted(x['labels'].items()))
+        return result
+
+    def prometheus(self, prefix='dataflake_ldap_'):
+        """ Return all metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        for kind, metric_type in (('counters', 'counter'),
+                                  ('gauges', 'gauge')):
+            for name in sorted(snapshot[kind]):
+                _header(lines, prefix + name, metric_type, name)
+                for series in snapshot[kind][name]:
+                    lines.append('%s%s %s' % (prefix + name,
+                                              _labels(series['labels']),
+                                              _number(series['value'])))
+
+        for name in sorted(snapshot['histograms']):
+            full_name = prefix + name
+            _header(lines, full_name, 'histogram', name)
+            for series in snapshot['histograms'][name]:
+                labels = series['labels']
+                for bound, count in series['buckets']:
+                    bucket_labels = dict(labels, le=_number(bound))
+                    lines.append('%s_bucket%s %s' % (
+                        full_name, _labels(bucket_labels), count))
+                lines.append('%s_sum%s %s' % (full_name, _labels(labels),
+                                              _number(series['sum'])))
+                lines.append('%s_count%s %s' % (full_name, _labels(labels),
+                                                series['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _header(lines, full_name, metric_type, name):
+    if name in HELP:
+        lines.append('# HELP %s %s' % (full_name, HELP[name]))
+    lines.append('# TYPE %s %s' % (full_name, metric_type))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value))
+                             for key, value in sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def instrumented(operation):
+    """ Decorator recording duration and errors of a connection method
+
+    Registered observers are notified about the call as well. The
+    search arguments for their events are picked from the method's
+    arguments by name. A profiler set on the connection decides
+    whether to profile the call, a retry policy retries failed calls.
+    Each attempt is measured and profiled on its own.
+    """
+    def decorator(method):
+        names = _argNames(method)
+        timeout_index = 'timeout' in names and names.index('timeout')
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kw):
+            if self.retry_policy is not None:
+                if timeout_index is not False and len(args) > timeout_index:
+                    # The policy finds and adjusts the timeout by name
+                    kw = dict(kw, **dict(zip(names[timeout_index:],
+                                             args[timeout_index:])))
+                    args = args[:timeout_index]
+                return self.retry_policy.call(self, operation, profiled,
+                                              args, kw)
+            return profiled(self, *args, **kw)
+
+        def profiled(self, *args, **kw):
+            if self.profiler is not None:
+                return self.profiler.run(operation, measured,
+                                         self, *args, **kw)
+            return measured(self, *args, **kw)
+
+        def measured(self, *args, **kw):
+            metrics = self.metrics
+            if metrics is None and not self.observers:
+                return method(self, *args, **kw)
+
+            event = None
+            if self.observers:
+                arguments = dict(zip(names, args))
+                arguments.update(kw)
+                event = self._startEvent(
+                            operation,
+                            base=_eventBase(arguments),
+                            scope=arguments.get('scope'),
+                            fltr=arguments.get('fltr'),
+                            attrs=arguments.get('attrs'))
+
+            started = time.time()
+            result = exception = None
+            try:
+                result = method(self, *args, **kw)
+                return result
+            except Exception as e:
+                exception = e
+                if metrics is not None:
+                    metrics.increment('errors_total', operation=operation,
+                                      error=e.__class__.__name__)
+                raise
+            finally:
+                server = self._serverUrl()
+                if metrics is not None:
+                    metrics.observe('operation_seconds',
+                                    time.time() - started,
+                                    operation=operation, server=server or '')
+                    self._updateGauges(metrics)
+                if event is not None:
+                    event.server = server
+                    self._finishEvent(event, result, exception)
+
+        return wrapper
+
+    return decorator
+
+
+def _eventBase(arguments):
+    """ The search base or DN operated on, given the method arguments
+    """
+    base = arguments.get('base', arguments.get('dn'))
+    rdn = arguments.get('rdn')
+    if rdn is None or type(rdn) is not type(base):
+        return base
+    if isinstance(rdn, six.binary_type):
+        return rdn + b',' + base
+    return rdn + u',' + base
+
+
+def _argNames(method):
+    """ Names of the positional arguments of a method, without `self`
+    """
+    if six.PY2:
+        return inspect.getargspec(method).args[1:]
+    return inspect.getfullargspec(method).args[1:]
@@ -0,0 +1,221 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Operation observers
+
+Objects providing `IOperationObserver` can be registered on a connection
+with `addObserver`. They are told about every operation, server
+connection, bind and referral before it starts and after it finished,
+for example to create tracing spans. Without registered observers no
+events are created at all.
+"""
+
+from collections import deque
+import logging
+import threading
+import time
+
+import six
+from zope.interface import implementer
+
+from dataflake.ldapconnection.interfaces import IOperationObserver
+
+
+default_logger = logging.getLogger('dataflake.ldapconnection')
+
+# Stack of the events for the operations running in each thread
+_running = threading.local()
+
+
+class OperationEvent(object):
+    """ Information about a single operation handed to observers
+
+    - `operation` is the operation name, like ``search`` or ``bind``
+
+    - `server` is the URL of the server used, if known
+
+    - `base` is the search base or the DN operated on, `scope`,
+      `fltr` and `attrs` are the search arguments if any
+
+    - `started` is the start time, `duration` the elapsed seconds
+
+    - `size` is the number of records returned or processed
+
+    - `exception` is the exception raised by the operation, if any
+
+    - `phases` maps the names of the steps of an operation, like
+      ``connect``, ``bind``, ``network`` or ``decode``, to the seconds
+      spent on them
+
+    - `parent` is the event of the operation this operation is part
+      of, if any
+
+    - `annotations` is a mapping observers can keep their own data in
+      between the start and the end of the operation
+    """
+
+    def __init__(self, operation, server=None, base=None, scope=None,
+                 fltr=None, attrs=None):
+        self.operation = operation
+        self.server = server
+        self.base = base
+        self.scope = scope
+        self.fltr = fltr
+        self.attrs = attrs
+        self.started = time.time()
+        self.duration = None
+        self.size = None
+        self.exception = None
+        self.phases = {}
+        self.parent = None
+        self.annotations = {}
+
+    def addPhase(self, name, seconds):
+        """ Add time spent on a step of the operation
+        """
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self, result=None, exception=None):
+        """ Record the outcome of the operation
+        """
+        self.duration = time.time() - self.started
+        self.exception = exception
+        if isinstance(result, dict) and 'size' in result:
+            self.size = result['size']
+
+
+def current_event():
+    """ Return the event of the innermost operation in this thread
+    """
+    stack = getattr(_running, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def _push(event):
+    stack = getattr(_running, 'stack', None)
+    if stack is None:
+        stack = _running.stack = []
+    if stack:
+        event.parent = stack[-1]
+    stack.append(event)
+
+
+def _pop(event):
+    stack = getattr(_running, 'stack', None)
+    if stack and stack[-1] is event:
+        stack.pop()
+    if event.parent is not None:
+        # Connecting and binding are steps of the enclosing operation
+        event.parent.addPhase(event.operation, event.duration)
+
+
+@implementer(IOperationObserver)
+class SlowOperationLog(object):
+    """ Log operations taking longer than a threshold
+
+    Each log message shows the time spent connecting, binding, waiting
+    for the server and decoding results, and the number of records.
+    The most recent slow operations are also kept in the `entries`
+    sequence as mappings.
+
+    - `threshold` is the duration in seconds from which on operations
+      are logged
+
+    - `size` is the number of slow operations kept in `entries`
+    """
+
+    def __init__(self, threshold=1.0, logger=None, level=logging.WARNING,
+                 size=100):
+        self.threshold = threshold
+        self.logger = logger or default_logger
+        self.level = level
+        self.entries = deque(maxlen=size)
+
+    def started(self, event):
+        pass
+
+    def finished(self, event):
+        if event.parent is not None or event.duration < self.threshold:
+            return
+
+        entry = {'operation': event.operation, 'server': event.server,
+                 'base': event.base, 'fltr': event.fltr,
+                 'duration': event.duration, 'size': event.size,
+                 'phases': dict(event.phases),
+                 'exception': event.exception}
+        self.entries.append(entry)
+
+        details = ['base %s' % _text(event.base)]
+        if event.fltr is not None:
+            details.append('filter %s' % _text(event.fltr))
+        if event.size is not None:
+            details.append('%i records' % event.size)
+        if event.exception is not None:
+            details.append('failed: %s' % event.exception.__class__.__name__)
+        phases = ', '.join('%s %.3fs' % (name, seconds)
+                           for name, seconds in sorted(event.phases.items()))
+        self.logger.log(self.level, 'Slow LDAP %s (%.3fs) on %s, %s%s' % (
+                            event.operation, event.duration, event.server,
+                            ', '.join(details),
+                            phases and ' (%s)' % phases or ''))
+
+
+@implementer(IOperationObserver)
+class OpenTelemetryObserver(object):
+    """ Report each operation as an OpenTelemetry span
+
+    Needs the ``opentelemetry-api`` package. Spans are created as
+    children of the current span and become the current span while the
+    operation runs, so nested operations show up as their children.
+    """
+
+    def __init__(self, tracer=None):
+        from opentelemetry import context
+        from opentelemetry import trace
+        self.context = context
+        self.trace = trace
+        self.tracer = tracer or trace.get_tracer('dataflake.ldapconnection')
+
+    def started(self, event):
+        attributes = {'db.system': 'ldap',
+                      'db.operation': event.operation}
+        if event.server:
+            attributes['server.address'] = event.server
+        if event.base is not None:
+            attributes['ldap.base'] = _text(event.base)
+        if event.fltr is not None:
+            attributes['ldap.filter'] = _text(event.fltr)
+
+        span = self.tracer.start_span('ldap.%s' % event.operation,
+                                      attributes=attributes)
+        token = self.context.attach(self.trace.set_span_in_context(span))
+        event.annotations[self] = (span, token)
+
+    def finished(self, event):
+        span, token = event.annotations.pop(self)
+        self.context.detach(token)
+
+        if event.server:
+            span.set_attribute('server.address', event.server)
+        if event.size is not None:
+            span.set_attribute('ldap.result_size', event.size)
+        if event.exception is not None:
+            span.record_exception(event.exception)
+            span.set_status(self.trace.Status(self.trace.StatusCode.ERROR,
+                                              str(event.exception)))
+        span.end()
+
+
+def _text(value):
+    if isinstance(value, six.binary_type):
+        return value.decode('UTF-8', 'replace')
+    return six.text_type(value)
@@ -0,0 +1,310 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Profiling of connection operations
+
+A profiler set as the `profiler` attribute of a `LDAPConnection`
+profiles a random fraction of its operations and aggregates the
+results per operation type, which shows where client-side CPU time
+goes under real traffic without profiling the whole process:
+
+    connection.profiler = CProfileProfiler(rate=0.01)
+    ...
+    connection.profiler.report()
+    connection.profiler.dump('/tmp/profiles')
+
+`CProfileProfiler` records every function call of the profiled
+operations. `SamplingProfiler` looks at the stack of the threads
+running a profiled operation at a fixed interval instead, which costs
+much less and can profile all operations.
+"""
+
+import cProfile
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+from zope.interface import implementer
+
+from dataflake.ldapconnection.interfaces import IProfiler
+
+
+# cProfile cannot run more than one profiler at the same time on
+# Python 3.12 and later, where it also profiles all threads
+_cprofile_lock = threading.Lock()
+
+
+class _Profiler(object):
+    """ Base class choosing the operations to profile
+
+    Subclasses provide `_profile`, which runs a chosen operation, and
+    `_reset`, which drops their results.
+    """
+
+    def __init__(self, rate=0.01, seed=None):
+        self.rate = rate
+        self.calls = {}
+        self.profiled = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._running = threading.local()
+
+    def run(self, operation, func, *args, **kw):
+        """ Call `func`, profiling the call if it is chosen
+
+        Operations run by another operation, like the searches of
+        `modify_many`, are part of the enclosing operation's profile.
+        """
+        if getattr(self._running, 'active', False):
+            return func(*args, **kw)
+
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            sampled = self._random.random() < self.rate
+        if not sampled:
+            return func(*args, **kw)
+
+        self._running.active = True
+        try:
+            return self._profile(operation, func, args, kw)
+        finally:
+            self._running.active = False
+
+    def _count(self, operation):
+        self.profiled[operation] = self.profiled.get(operation, 0) + 1
+
+    def _header(self, operation):
+        return '%s: %i of %i calls profiled' % (
+            operation, self.profiled.get(operation, 0),
+            self.calls.get(operation, 0))
+
+    def reset(self):
+        """ Forget all profiling results
+        """
+        with self._lock:
+            self.calls = {}
+            self.profiled = {}
+            self._reset()
+
+
+@implementer(IProfiler)
+class CProfileProfiler(_Profiler):
+    """ Profile a fraction of the operations with cProfile
+
+    Profiled operations run one at a time. An operation chosen while
+    another one is being profiled, possibly by another profiler, runs
+    without profiling.
+    """
+
+    def __init__(self, rate=0.01, seed=None):
+        super(CProfileProfiler, self).__init__(rate, seed)
+        self.stats = {}
+
+    def _profile(self, operation, func, args, kw):
+        if not _cprofile_lock.acquire(False):
+            return func(*args, **kw)
+
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiling tool is active
+                return func(*args, **kw)
+            try:
+                return func(*args, **kw)
+            finally:
+                profile.disable()
+                self._add(operation, profile)
+        finally:
+            _cprofile_lock.release()
+
+    def _add(self, operation, profile):
+        with self._lock:
+            stats = self.stats.get(operation)
+            if stats is None:
+                self.stats[operation] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self._count(operation)
+
+    def _reset(self):
+        self.stats = {}
+
+    def report(self, out=None, sort='cumulative', limit=20):
+        """ Write the statistics of each operation type to `out`
+
+        `sort` and `limit` are passed to `pstats.Stats.sort_stats` and
+        `print_stats`.
+        """
+        out = sys.stdout if out is None else out
+        with self._lock:
+            for operation in sorted(self.stats):
+                out.write('%s\n' % self._header(operation))
+                stats = self.stats[operation]
+                stats.stream = out
+                stats.sort_stats(sort).print_stats(limit)
+
+    def dump(self, directory):
+        """ Save the statistics as ``<operation>.prof`` files
+
+        The files can be read with `pstats` and most profile viewers.
+        Returns the paths written.
+        """
+        paths = []
+        with self._lock:
+            for operation in sorted(self.stats):
+                path = os.path.join(directory, '%s.prof' % operation)
+                self.stats[operation].dump_stats(path)
+                paths.append(path)
+        return paths
+
+
+@implementer(IProfiler)
+class SamplingProfiler(_Profiler):
+    """ Sample the call stacks of the profiled operations
+
+    A background thread records the stack of each thread running a
+    profiled operation every `interval` seconds. Samples are counted
+    per operation type and distinct stack.
+    """
+
+    def __init__(self, rate=1.0, interval=0.005, seed=None):
+        super(SamplingProfiler, self).__init__(rate, seed)
+        self.interval = interval
+        self.stacks = {}
+        self._active = {}
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = None
+
+    def _profile(self, operation, func, args, kw):
+        ident = threading.current_thread().ident
+        with self._lock:
+            self._count(operation)
+            self._active[ident] = (operation, sys._getframe())
+            self._wakeup.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample,
+                                                name='LDAP profiler')
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            return func(*args, **kw)
+        finally:
+            with self._lock:
+                del self._active[ident]
+
+    def _sample(self):
+        """ Sampling loop of the background thread
+        """
+        while True:
+            with self._lock:
+                while not self._active and not self._closed:
+                    self._wakeup.wait()
+                if self._closed:
+                    return
+            time.sleep(self.interval)
+            with self._lock:
+                frames = sys._current_frames()
+                for ident, (operation, stop) in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self._record(operation, frame, stop)
+                del frames
+
+    def _record(self, operation, frame, stop):
+        stack = []
+        while frame is not None and frame is not stop:
+            stack.append(_label(frame.f_code))
+            frame = frame.f_back
+        if not stack:
+            # The operation has not started or already finished
+            return
+        stack.reverse()
+        counts = self.stacks.setdefault(operation, {})
+        key = tuple(stack)
+        counts[key] = counts.get(key, 0) + 1
+
+    def _reset(self):
+        self.stacks = {}
+
+    def close(self):
+        """ Stop the sampling thread
+        """
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def functions(self, operation):
+        """ Sample counts per function for an operation type
+
+        Returns a list of ``(function, own samples, total samples)``
+        tuples, the function with the most own samples first. Own
+        samples were taken while the function itself was running, the
+        total includes the functions it called.
+        """
+        own = {}
+        total = {}
+        with self._lock:
+            stacks = list(self.stacks.get(operation, {}).items())
+        for stack, count in stacks:
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for function in set(stack):
+                total[function] = total.get(function, 0) + count
+        return sorted(((x, own.get(x, 0), total[x]) for x in total),
+                      key=lambda x: (-x[1], -x[2], x[0]))
+
+    def report(self, out=None, limit=20):
+        """ Write the most frequently sampled functions of each operation
+        """
+        out = sys.stdout if out is None else out
+        with self._lock:
+            operations = sorted(self.stacks)
+        for operation in operations:
+            functions = self.functions(operation)
+            samples = sum(x[1] for x in functions)
+            out.write('%s, %i samples\n' % (self._header(operation), samples))
+            out.write('%8s %8s  %s\n' % ('own %', 'total %', 'function'))
+            for function, own, total in functions[:limit]:
+                out.write('%8.1f %8.1f  %s\n' % (
+                    100.0 * own / samples, 100.0 * total / samples, function))
+            out.write('\n')
+
+    def dump(self, path):
+        """ Save the samples in the folded stack format of flame graphs
+
+        Each line holds the operation and the stack frames separated by
+        semicolons, followed by the number of samples.
+        """
+        with self._lock:
+            lines = ['%s %i\n' % (';'.join((operation,) + stack), count)
+                     for operation in sorted(self.stacks)
+                     for stack, count in sorted(
+                         self.stacks[operation].items())]
+        with open(path, 'w') as fp:
+            fp.writelines(lines)
+        return path
+
+
+def _label(code):
+    """ A readable name for the function of a code object
+    """
+    return '%s (%s:%i)' % (code.co_name.replace(';', ':'),
+                           os.path.basename(code.co_filename),
+                           code.co_firstlineno)
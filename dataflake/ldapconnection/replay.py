@@ -0,0 +1,426 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Recording and replaying connection traffic
+
+A `TraceRecorder` registered as observer on a connection writes each
+operation with its timing to a trace file, one JSON object per line.
+DN, filter and attribute values are replaced by salted hashes, so equal
+values still look equal in the trace.
+
+`replay` sends the operations of a trace to a connection again, from
+several threads and at a multiple of the recorded speed, and reports
+the throughput and latency percentiles. Run ``python -m
+dataflake.ldapconnection.replay --help`` to replay a trace file against
+a server or the fault injecting fake server.
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+import ldap
+import ldap.dn
+from ldapurl import LDAPUrl
+import six
+from six.moves import queue
+from zope.interface import implementer
+
+from dataflake.ldapconnection.benchmarks import percentile
+from dataflake.ldapconnection.connection import LDAPConnection
+from dataflake.ldapconnection.filters import Filter
+from dataflake.ldapconnection.interfaces import IOperationObserver
+
+
+# Filter items with their attribute, comparison and value
+FILTER_ITEM = re.compile(u'\\(([\\w.;:-]+)(~=|>=|<=|=)([^()]*)\\)')
+
+# Operations replayed by default and write operations replayed on demand
+READS = ('search', 'search_page')
+WRITES = ('insert', 'modify', 'delete', 'delete_subtree')
+
+# Encodes filter objects as unicode filter strings
+_text_connection = LDAPConnection(ldap_encoding='')
+
+
+@implementer(IOperationObserver)
+class TraceRecorder(object):
+    """ Observer writing the operations of a connection to a trace file
+
+    - `path` is the name of the trace file, which is overwritten
+
+    - `redact` replaces DN, filter and attribute values by hashes
+
+    - `keep` lists the attributes whose values are never redacted
+
+    Only operations called directly are recorded, not the connection
+    setup and binds they cause.
+    """
+
+    def __init__(self, path, redact=True, keep=('objectClass',)):
+        self.redact = redact
+        self.keep = frozenset(x.lower() for x in keep)
+        self.salt = os.urandom(16)
+        self.created = time.time()
+        self.lock = threading.Lock()
+        self.file = open(path, 'w')
+        self._write({'trace': 1, 'started': self.created,
+                     'redacted': redact})
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def started(self, event):
+        pass
+
+    def finished(self, event):
+        if event.parent is not None:
+            return
+
+        error = event.exception
+        self._write({'offset': event.started - self.created,
+                     'operation': event.operation,
+                     'base': self._dn(event.base),
+                     'scope': event.scope,
+                     'filter': self._filter(event.fltr),
+                     'attrs': self._attrs(event.attrs),
+                     'duration': event.duration,
+                     'size': event.size,
+                     'error': error.__class__.__name__ if error else None})
+
+    def _write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(line)
+                self.file.flush()
+
+    def _token(self, value):
+        if isinstance(value, six.text_type):
+            value = value.encode('UTF-8')
+        return u'r' + hashlib.sha1(self.salt + value).hexdigest()[:12]
+
+    def _value(self, attr, value):
+        if not self.redact or attr.split(u';')[0].lower() in self.keep:
+            return _text(value)
+        return self._token(value)
+
+    def _dn(self, dn):
+        if dn is None:
+            return None
+        dn = _text(dn)
+        if not self.redact:
+            return dn
+        try:
+            parts = ldap.dn.str2dn(dn)
+        except ldap.DECODING_ERROR:
+            return self._token(dn)
+        return ldap.dn.dn2str([[(attr, self._value(attr, value), flag)
+                                for attr, value, flag in rdn]
+                               for rdn in parts])
+
+    def _filter(self, fltr):
+        if fltr is None:
+            return None
+        if isinstance(fltr, Filter):
+            fltr = fltr.encode(_text_connection)
+        fltr = _text(fltr)
+        if not self.redact:
+            return fltr
+
+        def redact(match):
+            attr, comparison, value = match.groups()
+            if value != u'*':
+                value = u'*'.join(x and self._value(attr, x)
+                                  for x in value.split(u'*'))
+            return u'(%s%s%s)' % (attr, comparison, value)
+
+        return FILTER_ITEM.sub(redact, fltr)
+
+    def _attrs(self, attrs):
+        if attrs is None:
+            return None
+        if not isinstance(attrs, dict):
+            # Attribute names requested by a search
+            return [_text(x) for x in attrs]
+
+        result = {}
+        for attr, values in attrs.items():
+            attr = _text(attr)
+            if isinstance(values, (six.binary_type, six.text_type)):
+                values = [values]
+            result[attr] = [self._value(attr, x) for x in values]
+        return result
+
+
+def load_trace(path):
+    """ Read the operations of a trace file ordered by start time
+    """
+    records = []
+    with open(path) as fp:
+        for line in fp:
+            record = json.loads(line)
+            if 'operation' in record:
+                records.append(record)
+    records.sort(key=lambda x: x['offset'])
+    return records
+
+
+def populate(records):
+    """ Create the records a trace operates on in the fake directory
+
+    Searched, modified and deleted records are created without any
+    attributes, for inserted records only their parent is created.
+    """
+    from dataflake.fakeldap import TREE
+
+    for record in records:
+        dn = record['base']
+        if not dn:
+            continue
+        if record['operation'] == 'insert':
+            dn = ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:])
+        if dn:
+            TREE.addTreeItems(dn.encode('UTF-8'))
+
+
+def replay(connection, records, speed=1.0, workers=8, writes=False,
+           share_connection=False):
+    """ Send the recorded operations to `connection` again
+
+    Operations are started at their recorded offset divided by `speed`
+    by a pool of `workers` threads. Unless `share_connection` is true
+    each thread uses its own server connection. Write operations are
+    only sent if `writes` is true, bulk operations are never sent.
+
+    Returns a mapping with the number of `operations` sent and
+    `skipped`, the number of `errors` by exception class, the elapsed
+    `seconds` and the `throughput` per second. `latency` summarizes the
+    latencies of all operations with their ``count``, ``mean``,
+    ``p50``, ``p90``, ``p99`` and ``max``, `by_operation` maps the
+    operation names to the same summary. `max_lag` is the longest time
+    an operation had to wait for a free thread.
+    """
+    replayed = READS + WRITES if writes else READS
+    jobs = queue.Queue()
+    lock = threading.Lock()
+    outcomes = []
+
+    def work(conn):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            record, due = job
+            started = time.time()
+            error = None
+            try:
+                _execute(conn, record)
+            except (ldap.LDAPError, RuntimeError) as e:
+                error = e.__class__.__name__
+            finished = time.time()
+            with lock:
+                outcomes.append((record['operation'], finished - started,
+                                 started - due, error))
+
+    conns = [connection if share_connection else _clone(connection)
+             for i in range(workers)]
+    threads = [threading.Thread(target=work, args=(x,)) for x in conns]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    skipped = 0
+    started = time.time()
+    try:
+        for record in records:
+            if record['operation'] not in replayed:
+                skipped += 1
+                continue
+            due = started + record['offset'] / float(speed)
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            jobs.put((record, due))
+    finally:
+        for thread in threads:
+            jobs.put(None)
+        for thread in threads:
+            thread.join()
+        for conn in conns:
+            if conn is not connection:
+                conn.disconnect()
+    seconds = time.time() - started
+
+    errors = {}
+    by_operation = {}
+    for operation, latency, lag, error in outcomes:
+        by_operation.setdefault(operation, []).append(latency)
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+
+    return {'operations': len(outcomes),
+            'skipped': skipped,
+            'errors': errors,
+            'seconds': seconds,
+            'throughput': len(outcomes) / seconds if seconds else 0.0,
+            'speed': speed,
+            'workers': workers,
+            'max_lag': max([x[2] for x in outcomes] or [0.0]),
+            'latency': _summary([x[1] for x in outcomes]),
+            'by_operation': dict((name, _summary(latencies))
+                                 for name, latencies in by_operation.items())}
+
+
+def _execute(connection, record):
+    operation = record['operation']
+    dn = record['base']
+
+    if operation == 'search':
+        connection.search(dn, _scope(record), _fltr(record), record['attrs'])
+    elif operation == 'search_page':
+        for page in connection.search_paged(dn, _scope(record), _fltr(record),
+                                            record['attrs']):
+            break
+    elif operation == 'insert':
+        parts = ldap.dn.str2dn(dn)
+        connection.insert(ldap.dn.dn2str(parts[1:]),
+                          ldap.dn.dn2str(parts[:1]), record['attrs'] or {})
+    elif operation == 'modify':
+        connection.modify(dn, attrs=record['attrs'] or {})
+    elif operation == 'delete':
+        connection.delete(dn)
+    elif operation == 'delete_subtree':
+        connection.delete_subtree(dn)
+
+
+def _scope(record):
+    if record['scope'] is None:
+        return ldap.SCOPE_SUBTREE
+    return record['scope']
+
+
+def _fltr(record):
+    return record['filter'] or u'(objectClass=*)'
+
+
+def _clone(connection):
+    """ Copy a connection, the copy uses a server connection of its own
+    """
+    clone = copy.copy(connection)
+    clone.hash = id(clone) + random.random()
+    return clone
+
+
+def _summary(latencies):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {'count': count,
+            'mean': sum(latencies) / count if count else 0.0,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else 0.0}
+
+
+def _text(value):
+    if isinstance(value, six.binary_type):
+        return value.decode('UTF-8', 'replace')
+    return six.text_type(value)
+
+
+def _server(url):
+    """ Host, port and protocol for `addServer` from a server URL
+    """
+    url = LDAPUrl(url)
+    default_port = url.urlscheme == 'ldaps' and '636' or '389'
+    host, port = (url.hostport.split(':') + [default_port])[:2]
+    return host, port, url.urlscheme
+
+
+def main(argv=None):
+    from dataflake.ldapconnection.testing import FaultInjectingFactory
+    from dataflake.ldapconnection.testing import lognormal
+
+    parser = argparse.ArgumentParser(
+                prog='python -m dataflake.ldapconnection.replay',
+                description='Replay a recorded trace of LDAP operations.')
+    parser.add_argument('trace', help='trace file written by TraceRecorder')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='replay speed as multiple of the recorded one')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of concurrent threads')
+    parser.add_argument('--writes', action='store_true',
+                        help='replay write operations as well')
+    parser.add_argument('--server', action='append', dest='servers',
+                        metavar='URL',
+                        help='server URL, may be repeated. Without servers '
+                             'the trace is replayed against a fake server')
+    parser.add_argument('--bind-dn', default='')
+    parser.add_argument('--bind-pwd', default='')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='median latency of the fake server')
+    parser.add_argument('--concurrency', type=int,
+                        help='concurrent operations of the fake server')
+    parser.add_argument('-o', '--output',
+                        help='write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    records = load_trace(args.trace)
+
+    if args.servers:
+        connection = LDAPConnection(bind_dn=args.bind_dn,
+                                    bind_pwd=args.bind_pwd)
+        for url in args.servers:
+            connection.addServer(*_server(url))
+    else:
+        populate(records)
+        latency = lognormal(args.latency) if args.latency else 0
+        factory = FaultInjectingFactory(latency=latency,
+                                        concurrency=args.concurrency)
+        connection = LDAPConnection('localhost', 389, 'ldap', factory)
+
+    report = replay(connection, records, speed=args.speed,
+                    workers=args.workers, writes=args.writes)
+
+    out = sys.stdout
+    out.write('%i operations (%i skipped) in %.2fs, %.1f/s, '
+              'max lag %.3fs\n' % (report['operations'], report['skipped'],
+                                   report['seconds'], report['throughput'],
+                                   report['max_lag']))
+    out.write('%-16s %8s %10s %10s %10s\n' % (
+              'operation', 'count', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for name, summary in sorted(report['by_operation'].items()) + \
+            [('all', report['latency'])]:
+        out.write('%-16s %8i %10.3f %10.3f %10.3f\n' % (
+                  name, summary['count'], summary['p50'] * 1000,
+                  summary['p90'] * 1000, summary['p99'] * 1000))
+    for name, count in sorted(report['errors'].items()):
+        out.write('%s: %i\n' % (name, count))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Retrying operations
+
+A `RetryPolicy` set as the `retry_policy` attribute of an
+`LDAPConnection` retries operations failing with transient errors like
+SERVER_DOWN after a jittered, exponentially growing delay. The server
+that failed is dropped and tried last for a while, so the retry goes
+to another server if there is one.
+
+Searches are always safe to repeat. A write that failed after the
+connection was made may have been carried out by the server, it is
+only retried if the policy allows retrying writes.
+
+The default connection factory, `ReconnectLDAPObject`, reconnects
+and repeats a failed operation once by itself before the policy sees
+the error. Use `ldap.ldapobject.SimpleLDAPObject` as `c_factory` to
+leave all retrying to the policy.
+"""
+
+import random
+import threading
+import time
+
+import ldap
+
+from dataflake.ldapconnection.connection import connection_cache
+
+
+# Operations that can be repeated without changing their outcome
+READS = ('search', 'lookup_many', 'authenticate')
+
+WRITES = ('insert', 'insert_many', 'modify', 'modify_many', 'delete',
+          'delete_subtree')
+
+
+class RetryPolicy(object):
+    """ Retry operations failing with transient errors
+
+    - `attempts` is the maximum number of attempts including the first
+
+    - the delay before a retry is chosen at random between zero and
+      `base_delay` doubled for each earlier retry, at most `max_delay`
+
+    - no retry is started if more than `max_time` seconds would have
+      passed since the first attempt by the time it starts, or if the
+      `timeout` passed to the operation would have run out
+
+    - `retry_writes` allows retrying writes even if the request may have
+      reached the server. Otherwise writes are only retried if they
+      failed while connecting
+
+    - a failed server is tried last for `penalty` seconds
+    """
+
+    retryable = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.UNAVAILABLE,
+                 ldap.BUSY, ldap.TIMEOUT)
+
+    def __init__(self, attempts=3, base_delay=0.1, max_delay=2.0,
+                 max_time=10.0, retry_writes=False, penalty=30.0,
+                 seed=None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_time = max_time
+        self.retry_writes = retry_writes
+        self.penalty = penalty
+        self.failed = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._state = threading.local()
+
+    def call(self, connection, operation, func, args, kw):
+        """ Call `func` for `operation`, retrying after transient errors
+
+        Operations run by another operation are retried as part of it.
+        """
+        state = self._state
+        if getattr(state, 'active', False) or \
+                operation not in READS + WRITES:
+            return func(connection, *args, **kw)
+
+        started = time.time()
+        deadline = None
+        if kw.get('timeout') is not None:
+            deadline = started + kw['timeout']
+
+        state.active = True
+        try:
+            attempt = 1
+            while True:
+                state.connected = False
+                try:
+                    return func(connection, *args, **kw)
+                except self.retryable as e:
+                    delay = self._retry(connection, operation, e, attempt,
+                                        started, deadline)
+                    if delay is None:
+                        raise
+
+                self._sleep(delay)
+                attempt += 1
+                if deadline is not None:
+                    kw = dict(kw, timeout=deadline - time.time())
+        finally:
+            state.active = False
+
+    def _retry(self, connection, operation, exception, attempt, started,
+               deadline):
+        """ Decide about retrying, return the delay or None to give up
+        """
+        if attempt >= self.attempts:
+            return None
+        if operation not in READS and self._state.connected and \
+                not self.retry_writes:
+            # The server may have carried out the write already
+            return None
+
+        delay = self.backoff(attempt)
+        now = time.time()
+        if now + delay - started > self.max_time:
+            return None
+        if deadline is not None and now + delay >= deadline:
+            return None
+
+        server = connection._serverUrl()
+        if server is not None:
+            self.serverFailed(server)
+            connection_cache.invalidate(connection.hash)
+
+        error = exception.__class__.__name__
+        if connection.metrics is not None:
+            connection.metrics.increment('retries_total',
+                                         operation=operation, error=error)
+        connection.logger().warning(
+            'Retrying %s in %.3fs after %s (attempt %i of %i)' % (
+                operation, delay, error, attempt + 1, self.attempts))
+        return delay
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def backoff(self, attempt):
+        """ The delay before the retry following attempt number `attempt`
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return self._random.uniform(0, ceiling)
+
+    def connected(self):
+        """ Note that the current operation has a server connection
+
+        Requests sent from now on may reach the server.
+        """
+        self._state.connected = True
+
+    def serverFailed(self, url):
+        """ Try the server with the given URL last for a while
+        """
+        with self._lock:
+            self.failed[url] = time.time()
+
+    def order(self, servers):
+        """ Sort server definitions, recently failed servers last
+        """
+        now = time.time()
+        with self._lock:
+            failed = dict((url, when) for url, when in self.failed.items()
+                          if now - when < self.penalty)
+            self.failed = failed
+        return sorted(servers, key=lambda x: failed.get(x['url'], 0))
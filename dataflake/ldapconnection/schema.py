@@ -0,0 +1,156 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Attribute syntaxes from the server schema
+
+`fetch_schema` reads the attribute type definitions from the server's
+subschema subentry and finds the attributes with a binary syntax. Set
+the result as the `schema` attribute of an
+`LDAPConnection`: values of all binary attributes are then returned
+undecoded and are not split or transcoded when sent, without a
+``;binary`` marker on the attribute name.
+
+    connection.schema = fetch_schema(connection)
+"""
+
+import threading
+
+import ldap
+from ldap.schema.models import AttributeType
+import six
+
+from dataflake.ldapconnection.utils import _names
+from dataflake.ldapconnection.utils import BINARY_ATTRIBUTES
+from dataflake.ldapconnection.utils import has_binary_values
+
+
+# Binary syntax OIDs of RFC 4517 and RFC 4523
+_PREFIX = '1.3.6.1.4.1.1466.115.121.1.'
+BINARY_SYNTAXES = frozenset([
+    _PREFIX + '4',      # Audio
+    _PREFIX + '5',      # Binary
+    _PREFIX + '8',      # Certificate
+    _PREFIX + '9',      # Certificate List
+    _PREFIX + '10',     # Certificate Pair
+    _PREFIX + '23',     # Fax
+    _PREFIX + '28',     # JPEG
+    _PREFIX + '40',     # Octet String
+    _PREFIX + '49',     # Supported Algorithm
+])
+
+# Schemas already fetched, by server URL
+_schemas = {}
+_lock = threading.Lock()
+
+
+class AttributeSchema(object):
+    """ The attributes with binary values according to a server schema
+
+    `binary` is a frozenset of the lowercase names of these attributes,
+    as both encoded and text strings. It always contains the names in
+    `dataflake.ldapconnection.utils.BINARY_ATTRIBUTES`.
+    """
+
+    def __init__(self, binary=()):
+        self.binary = BINARY_ATTRIBUTES.union(
+            _names(*[_key(x) for x in binary]))
+
+    @classmethod
+    def fromAttributeTypes(cls, definitions):
+        """ Build a schema from attribute type definition strings
+
+        These are the values of the ``attributeTypes`` attribute of a
+        subschema subentry. Syntaxes are inherited from supertypes.
+        """
+        types = {}
+        for definition in definitions:
+            attr_type = AttributeType(definition)
+            for name in (attr_type.oid,) + tuple(attr_type.names):
+                types[name.lower()] = attr_type
+
+        binary = []
+        for attr_type in types.values():
+            if _syntax(attr_type, types) in BINARY_SYNTAXES:
+                binary.extend(attr_type.names)
+
+        return cls(binary)
+
+    def isBinary(self, name):
+        """ Find out if the values of an attribute are binary
+
+        Options on the name, like ``;lang-de``, are ignored unless one
+        of them is ``binary``.
+        """
+        return has_binary_values(name, self.binary)
+
+
+def fetch_schema(connection, refresh=False):
+    """ Read the attribute types from the server's subschema subentry
+
+    Schemas are kept for each server URL and only fetched again if
+    `refresh` is true. Returns an `AttributeSchema`.
+    """
+    server = connection._serverUrl()
+    if server is None:
+        connection.connect()
+        server = connection._serverUrl()
+
+    with _lock:
+        schema = _schemas.get(server)
+    if schema is not None and not refresh:
+        return schema
+
+    root = connection.search('', ldap.SCOPE_BASE,
+                             attrs=['subschemaSubentry'], raw=True)
+    subentry = b'cn=Subschema'
+    for record in root['results']:
+        values = _values(record, b'subschemasubentry')
+        if values:
+            subentry = values[0]
+
+    res = connection.search(subentry, ldap.SCOPE_BASE,
+                            fltr='(objectClass=subschema)',
+                            attrs=['attributeTypes'], raw=True)
+    definitions = []
+    for record in res['results']:
+        definitions.extend(_values(record, b'attributetypes'))
+
+    schema = AttributeSchema.fromAttributeTypes(definitions)
+    with _lock:
+        _schemas[server] = schema
+    return schema
+
+
+def _syntax(attr_type, types):
+    """ The syntax OID of an attribute type, looking at its supertypes
+    """
+    seen = set()
+    while attr_type is not None and attr_type.oid not in seen:
+        if attr_type.syntax:
+            return attr_type.syntax
+        seen.add(attr_type.oid)
+        sup = attr_type.sup and attr_type.sup[0].lower()
+        attr_type = types.get(sup)
+    return None
+
+
+def _key(name):
+    if isinstance(name, six.text_type):
+        name = name.encode('UTF-8')
+    return name.lower()
+
+
+def _values(record, name):
+    for key, values in record.items():
+        if key != 'dn' and _key(key) == name:
+            return values
+    return []
@@ -0,0 +1,217 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" In-memory entry store with local search
+
+An `EntryStore` holds records keyed by their normalized DN and answers
+searches with any filter that `dataflake.ldapconnection.filters` can
+parse. Equality and presence terms on indexed attributes are looked up
+in hash indexes, so only the records they point to are matched against
+the whole filter. All other searches check every record in scope.
+"""
+
+from copy import deepcopy
+import threading
+
+import six
+
+from dataflake.ldapconnection.filters import _fold
+from dataflake.ldapconnection.filters import And
+from dataflake.ldapconnection.filters import Equality
+from dataflake.ldapconnection.filters import Filter
+from dataflake.ldapconnection.filters import Or
+from dataflake.ldapconnection.filters import parse_filter
+from dataflake.ldapconnection.filters import Presence
+from dataflake.ldapconnection.utils import dn_in_scope
+from dataflake.ldapconnection.utils import normalize_dn
+
+
+def _attrName(key):
+    """ Lowercase attribute name without options
+    """
+    return _fold(key, 'ascii').split(u';')[0]
+
+
+class EntryStore(object):
+    """ Records indexed by DN and by the values of selected attributes
+
+    - `indexes` is a sequence of attribute names to keep hash indexes
+      for, matching values case-insensitively like the filter objects
+
+    - `encoding` is the encoding of the stored DNs and values
+    """
+
+    def __init__(self, indexes=('uid', 'mail', 'cn'), encoding='UTF-8'):
+        self.encoding = encoding
+        self.indexed = frozenset(_attrName(x) for x in indexes)
+        self.lock = threading.RLock()
+        self.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, parts):
+        return parts in self.entries
+
+    def clear(self):
+        """ Remove all records
+        """
+        with self.lock:
+            self.entries = {}
+            self.index = dict((x, {}) for x in self.indexed)
+            self.present = dict((x, set()) for x in self.indexed)
+
+    def keys(self):
+        """ Return the normalized DNs of all records
+        """
+        with self.lock:
+            return list(self.entries.keys())
+
+    def items(self):
+        """ Return (normalized DN, (dn, record)) tuples for all records
+        """
+        with self.lock:
+            return list(self.entries.items())
+
+    def get(self, dn, default=None):
+        """ Return the (dn, record) tuple stored for a DN
+        """
+        return self.entries.get(self._parts(dn), default)
+
+    def add(self, dn, record):
+        """ Store a record, replacing any record with the same DN
+
+        Returns the normalized DN.
+        """
+        parts = normalize_dn(dn, self.encoding)
+        with self.lock:
+            self._unindex(parts)
+            self.entries[parts] = (dn, record)
+            for attr, values in self._indexedValues(record):
+                self.present[attr].add(parts)
+                for value in values:
+                    self.index[attr].setdefault(value, set()).add(parts)
+        return parts
+
+    def remove(self, dn):
+        """ Remove a record, return its (dn, record) tuple or None
+        """
+        parts = self._parts(dn)
+        with self.lock:
+            self._unindex(parts)
+            return self.entries.pop(parts, None)
+
+    def search(self, base, scope, fltr, attrs=None):
+        """ Find records matching a filter
+
+        `fltr` is a filter string or filter object. Returns a list of
+        (dn, record) tuples with copies of the records, restricted to
+        the attributes in `attrs`. Raises ValueError if the filter
+        cannot be evaluated locally.
+        """
+        if not isinstance(fltr, Filter):
+            fltr = parse_filter(fltr, self.encoding)
+        base_parts = self._parts(base)
+
+        results = []
+        with self.lock:
+            candidates = self._plan(fltr)
+            if candidates is None:
+                candidates = self.entries.keys()
+
+            for parts in candidates:
+                if not dn_in_scope(parts, base_parts, scope):
+                    continue
+                dn, record = self.entries[parts]
+                if fltr.match(record, self.encoding):
+                    results.append((dn, self._select(record, attrs)))
+
+        return results
+
+    def _plan(self, fltr):
+        """ Use the indexes to narrow down the records a filter can match
+
+        Returns a set of normalized DNs that includes all matches, or
+        None if every record must be checked.
+        """
+        if isinstance(fltr, Equality):
+            attr = _attrName(fltr.attr)
+            if attr in self.indexed:
+                value = _fold(fltr.value, self.encoding)
+                return self.index[attr].get(value, set())
+        elif isinstance(fltr, Presence):
+            attr = _attrName(fltr.attr)
+            # Records always have an object class, even if not stored
+            if attr in self.indexed and attr != u'objectclass':
+                return self.present[attr]
+        elif isinstance(fltr, And):
+            found = [x for x in map(self._plan, fltr.filters)
+                     if x is not None]
+            if found:
+                found.sort(key=len)
+                return found[0].intersection(*found[1:])
+        elif isinstance(fltr, Or):
+            found = []
+            for candidates in map(self._plan, fltr.filters):
+                if candidates is None:
+                    return None
+                found.append(candidates)
+            return set().union(*found)
+
+        return None
+
+    def _indexedValues(self, record):
+        for key, values in record.items():
+            attr = _attrName(key)
+            if attr in self.indexed:
+                if isinstance(values, (six.binary_type, six.text_type)):
+                    values = [values]
+                yield attr, [_fold(x, self.encoding) for x in values]
+
+    def _unindex(self, parts):
+        dn, record = self.entries.get(parts, (None, None))
+        if record is None:
+            return
+
+        for attr, values in self._indexedValues(record):
+            self.present[attr].discard(parts)
+            for value in values:
+                matching = self.index[attr].get(value)
+                if matching is not None:
+                    matching.discard(parts)
+                    if not matching:
+                        del self.index[attr][value]
+
+    def _parts(self, dn):
+        if isinstance(dn, tuple):
+            return dn
+        return normalize_dn(dn, self.encoding)
+
+    def _select(self, record, attrs):
+        """ Copy a record, restricted to the requested attributes
+        """
+        if not attrs or '*' in attrs:
+            return deepcopy(record)
+
+        wanted = set(_attrName(x) for x in attrs)
+        return dict((key, deepcopy(values))
+                    for key, values in record.items()
+                    if _attrName(key) in wanted)
@@ -0,0 +1,360 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Local replica of a directory subtree
+
+A `SyncMirror` keeps an in-process copy of a subtree up to date using the
+Content Synchronization Operation (syncrepl, RFC 4533). Searches inside
+the mirrored subtree can then be answered without asking the server: an
+`LDAPConnection` with its `mirror` attribute set uses the mirror for all
+searches it can answer.
+"""
+
+import os
+import threading
+import time
+
+import ldap
+from ldap.ldapobject import LDAPObject
+from ldap.syncrepl import SyncreplConsumer
+import six
+from six.moves import cPickle
+
+from dataflake.ldapconnection.store import EntryStore
+from dataflake.ldapconnection.utils import dn_in_scope
+from dataflake.ldapconnection.utils import escape_dn
+from dataflake.ldapconnection.utils import normalize_dn
+
+
+# Errors signalling that the server cannot do refreshAndPersist
+PERSIST_UNSUPPORTED = (ldap.PROTOCOL_ERROR,
+                       ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+                       ldap.UNWILLING_TO_PERFORM)
+
+
+class MirrorConsumerMixin(object):
+    """ Hand the syncrepl consumer callbacks to a `SyncMirror`
+    """
+    mirror = None
+
+    def syncrepl_get_cookie(self):
+        return self.mirror.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.mirror.cookie = cookie
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        self.mirror._entry(dn, attrs, uuid)
+
+    def syncrepl_delete(self, uuids):
+        self.mirror._delete(uuids)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        self.mirror._present(uuids, refreshDeletes)
+
+    def syncrepl_refreshdone(self):
+        self.mirror._refreshDone()
+
+
+class SyncConsumer(MirrorConsumerMixin, SyncreplConsumer, LDAPObject):
+    """ LDAP connection class feeding syncrepl results into a mirror
+    """
+
+
+class SyncMirror(object):
+    """ In-process copy of a subtree, kept up to date with syncrepl
+
+    - `connection` is the `LDAPConnection` providing the server
+      definitions, encodings and default credentials. The mirror uses a
+      separate server connection of its own.
+
+    - `attrs` is the attribute list requested for mirrored records. It
+      must cover all attributes that searches answered from the mirror
+      filter on or ask for. By default all user attributes are mirrored.
+
+    - `mode` is ``refreshAndPersist``, where the server pushes changes
+      as they happen, or ``refreshOnly``, where the mirror polls every
+      `poll_interval` seconds. If the server cannot do
+      ``refreshAndPersist`` the mirror falls back to polling.
+
+    - `indexes` names the attributes the mirror keeps hash indexes for,
+      searches with equality or presence terms on them only look at the
+      matching records
+
+    - `path` is a file the mirror is saved to together with the sync
+      cookie, after each refresh and at most every `save_interval`
+      seconds. A saved mirror is loaded when the mirror is created, so
+      a restarted process only needs to fetch the changes since.
+    """
+    consumer_factory = SyncConsumer
+
+    def __init__(self, connection, base, scope=ldap.SCOPE_SUBTREE,
+                 attrs=None, mode='refreshAndPersist', poll_interval=60,
+                 path=None, save_interval=300, bind_dn=None, bind_pwd=None,
+                 indexes=('uid', 'mail', 'cn')):
+        self.connection = connection
+        self.base = escape_dn(connection._encode_incoming(base),
+                              connection.ldap_encoding)
+        self.base_parts = normalize_dn(self.base, connection.ldap_encoding)
+        self.scope = scope
+        self.attrs = attrs
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.path = path
+        self.save_interval = save_interval
+        self.bind_dn = bind_dn
+        self.bind_pwd = bind_pwd
+
+        self.entries = EntryStore(indexes, connection.ldap_encoding)
+        self.uuids = {}
+        self.cookie = None
+        self.ready = False
+        self.lock = threading.RLock()
+        self.callbacks = []
+        self._present_uuids = set()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.load()
+
+    def subscribe(self, callback):
+        """ Register a callable notified about each change
+
+        It is called with the kind of change (``add``, ``modify`` or
+        ``delete``), the DN and the record, which is None for deletions.
+        """
+        self.callbacks.append(callback)
+
+    def search(self, base, scope, fltr, attrs=None):
+        """ Search the mirror
+
+        `base` and `fltr` must be encoded like the arguments passed to
+        the server. Returns a list of (dn, record) tuples like a server
+        search, or None if the mirror cannot answer the search.
+        """
+        if not self.ready:
+            return None
+
+        encoding = self.connection.ldap_encoding
+        base_parts = normalize_dn(base, encoding)
+        if not self._covers(base_parts, scope):
+            return None
+
+        with self.lock:
+            if base_parts not in self.entries:
+                return None
+
+            try:
+                return self.entries.search(base_parts, scope, fltr, attrs)
+            except ValueError:
+                return None
+
+    def _covers(self, base_parts, scope):
+        """ Find out if all records a search can find are mirrored
+
+        Below a base or one level mirror nothing is mirrored, so only
+        base searches for the mirrored records can be answered there.
+        """
+        if not dn_in_scope(base_parts, self.base_parts, self.scope):
+            return False
+
+        return self.scope == ldap.SCOPE_SUBTREE or scope == ldap.SCOPE_BASE
+
+    def sync(self):
+        """ Bring the mirror up to date with a single refresh
+        """
+        consumer = self._connect()
+        try:
+            msgid = consumer.syncrepl_search(self.base, self.scope,
+                                             mode='refreshOnly',
+                                             attrlist=self.attrs)
+            while consumer.syncrepl_poll(msgid=msgid, all=1):
+                pass
+        finally:
+            self._disconnect(consumer)
+
+        self._refreshDone()
+
+    def start(self):
+        """ Keep the mirror up to date from a background thread
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread and save the mirror
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.save()
+
+    def _run(self):
+        mode = self.mode
+        logger = self.connection.logger()
+
+        while not self._stopped.is_set():
+            try:
+                if mode == 'refreshAndPersist':
+                    self._persist()
+                else:
+                    self.sync()
+            except PERSIST_UNSUPPORTED as e:
+                if mode != 'refreshAndPersist':
+                    logger.warning('Mirror refresh failed: %s' % str(e))
+                else:
+                    logger.info('refreshAndPersist unavailable, '
+                                'polling instead: %s' % str(e))
+                    mode = 'refreshOnly'
+                    continue
+            except ldap.LDAPError as e:
+                logger.warning('Mirror refresh failed: %s' % str(e))
+
+            self._stopped.wait(self.poll_interval)
+
+    def _persist(self):
+        """ Run a refreshAndPersist search until stopped
+        """
+        consumer = self._connect()
+        last_save = time.time()
+
+        try:
+            msgid = consumer.syncrepl_search(self.base, self.scope,
+                                             mode='refreshAndPersist',
+                                             attrlist=self.attrs)
+            while not self._stopped.is_set():
+                try:
+                    if not consumer.syncrepl_poll(msgid=msgid, timeout=1):
+                        break
+                except ldap.TIMEOUT:
+                    pass
+
+                if time.time() - last_save > self.save_interval:
+                    self.save()
+                    last_save = time.time()
+        finally:
+            self._disconnect(consumer)
+            self.save()
+
+    def _connect(self):
+        """ Open a syncrepl consumer connection
+        """
+        consumer = self.connection._newConnection(
+                    self.bind_dn, self.bind_pwd,
+                    c_factory=self.consumer_factory)
+        consumer.mirror = self
+        return consumer
+
+    def _disconnect(self, consumer):
+        try:
+            consumer.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _entry(self, dn, attrs, uuid):
+        """ Store an added or changed record
+        """
+        if not isinstance(dn, six.binary_type):
+            dn = dn.encode(self.connection.ldap_encoding or 'UTF-8')
+        parts = normalize_dn(dn, self.connection.ldap_encoding)
+
+        with self.lock:
+            old_parts = self.uuids.get(uuid)
+            if old_parts is not None and old_parts != parts:
+                # The record was renamed or moved
+                self.entries.remove(old_parts)
+            self.entries.add(dn, attrs)
+            self.uuids[uuid] = parts
+
+        self._notify(old_parts is None and 'add' or 'modify', dn, attrs)
+
+    def _delete(self, uuids):
+        """ Remove deleted records
+        """
+        for uuid in uuids:
+            with self.lock:
+                parts = self.uuids.pop(uuid, None)
+                if parts is None:
+                    continue
+                dn, record = self.entries.remove(parts) or (None, None)
+            if dn is not None:
+                self._notify('delete', dn, None)
+
+    def _present(self, uuids, refresh_deletes):
+        """ Track the records the server reports as still present
+
+        At the end of the present phase all records that were not
+        reported are gone from the server, unless the server sent the
+        deletions explicitly.
+        """
+        if uuids is not None:
+            self._present_uuids.update(uuids)
+            return
+
+        if not refresh_deletes:
+            with self.lock:
+                missing = [x for x in self.uuids
+                           if x not in self._present_uuids]
+            self._delete(missing)
+        self._present_uuids = set()
+
+    def _refreshDone(self):
+        self.ready = True
+        self.save()
+
+    def _notify(self, change, dn, record):
+        for callback in self.callbacks:
+            try:
+                callback(change, dn, record)
+            except Exception:
+                self.connection.logger().exception(
+                    'Mirror change callback failed')
+
+    def save(self):
+        """ Save the mirror and the sync cookie to the configured file
+        """
+        if not self.path:
+            return
+
+        with self.lock:
+            data = {'base': self.base, 'scope': self.scope,
+                    'attrs': self.attrs, 'cookie': self.cookie,
+                    'entries': self.entries, 'uuids': self.uuids}
+            tmp_path = '%s.tmp' % self.path
+            with open(tmp_path, 'wb') as fp:
+                cPickle.dump(data, fp, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+
+    def load(self):
+        """ Load the mirror from the configured file if it matches
+        """
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as fp:
+            data = cPickle.load(fp)
+
+        if (data['base'], data['scope'], data['attrs']) != \
+           (self.base, self.scope, self.attrs):
+            return
+
+        with self.lock:
+            self.entries = data['entries']
+            self.uuids = data['uuids']
+            self.cookie = data['cookie']
+            self.ready = True
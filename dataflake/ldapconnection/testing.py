@@ -0,0 +1,436 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Fake server connections for tests and load experiments
+
+The connection classes work on the fake directory tree of
+``dataflake.fakeldap``. `FaultInjectingFactory` can be passed to an
+`LDAPConnection` as `c_factory` to emulate a slow and flaky server.
+"""
+
+import heapq
+import math
+import random
+import threading
+import time
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+from ldap.controls.libldap import AssertionControl
+from ldap.controls.readentry import PostReadControl
+from ldap.controls.readentry import PreReadControl
+
+from dataflake.fakeldap import FakeLDAPConnection
+from dataflake.fakeldap import TREE
+from dataflake.fakeldap.utils import to_utf8
+from dataflake.ldapconnection.connection import TREE_DELETE_CONTROL
+
+# Map connection methods to the operation names used for latencies
+OPERATIONS = {'simple_bind_s': 'bind',
+              'search_s': 'search', 'search_ext': 'search',
+              'add_s': 'add', 'add_ext': 'add',
+              'modify_s': 'modify', 'modify_ext': 'modify',
+              'delete_s': 'delete', 'delete_ext': 'delete',
+              'modrdn_s': 'modrdn', 'rename': 'modrdn'}
+
+# The fake directory tree is not safe for concurrent changes
+_tree_lock = threading.RLock()
+
+
+class AsyncFakeLDAPConnection(FakeLDAPConnection):
+    """ Fake LDAP connection emulating the asynchronous operations API
+
+    Operations are carried out immediately when they are submitted, the
+    outcome is kept until it is collected by calling `result3`.
+    """
+
+    def __init__(self, *args, **kw):
+        FakeLDAPConnection.__init__(self, *args, **kw)
+        self.outcomes = {}
+        self.submitted = []
+        self.abandoned = []
+        self.deleted = []
+        self.last_msgid = 0
+
+    def _submit(self, name, func, *args):
+        self.last_msgid += 1
+        self.submitted.append(name)
+        try:
+            self.outcomes[self.last_msgid] = func(*args)
+        except ldap.LDAPError as exc:
+            self.outcomes[self.last_msgid] = exc
+        return self.last_msgid
+
+    def search_ext(self, base, scope, filterstr=b'(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        def search():
+            if scope == ldap.SCOPE_SUBTREE:
+                res = self._searchSubtree(base, filterstr, attrlist)
+            else:
+                res = self.search_s(base, scope, filterstr, attrlist)
+            res_ctrls = []
+            for ctrl in serverctrls or ():
+                if ctrl.controlType == SimplePagedResultsControl.controlType:
+                    res.sort(key=lambda x: x[0])
+                    start = int(ctrl.cookie or 0)
+                    end = start + ctrl.size
+                    cookie = str(end).encode() if end < len(res) else b''
+                    res = res[start:end]
+                    res_ctrls.append(
+                        SimplePagedResultsControl(size=ctrl.size,
+                                                  cookie=cookie))
+            return (ldap.RES_SEARCH_RESULT, res, res_ctrls)
+        return self._submit('search_ext', search)
+
+    def add_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        def add():
+            self.add_s(dn, modlist)
+            return (ldap.RES_ADD, [], [])
+        return self._submit('add_ext', add)
+
+    def modify_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        def modify():
+            by_type = dict((x.controlType, x) for x in serverctrls or ())
+            assertion = by_type.get(AssertionControl.controlType)
+            if assertion is not None and \
+                    not self.search_s(dn, ldap.SCOPE_BASE,
+                                      to_utf8(assertion.filterstr)):
+                raise ldap.ASSERTION_FAILED({'desc': 'Assertion Failed'})
+
+            res_ctrls = []
+            pre_read = by_type.get(PreReadControl.controlType)
+            if pre_read is not None:
+                res_ctrls.append(self._readEntry(PreReadControl, dn,
+                                                 pre_read.attrList))
+            self.modify_s(dn, modlist)
+            post_read = by_type.get(PostReadControl.controlType)
+            if post_read is not None:
+                res_ctrls.append(self._readEntry(PostReadControl, dn,
+                                                 post_read.attrList))
+            return (ldap.RES_MODIFY, [], res_ctrls)
+        return self._submit('modify_ext', modify)
+
+    def _readEntry(self, control_class, dn, attr_list):
+        attrs = [x.encode('UTF-8') for x in attr_list]
+        ((rec_dn, entry),) = self.search_s(dn, ldap.SCOPE_BASE, attrs=attrs)
+        control = control_class()
+        control.dn = dn.decode('UTF-8')
+        control.entry = dict((k.decode('UTF-8'), [v.decode('UTF-8')
+                                                  for v in values])
+                             for k, values in entry.items())
+        return control
+
+    def delete_ext(self, dn, serverctrls=None, clientctrls=None):
+        def delete():
+            tree_delete = [x for x in serverctrls or ()
+                           if x.controlType == TREE_DELETE_CONTROL]
+            if not tree_delete and len(list(self._walk(dn))) > 1:
+                raise ldap.NOT_ALLOWED_ON_NONLEAF({'desc': 'Non-leaf'})
+            self.delete_s(dn)
+            self.deleted.append(dn)
+            return (ldap.RES_DELETE, [], [])
+        return self._submit('delete_ext', delete)
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1,
+               serverctrls=None, clientctrls=None):
+        def rename():
+            self.modrdn_s(dn, newrdn)
+            return (ldap.RES_MODRDN, [], [])
+        return self._submit('rename', rename)
+
+    def _searchSubtree(self, base, filterstr, attrlist):
+        """ Search the base record and all records below it
+
+        FakeLDAPConnection only searches one level deep, so each record
+        in the subtree is matched against the filter on its own.
+        """
+        res = []
+        for dn in self._walk(to_utf8(base)):
+            for rec_dn, rec in self.search_s(dn, ldap.SCOPE_BASE,
+                                             filterstr, attrlist):
+                # Leave out the child records kept inside the parent
+                res.append((rec_dn, dict((k, v) for k, v in rec.items()
+                                         if not isinstance(v, dict))))
+        return res
+
+    def _walk(self, dn):
+        """ Yield a DN and the DNs of all records below it
+        """
+        yield dn
+        for key, value in TREE.getElementByDN(dn).items():
+            if b'=' in key and isinstance(value, dict):
+                for child in self._walk(key + b',' + dn):
+                    yield child
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None,
+                resp_ctrl_classes=None):
+        outcome = self.outcomes.pop(msgid)
+        if isinstance(outcome, Exception):
+            raise outcome
+        res_type, res_data, res_ctrls = outcome
+        return (res_type, res_data, msgid, res_ctrls)
+
+    def abandon_ext(self, msgid, serverctrls=None, clientctrls=None):
+        self.outcomes.pop(msgid, None)
+        self.abandoned.append(msgid)
+
+
+def constant(seconds):
+    """ Latency distribution always returning `seconds`
+    """
+    return lambda rnd: seconds
+
+
+def uniform(low, high):
+    """ Latency distribution with values spread evenly between bounds
+    """
+    return lambda rnd: rnd.uniform(low, high)
+
+
+def exponential(mean):
+    """ Latency distribution with exponentially distributed values
+    """
+    return lambda rnd: rnd.expovariate(1.0 / mean)
+
+
+def lognormal(median, sigma=0.5):
+    """ Latency distribution with a long tail of slow operations
+
+    Half of the values are below `median`, a larger `sigma` makes for
+    a longer tail.
+    """
+    mu = math.log(median)
+    return lambda rnd: rnd.lognormvariate(mu, sigma)
+
+
+class FaultInjectingFactory(object):
+    """ Connection factory emulating a slow and unreliable server
+
+    Pass an instance as `c_factory` when creating an `LDAPConnection`.
+    All connections made by one factory behave like connections to the
+    same server working on the fake directory tree:
+
+    - `latency` is the time the server needs to answer an operation.
+      It is a number of seconds, a distribution like `lognormal`, or a
+      mapping of operation names (``bind``, ``search``, ``add``,
+      ``modify``, ``delete``, ``modrdn``) to either, with a ``default``
+      key for the operations not listed
+
+    - `concurrency` is the number of operations the server works on at
+      the same time. Further operations wait for a free slot, so the
+      throughput levels off like that of a real server. None means
+      there is no limit
+
+    - `failure_rate` and `timeout_rate` are the fractions of
+      operations failing with SERVER_DOWN and TIMEOUT
+
+    - `referral_rate` is the fraction of searches and writes answered
+      with a referral to `referral_url`. Operations on connections to
+      that URL are never referred
+
+    - `down` is a set of server URLs that cannot be reached
+
+    Like a server connection, each connection handles one call at a
+    time. Waiting honours the `timeout` attribute of the connection,
+    which `LDAPConnection` sets to the server's `op_timeout`, and the
+    `timeout` passed to `result3`.
+
+    The number of operations by name is counted in `operations`, the
+    number of injected faults by kind in `injected`. `connections`
+    lists the server URLs of all connections made.
+    """
+
+    def __init__(self, latency=0, concurrency=None, failure_rate=0.0,
+                 timeout_rate=0.0, referral_rate=0.0,
+                 referral_url='ldap://referral:389', down=(), seed=None):
+        self.latency = latency
+        self.concurrency = concurrency
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.referral_rate = referral_rate
+        self.referral_url = referral_url
+        self.down = set(down)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.injected = {}
+        self.connections = []
+        # Times at which the server's working slots become free
+        self._slots = [0.0] * concurrency if concurrency else None
+
+    def __call__(self, conn_string, *args, **kw):
+        if conn_string in self.down:
+            with self.lock:
+                self._count(self.injected, 'server_down')
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+        with self.lock:
+            self.connections.append(conn_string)
+        return FaultInjectingConnection(self, conn_string)
+
+    def _count(self, counter, name):
+        counter[name] = counter.get(name, 0) + 1
+
+    def _latency(self, operation):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(operation, latency.get('default', 0))
+        if callable(latency):
+            latency = latency(self.random)
+        return max(latency, 0.0)
+
+    def _schedule(self, conn, method):
+        """ Decide when and how the server answers an operation
+
+        Returns the time the answer arrives and the exception to answer
+        with, if any. Raises SERVER_DOWN right away for failures.
+        """
+        operation = OPERATIONS.get(method, method)
+
+        with self.lock:
+            self._count(self.operations, operation)
+
+            if conn.conn_string in self.down or \
+                    self.random.random() < self.failure_rate:
+                self._count(self.injected, 'server_down')
+                raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+            now = time.time()
+            latency = self._latency(operation)
+            if self._slots is None:
+                answered = now + latency
+            else:
+                answered = max(now, heapq.heappop(self._slots)) + latency
+                heapq.heappush(self._slots, answered)
+
+            exception = None
+            if self.random.random() < self.timeout_rate:
+                self._count(self.injected, 'timeout')
+                exception = ldap.TIMEOUT({'desc': 'Timed out'})
+            elif operation != 'bind' and \
+                    conn.conn_string != self.referral_url and \
+                    self.random.random() < self.referral_rate:
+                self._count(self.injected, 'referral')
+                exception = ldap.REFERRAL({
+                    'desc': 'Referral',
+                    'info': 'Referral:\n%s' % self.referral_url})
+
+        return answered, exception
+
+
+class FaultInjectingConnection(AsyncFakeLDAPConnection):
+    """ Fake server connection made by a `FaultInjectingFactory`
+    """
+
+    def __init__(self, factory, conn_string):
+        AsyncFakeLDAPConnection.__init__(self, conn_string)
+        self.factory = factory
+        self.conn_string = conn_string
+        self.timeout = -1
+        self.answered = {}
+        self._lock = threading.RLock()
+        self._busy = False
+
+    def _call(self, method, *args, **kw):
+        """ Carry out a synchronous operation after the server answered
+        """
+        func = getattr(AsyncFakeLDAPConnection, method)
+
+        with self._lock:
+            if self._busy:
+                # Called by another operation of the fake connection
+                return func(self, *args, **kw)
+
+            answered, exception = self.factory._schedule(self, method)
+            _wait(answered, self.timeout)
+            if exception is not None:
+                raise exception
+
+            self._busy = True
+            try:
+                with _tree_lock:
+                    return func(self, *args, **kw)
+            finally:
+                self._busy = False
+
+    def simple_bind_s(self, *args, **kw):
+        return self._call('simple_bind_s', *args, **kw)
+
+    def search_s(self, *args, **kw):
+        return self._call('search_s', *args, **kw)
+
+    def add_s(self, *args, **kw):
+        return self._call('add_s', *args, **kw)
+
+    def modify_s(self, *args, **kw):
+        return self._call('modify_s', *args, **kw)
+
+    def delete_s(self, *args, **kw):
+        return self._call('delete_s', *args, **kw)
+
+    def modrdn_s(self, *args, **kw):
+        return self._call('modrdn_s', *args, **kw)
+
+    def _submit(self, name, func, *args):
+        with self._lock:
+            answered, exception = self.factory._schedule(self, name)
+            if exception is not None:
+                func = _raiser(exception)
+
+            self._busy = True
+            try:
+                with _tree_lock:
+                    msgid = AsyncFakeLDAPConnection._submit(self, name, func,
+                                                            *args)
+            finally:
+                self._busy = False
+
+            self.answered[msgid] = answered
+            return msgid
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None,
+                resp_ctrl_classes=None):
+        with self._lock:
+            if timeout is None:
+                timeout = self.timeout
+            answered = self.answered.get(msgid)
+            if answered is not None:
+                if timeout == 0 and answered > time.time():
+                    return (None, None, None, None)
+                _wait(answered, timeout)
+                del self.answered[msgid]
+            return AsyncFakeLDAPConnection.result3(self, msgid, all, timeout,
+                                                   resp_ctrl_classes)
+
+    def abandon_ext(self, msgid, serverctrls=None, clientctrls=None):
+        with self._lock:
+            self.answered.pop(msgid, None)
+            AsyncFakeLDAPConnection.abandon_ext(self, msgid, serverctrls,
+                                                clientctrls)
+
+
+def _wait(answered, timeout=-1):
+    """ Sleep until `answered`, raise TIMEOUT if `timeout` passes first
+    """
+    remaining = answered - time.time()
+    if timeout is not None and timeout >= 0 and remaining > timeout:
+        time.sleep(timeout)
+        raise ldap.TIMEOUT({'desc': 'Timed out'})
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def _raiser(exception):
+    def fail(*args):
+        raise exception
+    return fail
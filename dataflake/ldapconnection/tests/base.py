@@ -75,6 +75,19 @@ class LDAPConnectionTests(unittest.TestCase):
 
         return conn
 
+    def _makeAsync(self, **kw):
+        from dataflake.ldapconnection.testing import \
+            AsyncFakeLDAPConnection
+        ldap_connection = AsyncFakeLDAPConnection('conn_string')
+
+        def factory(conn_string):
+            ldap_connection.conn_string = conn_string
+            return ldap_connection
+
+        conn = self._makeOne('host', 389, 'ldap', factory, **kw)
+
+        return conn, ldap_connection
+
     def _factory(self, connection_string):
         of = FakeLDAPConnection(connection_string)
         return of
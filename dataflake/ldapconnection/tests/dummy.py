@@ -13,7 +13,74 @@
 """ dummy: dummy test fixtures
 """
 
+import ldap
+
+from dataflake.ldapconnection.sync import MirrorConsumerMixin
+
 # From ISO-8859-1: Umlauts a, o, u and sharp s
 UNENCODED_LATIN1 = u'\xe4\xf6\xfc\xdf'
 # From ISO-8859-7 (Greek): Alpha, beta, gamma, delta
 UNENCODED_GREEK = u'\u03b1\u03b2\u03b3\u03b4'
+
+
+class FakeSyncConsumer(MirrorConsumerMixin):
+    """ Fake syncrepl consumer connection replaying a list of events
+
+    Each event is a tuple of a consumer callback name without the
+    ``syncrepl_`` prefix and its arguments, e.g. ``('delete', [uuid])``.
+    """
+
+    def __init__(self, conn_string, events=(), searches=None):
+        self.conn_string = conn_string
+        self.events = events
+        self.searches = searches if searches is not None else []
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, binduid, bindpwd):
+        self.last_bind = (binduid, bindpwd)
+
+    def unbind_s(self):
+        pass
+
+    def syncrepl_search(self, base, scope, mode='refreshOnly', cookie=None,
+                        **search_args):
+        self.searches.append((base, scope, mode, self.syncrepl_get_cookie()))
+        return 1
+
+    def syncrepl_poll(self, msgid=-1, timeout=None, all=0):
+        for event in self.events:
+            getattr(self, 'syncrepl_%s' % event[0])(*event[1:])
+        return False
+
+
+class FakeNotifyingConnection(object):
+    """ Fake server connection returning change notifications
+
+    `notifications` is a list of (dn, controls) tuples returned one at a
+    time by `result4`. The search ends after the last notification.
+    """
+
+    def __init__(self, notifications=()):
+        self.notifications = list(notifications)
+        self.searches = []
+
+    def search_ext(self, base, scope, filterstr=b'(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        self.searches.append((base, scope, filterstr, attrlist,
+                              serverctrls))
+        return 1
+
+    def result4(self, msgid=ldap.RES_ANY, all=1, timeout=None,
+                add_ctrls=0, add_intermediates=0, add_extop=0,
+                resp_ctrl_classes=None):
+        if not self.notifications:
+            return (ldap.RES_SEARCH_RESULT, [], msgid, [], None, None)
+        dn, ctrls = self.notifications.pop(0)
+        return (ldap.RES_SEARCH_ENTRY, [(dn, {}, ctrls)], msgid, [],
+                None, None)
+
+    def unbind_s(self):
+        pass
@@ -0,0 +1,95 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_benchmarks: Tests for the benchmark suite
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import ldap
+import six
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        from dataflake.fakeldap import TREE
+        from dataflake.ldapconnection.connection import connection_cache
+        TREE.clear()
+        connection_cache.invalidate()
+        shutil.rmtree(self.tmpdir)
+
+    def test_percentile(self):
+        from dataflake.ldapconnection.benchmarks import percentile
+        samples = list(range(1, 101))
+        self.assertEqual(percentile(samples, 50), 50)
+        self.assertEqual(percentile(samples, 99), 99)
+        self.assertEqual(percentile(samples, 100), 100)
+        self.assertEqual(percentile([3], 90), 3)
+        self.assertEqual(percentile([], 90), 0.0)
+
+    def test_run(self):
+        from dataflake.ldapconnection.benchmarks import CASES
+        from dataflake.ldapconnection.benchmarks import Benchmark
+        bench = Benchmark(size=30, values=5, iterations=3,
+                          memory_iterations=1)
+        response = bench.unicode_conn.search(bench.dn(2), ldap.SCOPE_BASE)
+        record = response['results'][0]
+        self.assertEqual(record[b'cn'], [u'\u03b1\u03b2\u03b32'])
+        self.assertEqual(len(record[b'memberOf']), 5)
+
+        results = bench.run()
+        self.assertEqual(sorted(results['cases']),
+                         sorted(name for name, case in CASES))
+        search = results['cases']['search']
+        self.assertEqual(search['iterations'], 3)
+        self.assertTrue(search['ops_per_sec'] > 0)
+        self.assertTrue(search['p50'] <= search['p99'] <= search['max'])
+
+    def test_main_and_compare(self):
+        from dataflake.ldapconnection.benchmarks import main
+        output = os.path.join(self.tmpdir, 'results.json')
+        args = ['-s', '10', '-n', '2', '-c', 'search', '-c', 'delete']
+
+        with _silenced():
+            self.assertEqual(main(args + ['-o', output]), 0)
+        with open(output) as fp:
+            previous = json.load(fp)
+        self.assertEqual(sorted(previous['cases']), ['delete', 'search'])
+
+        # Make the earlier run look much faster to provoke a regression
+        previous['cases']['search']['ops_per_sec'] *= 1000
+        with open(output, 'w') as fp:
+            json.dump(previous, fp)
+        with _silenced() as out:
+            self.assertEqual(main(args + ['--compare', output]), 1)
+        self.assertIn('search', out.getvalue().split('change')[1])
+
+
+class _silenced(object):
+
+    def __enter__(self):
+        import sys
+        self.stdout = sys.stdout
+        sys.stdout = six.StringIO()
+        return sys.stdout
+
+    def __exit__(self, *exc_info):
+        import sys
+        sys.stdout = self.stdout
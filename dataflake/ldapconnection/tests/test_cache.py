@@ -0,0 +1,337 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_cache: Tests for the search result cache and change listener
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import ldap
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from dataflake.ldapconnection.cache import ResultCache
+        return ResultCache(*args, **kw)
+
+    def test_get_set(self):
+        cache = self._makeOne()
+        key = cache.key(b'dc=localhost', 2, b'(cn=foo)', None)
+        self.assertEqual(cache.get(key), None)
+
+        result = {'size': 1, 'results': [{'dn': b'cn=foo,dc=localhost'}]}
+        cache.set(key, b'dc=localhost', 2, result)
+        self.assertEqual(cache.get(key), result)
+
+        # Callers cannot change cached results
+        cache.get(key)['results'].pop()
+        self.assertEqual(cache.get(key), result)
+
+    def test_invalidate_dn(self):
+        cache = self._makeOne()
+        searches = {'sub': (b'dc=localhost', ldap.SCOPE_SUBTREE),
+                    'one': (b'ou=people,dc=localhost', ldap.SCOPE_ONELEVEL),
+                    'base': (b'cn=foo,ou=people,dc=localhost',
+                             ldap.SCOPE_BASE),
+                    'other': (b'ou=groups,dc=localhost',
+                              ldap.SCOPE_SUBTREE)}
+        for key, (base, scope) in searches.items():
+            cache.set(key, base, scope, {'size': 0, 'results': []})
+
+        cache.invalidate_dn(b'CN=Bar,ou=people,dc=localhost')
+        self.assertEqual(cache.get('sub'), None)
+        self.assertEqual(cache.get('one'), None)
+        self.assertNotEqual(cache.get('base'), None)
+        self.assertNotEqual(cache.get('other'), None)
+
+        cache.invalidate_dn(b'dc=localhost', subtree=True)
+        self.assertEqual(cache.get('base'), None)
+        self.assertEqual(cache.get('other'), None)
+        self.assertEqual(cache.searches, {})
+
+
+class BindCacheTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from dataflake.ldapconnection.cache import BindCache
+        kw.setdefault('iterations', 10)
+        return BindCache(*args, **kw)
+
+    def test_check_set(self):
+        cache = self._makeOne()
+        dn = b'cn=foo,dc=localhost'
+        self.assertFalse(cache.check(dn, b'secret'))
+
+        cache.set(dn, b'secret')
+        self.assertTrue(cache.check(dn, b'secret'))
+        self.assertTrue(cache.check(b'CN=Foo, dc=localhost', u'secret'))
+        self.assertFalse(cache.check(dn, b'Secret'))
+        self.assertFalse(cache.check(b'cn=bar,dc=localhost', b'secret'))
+
+        # The password is not stored
+        salt, fingerprint, expires = cache.entries[(u'cn=foo',
+                                                    u'dc=localhost')]
+        self.assertFalse(b'secret' in salt + fingerprint)
+
+    def test_expiry(self):
+        cache = self._makeOne(timeout=-1)
+        cache.set(b'cn=foo,dc=localhost', b'secret')
+        self.assertFalse(cache.check(b'cn=foo,dc=localhost', b'secret'))
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_max_size(self):
+        cache = self._makeOne(max_size=2)
+        cache.set(b'cn=a,dc=localhost', b'a')
+        cache.set(b'cn=b,dc=localhost', b'b')
+        self.assertTrue(cache.check(b'cn=a,dc=localhost', b'a'))
+        cache.set(b'cn=c,dc=localhost', b'c')
+
+        # The least recently used DN is dropped
+        self.assertTrue(cache.check(b'cn=a,dc=localhost', b'a'))
+        self.assertFalse(cache.check(b'cn=b,dc=localhost', b'b'))
+        self.assertTrue(cache.check(b'cn=c,dc=localhost', b'c'))
+
+    def test_invalidate(self):
+        cache = self._makeOne()
+        for dn in (b'cn=a,ou=people,dc=localhost',
+                   b'cn=b,ou=people,dc=localhost', b'cn=c,dc=localhost'):
+            cache.set(dn, b'secret')
+
+        cache.invalidate(b'cn=A,ou=people,dc=localhost')
+        self.assertFalse(cache.check(b'cn=a,ou=people,dc=localhost',
+                                     b'secret'))
+        self.assertTrue(cache.check(b'cn=b,ou=people,dc=localhost',
+                                    b'secret'))
+
+        cache.invalidate(b'ou=people,dc=localhost', subtree=True)
+        self.assertEqual(list(cache.entries), [(u'cn=c', u'dc=localhost')])
+
+        cache.invalidate()
+        self.assertEqual(len(cache.entries), 0)
+
+
+class SQLiteCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self, *args, **kw):
+        from dataflake.ldapconnection.cache import SQLiteCache
+        return SQLiteCache(self.path, *args, **kw)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        from dataflake.cache.interfaces import ITimeoutCache
+        verifyObject(ITimeoutCache, self._makeOne())
+
+    def test_set_get(self):
+        cache = self._makeOne()
+        # WAL mode without a sync on every commit
+        self.assertEqual(cache.db.execute('PRAGMA synchronous').fetchone(),
+                         (1,))
+        cache.set('Key', {'results': [b'x']})
+        self.assertEqual(cache.get('key'), {'results': [b'x']})
+        self.assertEqual(cache.items(), [('key', {'results': [b'x']})])
+
+        cache.setTimeout(-1)
+        cache.set('other', 1)
+        self.assertEqual(cache.get('other', 'missing'), 'missing')
+        self.assertEqual(cache.keys(), ['key'])
+
+        cache.invalidate()
+        self.assertEqual(cache.values(), [])
+
+    def test_restart(self):
+        from dataflake.ldapconnection.cache import ResultCache
+        cache = ResultCache(self._makeOne())
+        cache.set('foo', b'cn=foo,dc=localhost', ldap.SCOPE_BASE, {'a': 1})
+        cache.set('bar', b'cn=bar,dc=localhost', ldap.SCOPE_BASE, {'b': 1})
+        cache.storage.close()
+
+        # A new process finds the results and can still invalidate them
+        # without loading all of them
+        restarted = ResultCache(self._makeOne())
+        restarted.storage.items = restarted.storage.values = None
+        self.assertEqual(restarted.get('foo'), {'a': 1})
+        restarted.invalidate_dn(b'cn=foo,dc=localhost')
+        self.assertEqual(restarted.get('foo'), None)
+        self.assertEqual(restarted.get('bar'), {'b': 1})
+        self.assertEqual(sorted(restarted.storage.keys()),
+                         ['bar', 'index:0:bar:cn=bar,dc=localhost'])
+
+
+class SocketCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        from dataflake.ldapconnection.cache import CacheServer
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.sock')
+        self.server = CacheServer(self.path)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self):
+        from dataflake.ldapconnection.cache import SocketCache
+        return SocketCache(self.path)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        from dataflake.cache.interfaces import ITimeoutCache
+        verifyObject(ITimeoutCache, self._makeOne())
+
+    def test_shared(self):
+        from dataflake.ldapconnection.cache import ResultCache
+        first = ResultCache(self._makeOne())
+        second = ResultCache(self._makeOne())
+
+        second.set('foo', b'cn=foo,dc=localhost', ldap.SCOPE_BASE,
+                   {'a': 1})
+        self.assertEqual(first.get('foo'), {'a': 1})
+
+        # Results stored by other clients are invalidated, too
+        first.invalidate_dn(b'cn=foo,dc=localhost')
+        self.assertEqual(second.get('foo'), None)
+
+    def test_server_down(self):
+        cache = self._makeOne()
+        cache.set('foo', 1)
+        cache.close()
+        self.server.stop()
+        self.assertEqual(cache.get('foo', 'missing'), 'missing')
+        self.assertEqual(cache.items(), [])
+
+
+class ConnectionResultCacheTests(LDAPConnectionTests):
+
+    def _makeCached(self):
+        from dataflake.ldapconnection.cache import ResultCache
+        conn = self._makeSimple()
+        conn.result_cache = ResultCache()
+        conn.server_searches = 0
+        search_server = conn._searchServer
+
+        def counting(*args, **kw):
+            conn.server_searches += 1
+            return search_server(*args, **kw)
+        conn._searchServer = counting
+        return conn
+
+    def test_search_cached(self):
+        conn = self._makeCached()
+        conn.insert('dc=localhost', 'cn=foo', attrs={'sn': 'Foo'})
+        first = conn.search('dc=localhost', fltr='(cn=foo)')
+        second = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(first, second)
+        self.assertEqual(conn.server_searches, 1)
+
+        # Other credentials always search on the server
+        conn.search('dc=localhost', fltr='(cn=foo)', bind_dn='',
+                    bind_pwd='')
+        self.assertEqual(conn.server_searches, 2)
+
+    def test_shared_storage(self):
+        conn = self._makeCached()
+        conn.insert('dc=localhost', 'cn=foo', attrs={'sn': 'Foo'})
+        conn.search('dc=localhost', fltr='(cn=foo)')
+
+        # Connections with other credentials or servers sharing the
+        # storage do not get each other's results
+        other = self._makeCached()
+        other.result_cache = conn.result_cache
+        other.bind_dn = 'cn=other,dc=localhost'
+        other.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(other.server_searches, 1)
+
+        other = self._makeCached()
+        other.result_cache = conn.result_cache
+        other.addServer('backup', 636, 'ldap')
+        other.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(other.server_searches, 1)
+
+        other = self._makeCached()
+        other.result_cache = conn.result_cache
+        other.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(other.server_searches, 0)
+
+    def test_writes_invalidate(self):
+        conn = self._makeCached()
+        conn.insert('dc=localhost', 'cn=foo', attrs={'sn': 'Foo'})
+        conn.search('dc=localhost', fltr='(cn=foo)')
+
+        conn.modify('cn=foo,dc=localhost', attrs={'sn': 'Bar'})
+        res = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(res['results'][0][b'sn'], [b'Bar'])
+
+        conn.delete('cn=foo,dc=localhost')
+        res = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(res['size'], 0)
+
+    def test_pickle(self):
+        from six.moves import cPickle
+        from dataflake.ldapconnection.cache import ResultCache
+        conn = self._makeSimple()
+        conn.result_cache = ResultCache()
+        conn.insert('dc=localhost', 'cn=foo', attrs={'sn': 'Foo'})
+        conn.search('dc=localhost', fltr='(cn=foo)')
+
+        copy = cPickle.loads(cPickle.dumps(conn))
+        self.assertEqual(copy.result_cache, None)
+        self.assertEqual(copy.search('dc=localhost', fltr='(cn=foo)')['size'],
+                         1)
+
+    def test_listener(self):
+        from ldap.controls.psearch import EntryChangeNotificationControl
+        from dataflake.ldapconnection.cache import ResultCache
+        from dataflake.ldapconnection.listener import ChangeListener
+        from dataflake.ldapconnection.tests.dummy import \
+            FakeNotifyingConnection
+
+        conn = self._makeSimple()
+        conn.result_cache = cache = ResultCache()
+
+        rename = EntryChangeNotificationControl()
+        rename.changeType = 8
+        rename.previousDN = 'cn=bar,dc=localhost'
+        server = FakeNotifyingConnection(
+                    [(b'cn=foo,dc=localhost', []),
+                     (b'cn=qux,dc=localhost', [rename])])
+        listener = ChangeListener(conn, 'dc=localhost', method='psearch')
+        changes = []
+        listener.subscribe(changes.append)
+
+        # Everything is dropped as soon as the search started
+        listener._listen(server, 'psearch')
+        self.assertEqual(changes, [None, b'cn=foo,dc=localhost',
+                                   b'cn=bar,dc=localhost',
+                                   b'cn=qux,dc=localhost'])
+        self.assertEqual(server.searches[0][3], ['1.1'])
+
+        cache.set('baz', b'cn=baz,dc=localhost', ldap.SCOPE_BASE, {})
+        changes[:] = []
+        server.notifications = [(b'cn=foo,dc=localhost', [])]
+        listener._listen(server, 'ad')
+        self.assertEqual(cache.get('baz'), None)
+        self.assertEqual(server.searches[1][4][0].controlType,
+                         '1.2.840.113556.1.4.528')
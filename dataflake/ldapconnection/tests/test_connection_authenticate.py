@@ -0,0 +1,112 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_connection_authenticate: Tests for password checks
+"""
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+USER = 'cn=foo,ou=people,dc=localhost'
+
+
+class ConnectionAuthenticateTests(LDAPConnectionTests):
+
+    def _makeConnection(self, cached=True):
+        from dataflake.ldapconnection.cache import BindCache
+        conn = self._makeOne('host', 389, 'ldap', self._factory,
+                             bind_dn='cn=Manager,dc=localhost',
+                             bind_pwd='admin')
+        if cached:
+            conn.bind_cache = BindCache(iterations=10)
+        self._addRecord(USER, cn=b'foo', userPassword='secret')
+        return conn
+
+    def _binds(self, conn):
+        counters = conn.metrics.snapshot()['counters']
+        return sum(x['value'] for x in counters.get('binds_total', ()))
+
+    def test_authenticate(self):
+        conn = self._makeConnection(cached=False)
+        self.assertTrue(conn.authenticate(USER, 'secret'))
+        self.assertFalse(conn.authenticate(USER, 'wrong'))
+        self.assertFalse(conn.authenticate(USER, ''))
+        self.assertTrue(conn.authenticate(USER, 'secret'))
+        self.assertEqual(self._binds(conn), 3)
+
+        # Checks use their own connection, the shared connection keeps
+        # its service bind
+        conn.connect()
+        self.assertTrue(conn.authenticate(USER, 'secret'))
+        last_bind = conn._getConnection()._last_bind
+        self.assertEqual(last_bind[1][0], b'cn=Manager,dc=localhost')
+        conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(self._binds(conn), 5)
+
+    def test_cached(self):
+        conn = self._makeConnection()
+        self.assertTrue(conn.authenticate(USER, 'secret'))
+        self.assertTrue(conn.authenticate(USER.upper(), 'secret'))
+        self.assertEqual(self._binds(conn), 1)
+
+        # Failed checks always reach the server
+        self.assertFalse(conn.authenticate(USER, 'wrong'))
+        self.assertFalse(conn.authenticate(USER, 'wrong'))
+        self.assertEqual(self._binds(conn), 3)
+
+        counters = conn.metrics.snapshot()['counters']
+        requests = dict((x['labels']['result'], x['value'])
+                        for x in counters['cache_requests_total']
+                        if x['labels']['cache'] == 'bind_cache')
+        self.assertEqual(requests, {'hit': 1, 'miss': 3})
+
+    def test_password_change_invalidates(self):
+        conn = self._makeConnection()
+        self.assertTrue(conn.authenticate(USER, 'secret'))
+
+        # Other changes keep the cached check
+        conn.modify(USER, attrs={'sn': 'Foo'})
+        self.assertTrue(conn.authenticate(USER, 'secret'))
+        self.assertEqual(self._binds(conn), 2)
+
+        conn.modify(USER, attrs={'userPassword': 'changed'})
+        self.assertFalse(conn.authenticate(USER, 'secret'))
+
+    def test_delete_invalidates(self):
+        conn = self._makeConnection()
+        self.assertTrue(conn.authenticate(USER, 'secret'))
+        conn.delete(USER)
+        self.assertEqual(len(conn.bind_cache.entries), 0)
+
+    def test_modify_many_invalidates(self):
+        from dataflake.ldapconnection.cache import BindCache
+        conn, ldap_connection = self._makeAsync()
+        conn.bind_cache = BindCache(iterations=10)
+        bar = 'cn=bar,ou=people,dc=localhost'
+        self._addRecord(USER, cn=b'foo', userPassword='secret')
+        self._addRecord(bar, cn=b'bar', userPassword='secret')
+        self.assertTrue(conn.authenticate(USER, 'secret'))
+        self.assertTrue(conn.authenticate(bar, 'secret'))
+
+        # Other changes keep the cached checks
+        conn.modify_many([(USER, {'sn': 'Foo'}), (bar, {'sn': 'Bar'})])
+        self.assertEqual(len(conn.bind_cache.entries), 2)
+
+        # Only the check for the changed password is dropped
+        conn.modify_many([(USER, {'userPassword': 'changed'}),
+                          (bar, {'sn': 'Baz'})])
+        self.assertEqual(list(conn.bind_cache.entries),
+                         [(u'cn=bar', u'ou=people', u'dc=localhost')])
+
+        # Renamed records cannot bind with their old DN
+        conn.modify_many([(bar, {'cn': 'baz'})])
+        self.assertEqual(len(conn.bind_cache.entries), 0)
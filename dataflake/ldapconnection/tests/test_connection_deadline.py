@@ -0,0 +1,108 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_connection_deadline: Tests for per-call timeouts
+"""
+
+import time
+
+import ldap
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+class ConnectionDeadlineTests(LDAPConnectionTests):
+
+    def _makeConnection(self, **kw):
+        from dataflake.ldapconnection.testing import FaultInjectingFactory
+        factory = FaultInjectingFactory(**kw)
+        conn = self._makeOne('host', 389, 'ldap', factory)
+        self._addRecord('cn=foo,dc=localhost', cn=b'foo', sn=b'Foo')
+        return conn, factory
+
+    def test_within_deadline(self):
+        conn, factory = self._makeConnection(latency=0.01)
+        response = conn.search('dc=localhost', fltr='(cn=foo)', timeout=1)
+        self.assertEqual(response['size'], 1)
+
+        conn.insert('dc=localhost', 'cn=bar', attrs={'sn': 'Bar'},
+                    timeout=1)
+        conn.modify('cn=bar,dc=localhost', attrs={'cn': 'baz'}, timeout=1)
+        response = conn.search('dc=localhost', fltr='(cn=baz)', timeout=1)
+        self.assertEqual(response['size'], 1)
+        conn.delete('cn=baz,dc=localhost', timeout=1)
+
+        self.assertEqual(factory.operations, {'bind': 1, 'search': 3,
+                                              'add': 1, 'modrdn': 1,
+                                              'modify': 1, 'delete': 1})
+        self.assertEqual(conn._getConnection().abandoned, [])
+
+    def test_search_abandoned(self):
+        conn, factory = self._makeConnection(latency={'search': 0.2})
+        conn.connect()
+
+        started = time.time()
+        self.assertRaises(ldap.TIMEOUT, conn.search, 'dc=localhost',
+                          timeout=0.05)
+        self.assertTrue(time.time() - started < 0.2)
+        self.assertEqual(len(conn._getConnection().abandoned), 1)
+        counters = conn.metrics.snapshot()['counters']
+        self.assertEqual(counters['abandons_total'],
+                         [{'labels': {}, 'value': 1}])
+
+    def test_write_abandoned(self):
+        conn, factory = self._makeConnection(latency={'modify': 0.2,
+                                                      'default': 0})
+        self.assertRaises(ldap.TIMEOUT, conn.modify, 'cn=foo,dc=localhost',
+                          attrs={'sn': 'Bar'}, timeout=0.05)
+        # Reading the current record worked, only the change timed out
+        self.assertEqual(factory.operations,
+                         {'bind': 1, 'search': 1, 'modify': 1})
+        self.assertEqual(len(conn._getConnection().abandoned), 1)
+
+    def test_remaining_budget(self):
+        # Binding and searching together take longer than allowed
+        conn, factory = self._makeConnection(latency=0.04)
+        self.assertRaises(ldap.TIMEOUT, conn.search, 'dc=localhost',
+                          timeout=0.06)
+        self.assertEqual(factory.operations, {'bind': 1, 'search': 1})
+
+        # An exhausted budget does not reach the server
+        self.assertRaises(ldap.TIMEOUT, conn.delete, 'cn=foo,dc=localhost',
+                          timeout=0)
+        self.assertEqual(factory.operations, {'bind': 1, 'search': 1})
+
+    def test_bind_timeout(self):
+        conn, factory = self._makeConnection(latency={'bind': 0.2,
+                                                      'default': 0})
+        self.assertRaises(ldap.TIMEOUT, conn.search, 'dc=localhost',
+                          timeout=0.05)
+        self.assertEqual(factory.operations, {'bind': 1})
+        # The connection is dropped, binds cannot be abandoned
+        self.assertEqual(conn._getConnection(), None)
+
+        factory.latency = 0
+        conn.connect(timeout=1)
+        connection = conn._getConnection()
+        self.assertEqual(connection.timeout, -1)
+        self.assertEqual(connection.options[ldap.OPT_NETWORK_TIMEOUT], -1)
+
+    def test_op_timeout(self):
+        from dataflake.ldapconnection.testing import FaultInjectingFactory
+        factory = FaultInjectingFactory(latency={'search': 0.2})
+        conn = self._makeOne('host', 389, 'ldap', factory, op_timeout=0.05)
+
+        # The shorter server timeout wins
+        started = time.time()
+        self.assertRaises(ldap.TIMEOUT, conn.search, 'dc=localhost',
+                          timeout=10)
+        self.assertTrue(time.time() - started < 0.2)
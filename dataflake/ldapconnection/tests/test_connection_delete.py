@@ -67,3 +67,40 @@ class ConnectionDeleteTests(LDAPConnectionTests):
         conn.delete('cn=foo,dc=localhost')
         self.assertEqual(ldap_connection.conn_string, 'ldap://otherhost:1389')
         self.assertEqual(ldap_connection.args, (b'cn=foo,dc=localhost',))
+
+    def _populateSubtree(self, conn):
+        conn.insert('dc=localhost', 'ou=people')
+        conn.insert('ou=people,dc=localhost', 'ou=staff')
+        for name in ('a', 'b'):
+            conn.insert('ou=people,dc=localhost', 'cn=%s' % name)
+            conn.insert('ou=staff,ou=people,dc=localhost', 'cn=%s' % name)
+
+    def test_delete_subtree(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populateSubtree(conn)
+        report = conn.delete_subtree('ou=people,dc=localhost', window=2)
+        self.assertEqual(report['size'], 6)
+        self.assertEqual(report['failed'], 0)
+        # Children are always deleted before their parents
+        deleted = ldap_connection.deleted
+        self.assertEqual(len(deleted), 6)
+        self.assertEqual(set(deleted[:2]),
+                         set([b'cn=a,ou=staff,ou=people,dc=localhost',
+                              b'cn=b,ou=staff,ou=people,dc=localhost']))
+        self.assertEqual(deleted[-1], b'ou=people,dc=localhost')
+        results = conn.search('dc=localhost', fltr='(ou=people)')
+        self.assertFalse(results['results'])
+
+    def test_delete_subtree_control(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populateSubtree(conn)
+        conn._supportedControls = lambda *args: [b'1.2.840.113556.1.4.805']
+        report = conn.delete_subtree('ou=people,dc=localhost')
+        self.assertEqual(report['results'],
+                         [(b'ou=people,dc=localhost', None)])
+        self.assertEqual(ldap_connection.submitted, ['delete_ext'])
+
+    def test_delete_subtree_readonly(self):
+        conn = self._makeOne('host', 636, 'ldap', self._factory,
+                             read_only=True)
+        self.assertRaises(RuntimeError, conn.delete_subtree, 'ou=people')
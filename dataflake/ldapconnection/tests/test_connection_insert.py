@@ -84,4 +84,38 @@ class ConnectionInsertTests(LDAPConnectionTests):
         self.assertEqual(results['size'], 1)
 
         record = results['results'][0]
-        self.assertEqual(record[b'objectguid'], 'a')
+        self.assertEqual(record[b'objectguid'], [b'a'])
+
+    def test_insert_many(self):
+        conn, ldap_connection = self._makeAsync()
+        records = [('dc=localhost', 'cn=%s' % x, {'sn': x})
+                   for x in ('a', 'b', 'c')]
+        report = conn.insert_many(records, window=2)
+        self.assertEqual(report['size'], 3)
+        self.assertEqual(report['succeeded'], 3)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(report['results'][0], (b'cn=a,dc=localhost', None))
+        self.assertTrue(report['rate'] >= 0)
+        self.assertEqual(ldap_connection.submitted, ['add_ext'] * 3)
+        rec = conn.search('dc=localhost', fltr='(cn=b)')['results'][0]
+        self.assertEqual(rec[b'sn'], [b'b'])
+
+    def test_insert_many_failures(self):
+        import ldap
+        conn, ldap_connection = self._makeAsync()
+        conn.insert('dc=localhost', 'cn=b')
+        records = [('dc=localhost', 'cn=%s' % x, {'sn': x})
+                   for x in ('a', 'b', 'c')]
+        report = conn.insert_many(records)
+        self.assertEqual(report['succeeded'], 2)
+        self.assertEqual(report['failed'], 1)
+        dn, exc = report['results'][1]
+        self.assertEqual(dn, b'cn=b,dc=localhost')
+        self.assertTrue(isinstance(exc, ldap.ALREADY_EXISTS))
+        self.assertEqual(report['results'][2], (b'cn=c,dc=localhost', None))
+
+    def test_insert_many_readonly(self):
+        conn = self._makeOne('host', 636, 'ldap', self._factory,
+                             read_only=True)
+        self.assertRaises(RuntimeError, conn.insert_many,
+                          [('dc=localhost', 'cn=foo', {})])
@@ -0,0 +1,67 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_connection_lookup: Tests for the LDAPConnection lookup_many method
+"""
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+class ConnectionLookupTests(LDAPConnectionTests):
+
+    def _populate(self, conn):
+        self.db.addTreeItems('ou=groups,dc=localhost')
+        for name in ('a', 'b', 'c', 'd'):
+            conn.insert('dc=localhost', 'cn=%s' % name, attrs={'sn': name})
+        conn.insert('ou=groups,dc=localhost', 'cn=g1')
+
+    def test_lookup_many(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        dns = ['cn=a,dc=localhost', 'cn=c,dc=localhost',
+               'cn=g1,ou=groups,dc=localhost']
+        found = conn.lookup_many(dns)
+        self.assertEqual(sorted(found.keys()), sorted(dns))
+        self.assertEqual(found['cn=a,dc=localhost'][b'sn'], [b'a'])
+        self.assertEqual(found['cn=a,dc=localhost']['dn'],
+                         b'cn=a,dc=localhost')
+        # One search per parent DN
+        self.assertEqual(ldap_connection.submitted, ['search_ext'] * 2)
+
+    def test_lookup_many_chunked(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        dns = ['cn=%s,dc=localhost' % x for x in ('a', 'b', 'c', 'd')]
+        found = conn.lookup_many(dns, chunk_size=3)
+        self.assertEqual(len(found), 4)
+        self.assertEqual(ldap_connection.submitted, ['search_ext'] * 2)
+
+    def test_lookup_many_missing(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        found = conn.lookup_many(['cn=a,dc=localhost',
+                                  'cn=unknown,dc=localhost',
+                                  'cn=x,ou=missing,dc=localhost'])
+        self.assertEqual(list(found.keys()), ['cn=a,dc=localhost'])
+
+    def test_lookup_many_normalized(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        found = conn.lookup_many(['cn=a, dc=localhost'])
+        self.assertEqual(list(found.keys()), ['cn=a, dc=localhost'])
+
+    def test_lookup_many_raw(self):
+        conn, ldap_connection = self._makeAsync(api_encoding='iso-8859-1')
+        self._populate(conn)
+        found = conn.lookup_many(['cn=b,dc=localhost'], raw=True)
+        self.assertEqual(found['cn=b,dc=localhost']['dn'],
+                         b'cn=b,dc=localhost')
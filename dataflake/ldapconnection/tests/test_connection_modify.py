@@ -151,7 +151,7 @@ class ConnectionModifyTests(LDAPConnectionTests):
         conn.insert('dc=localhost', 'cn=foo', attrs={'objectguid': 'a'})
         conn.modify('cn=foo,dc=localhost', attrs={'objectguid;binary': 'y'})
         rec = conn.search('dc=localhost', fltr='(cn=foo)')['results'][0]
-        self.assertEqual(rec[b'objectguid'], 'y')
+        self.assertEqual(rec[b'objectguid'], [b'y'])
 
     def test_modify_modrdn(self):
         conn = self._makeSimple()
@@ -179,3 +179,144 @@ class ConnectionModifyTests(LDAPConnectionTests):
         conn = self._makeSimple()
         self.assertRaises(ldap.NO_SUCH_OBJECT, conn.modify,
                           'cn=UNKNOWN', attrs={'a': 'y'})
+
+    def test_modify_many(self):
+        conn, ldap_connection = self._makeAsync()
+        for x in ('a', 'b', 'c'):
+            conn.insert('dc=localhost', 'cn=%s' % x, {'sn': 'old'})
+        changes = [('cn=%s,dc=localhost' % x, {'sn': x})
+                   for x in ('a', 'b', 'c')]
+        report = conn.modify_many(changes, window=2)
+        self.assertEqual(report['size'], 3)
+        self.assertEqual(report['succeeded'], 3)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(report['results'][0], (b'cn=a,dc=localhost', None))
+        self.assertEqual(ldap_connection.submitted.count('search_ext'), 1)
+        self.assertEqual(ldap_connection.submitted.count('modify_ext'), 3)
+        rec = conn.search('dc=localhost', fltr='(cn=b)')['results'][0]
+        self.assertEqual(rec[b'sn'], [b'b'])
+
+    def test_modify_many_failures(self):
+        import ldap
+        conn, ldap_connection = self._makeAsync()
+        conn.insert('dc=localhost', 'cn=a', {'sn': 'old'})
+        conn.insert('dc=localhost', 'cn=c', {'sn': 'c'})
+        changes = [('cn=a,dc=localhost', {'sn': 'a'}),
+                   ('cn=b,dc=localhost', {'sn': 'b'}),
+                   ('cn=c,dc=localhost', {'sn': 'c'})]
+        report = conn.modify_many(changes)
+        self.assertEqual(report['succeeded'], 2)
+        self.assertEqual(report['failed'], 1)
+        dn, exc = report['results'][1]
+        self.assertEqual(dn, b'cn=b,dc=localhost')
+        self.assertTrue(isinstance(exc, ldap.NO_SUCH_OBJECT))
+        # Nothing to change for the last record
+        self.assertEqual(report['results'][2], (b'cn=c,dc=localhost', None))
+        self.assertEqual(ldap_connection.submitted.count('modify_ext'), 1)
+
+    def test_modify_many_modrdn(self):
+        conn, ldap_connection = self._makeAsync()
+        conn.insert('dc=localhost', 'cn=foo', {'sn': 'old'})
+        report = conn.modify_many([('cn=foo,dc=localhost',
+                                    {'cn': 'bar', 'sn': 'new'})])
+        self.assertEqual(report['results'], [(b'cn=bar,dc=localhost', None)])
+        rec = conn.search('dc=localhost', fltr='(cn=bar)')['results'][0]
+        self.assertEqual(rec[b'sn'], [b'new'])
+
+    def test_modify_many_readonly(self):
+        conn = self._makeOne('host', 636, 'ldap', self._factory,
+                             read_only=True)
+        self.assertRaises(RuntimeError, conn.modify_many,
+                          [('cn=foo,dc=localhost', {'a': 'y'})])
+
+    def test_modify_explicit_type_skips_preread(self):
+        import ldap
+        conn, ldap_connection = self._makeAsync()
+        conn.insert('dc=localhost', 'cn=foo', {'a': 'x'})
+
+        def fail(*args, **kw):
+            raise AssertionError('Unexpected pre-read')
+        conn.search = fail
+        conn.modify('cn=foo,dc=localhost', mod_type=ldap.MOD_REPLACE,
+                    attrs={'a': 'y', 'cn': 'foo'})
+        conn.modify('cn=foo,dc=localhost', mod_type=ldap.MOD_ADD,
+                    attrs={'b': 'z'})
+        del conn.search
+        rec = conn.search('dc=localhost', fltr='(cn=foo)')['results'][0]
+        self.assertEqual(rec[b'a'], [b'y'])
+        self.assertEqual(rec[b'b'], [b'z'])
+
+    def test_modify_cur_rec(self):
+        conn = self._makeSimple()
+        conn.insert('dc=localhost', 'cn=foo', {'a': 'x'})
+        cur_rec = conn.search('dc=localhost', fltr='(cn=foo)',
+                              raw=True)['results'][0]
+
+        def fail(*args, **kw):
+            raise AssertionError('Unexpected pre-read')
+        conn.search = fail
+        conn.modify('cn=foo,dc=localhost', attrs={'a': 'y'},
+                    cur_rec=cur_rec)
+        del conn.search
+        rec = conn.search('dc=localhost', fltr='(cn=foo)')['results'][0]
+        self.assertEqual(rec[b'a'], [b'y'])
+
+    def test_modify_read_entry_controls(self):
+        conn, ldap_connection = self._makeAsync()
+        conn.insert('dc=localhost', 'cn=foo', {'a': 'x'})
+        result = conn.modify('cn=foo,dc=localhost', attrs={'a': 'y'},
+                             pre_read=['a'], post_read=['a'])
+        self.assertEqual(result['pre_read'][b'a'], [b'x'])
+        self.assertEqual(result['post_read'][b'a'], [b'y'])
+        self.assertEqual(result['post_read']['dn'], b'cn=foo,dc=localhost')
+        self.assertEqual(ldap_connection.submitted[-1], 'modify_ext')
+
+    def test_modify_assertion(self):
+        import ldap
+        from dataflake.ldapconnection.filters import Equality
+        conn, ldap_connection = self._makeAsync()
+        conn.insert('dc=localhost', 'cn=foo', {'a': 'x'})
+        self.assertRaises(ldap.ASSERTION_FAILED, conn.modify,
+                          'cn=foo,dc=localhost', attrs={'a': 'y'},
+                          assertion='(a=z)')
+        conn.modify('cn=foo,dc=localhost', attrs={'a': 'y'},
+                    assertion=Equality('a', 'x'))
+        rec = conn.search('dc=localhost', fltr='(cn=foo)')['results'][0]
+        self.assertEqual(rec[b'a'], [b'y'])
+
+    def test_modify_implicit_value_diff(self):
+        import ldap
+        conn = self._makeSimple()
+        members = ['m%i' % x for x in range(10)]
+        conn.insert('dc=localhost', 'cn=foo', attrs={'member': members})
+        cur_rec = conn.search('dc=localhost', fltr='(cn=foo)',
+                              raw=True)['results'][0]
+        new_members = members[1:] + ['m10']
+        dn, new_rdn, new_dn, mod_list = conn._prepare_modify(
+                    b'cn=foo,dc=localhost', None, {'member': new_members},
+                    cur_rec)
+        self.assertEqual(mod_list,
+                         [(ldap.MOD_DELETE, b'member', [b'm0']),
+                          (ldap.MOD_ADD, b'member', [b'm10'])])
+
+        conn.modify('cn=foo,dc=localhost', attrs={'member': new_members})
+        rec = conn.search('dc=localhost', fltr='(cn=foo)')['results'][0]
+        self.assertEqual(sorted(rec[b'member']),
+                         sorted(x.encode('UTF-8') for x in new_members))
+
+    def test_diff_values_replace(self):
+        import ldap
+        conn = self._makeSimple()
+        # Replacing is cheaper than sending all changed values
+        self.assertEqual(conn._diff_values(b'a', [b'x'], [b'y']),
+                         [(ldap.MOD_REPLACE, b'a', [b'y'])])
+        self.assertEqual(conn._diff_values(b'a', [b'x', b'y'], [b'z', b'y']),
+                         [(ldap.MOD_REPLACE, b'a', [b'z', b'y'])])
+        # Values only differing by case must be replaced
+        cur_values = [b'%i' % x for x in range(10)] + [b'a']
+        values = [b'%i' % x for x in range(10)] + [b'A']
+        self.assertEqual(conn._diff_values(b'a', cur_values, values),
+                         [(ldap.MOD_REPLACE, b'a', values)])
+        # Reordered values are left alone
+        self.assertEqual(conn._diff_values(b'a', [b'x', b'y'], [b'y', b'x']),
+                         [])
@@ -123,8 +123,7 @@ class ConnectionSearchTests(LDAPConnectionTests):
                           'dc=localhost', '(cn=foo)')
 
     def test_search_binaryattribute(self):
-        # A binary value will remain untouched, no transformation
-        # to and from UTF-8 will happen.
+        # A binary value is not decoded when it is read
         conn = self._makeSimple()
         attrs = {'objectguid;binary': u'a'}
         conn.insert('dc=localhost', 'cn=foo', attrs=attrs)
@@ -135,4 +134,27 @@ class ConnectionSearchTests(LDAPConnectionTests):
         self.assertEqual(results[0],
                          {'dn': b'cn=foo,dc=localhost',
                           b'cn': [b'foo'],
-                          b'objectguid': u'a'})
+                          b'objectguid': [b'a']})
+
+    def test_search_paged(self):
+        conn, ldap_connection = self._makeAsync()
+        for name in ('a', 'b', 'c'):
+            conn.insert('dc=localhost', 'cn=%s' % name)
+        pages = list(conn.search_paged('dc=localhost', fltr='(cn=*)',
+                                       page_size=2))
+        self.assertEqual(len(pages), 2)
+        self.assertEqual([x['size'] for x in pages], [2, 1])
+        self.assertEqual(pages[0]['cookie'], b'2')
+        self.assertEqual(pages[1]['cookie'], b'')
+        self.assertEqual(pages[1]['results'][0]['dn'],
+                         b'cn=c,dc=localhost')
+
+    def test_search_paged_resume(self):
+        conn, ldap_connection = self._makeAsync()
+        for name in ('a', 'b', 'c'):
+            conn.insert('dc=localhost', 'cn=%s' % name)
+        pages = list(conn.search_paged('dc=localhost', fltr='(cn=*)',
+                                       page_size=2, cookie=b'1'))
+        self.assertEqual(len(pages), 1)
+        self.assertEqual([x['dn'] for x in pages[0]['results']],
+                         [b'cn=b,dc=localhost', b'cn=c,dc=localhost'])
@@ -0,0 +1,155 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_filters: Tests for the search filter construction module
+"""
+
+import unittest
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+from dataflake.ldapconnection.tests.dummy import UNENCODED_GREEK
+from dataflake.ldapconnection.tests.dummy import UNENCODED_LATIN1
+
+
+class FilterTests(unittest.TestCase):
+
+    def _makeConnection(self, **kw):
+        from dataflake.ldapconnection.connection import LDAPConnection
+        return LDAPConnection(**kw)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyClass
+        from dataflake.ldapconnection import filters
+        from dataflake.ldapconnection.interfaces import IFilter
+        for klass in (filters.Equality, filters.Approximate,
+                      filters.GreaterOrEqual, filters.LessOrEqual,
+                      filters.Presence, filters.Substring, filters.And,
+                      filters.Or, filters.Not, filters.BoundTemplate):
+            verifyClass(IFilter, klass)
+
+    def test_escape_filter_value(self):
+        from dataflake.ldapconnection.utils import escape_filter_value
+        self.assertEqual(escape_filter_value(b'a*(b)\\c\x00'),
+                         b'a\\2a\\28b\\29\\5cc\\00')
+        self.assertEqual(escape_filter_value(u'a*b'), u'a\\2ab')
+        self.assertEqual(escape_filter_value(None), None)
+
+    def test_equality(self):
+        from dataflake.ldapconnection.filters import Equality
+        conn = self._makeConnection()
+        self.assertEqual(Equality('cn', 'foo').encode(conn), b'(cn=foo)')
+        self.assertEqual(Equality('cn', '*)(uid=*').encode(conn),
+                         b'(cn=\\2a\\29\\28uid=\\2a)')
+
+    def test_presence_and_substring(self):
+        from dataflake.ldapconnection.filters import Presence
+        from dataflake.ldapconnection.filters import Substring
+        conn = self._makeConnection()
+        self.assertEqual(Presence('mail').encode(conn), b'(mail=*)')
+        fltr = Substring('cn', initial='a', any=('b*',), final='c')
+        self.assertEqual(fltr.encode(conn), b'(cn=a*b\\2a*c)')
+        self.assertEqual(Substring('cn', final='x').encode(conn),
+                         b'(cn=*x)')
+        self.assertRaises(ValueError, Substring, 'cn')
+
+    def test_junctions(self):
+        from dataflake.ldapconnection.filters import Equality
+        from dataflake.ldapconnection.filters import Presence
+        conn = self._makeConnection()
+        fltr = (Equality('objectClass', 'person') &
+                (Presence('mail') | ~Equality('uid', 'x')))
+        self.assertEqual(fltr.encode(conn),
+                         b'(&(objectClass=person)(|(mail=*)(!(uid=x))))')
+
+    def test_encoding(self):
+        from dataflake.ldapconnection.filters import Equality
+        conn = self._makeConnection(api_encoding='iso-8859-1')
+        fltr = Equality('cn', UNENCODED_LATIN1.encode('iso-8859-1'))
+        expected = b'(cn=%s)' % UNENCODED_LATIN1.encode('UTF-8')
+        self.assertEqual(fltr.encode(conn), expected)
+
+    def test_template(self):
+        from dataflake.ldapconnection.filters import Template
+        conn = self._makeConnection()
+        tmpl = Template('(&(objectClass=person)(uid={uid}))')
+        self.assertEqual(tmpl(uid='jd').encode(conn),
+                         b'(&(objectClass=person)(uid=jd))')
+        self.assertEqual(tmpl(uid='*').encode(conn),
+                         b'(&(objectClass=person)(uid=\\2a))')
+        self.assertRaises(KeyError, tmpl().encode, conn)
+
+    def test_template_cache(self):
+        from dataflake.ldapconnection.filters import Template
+        from dataflake.ldapconnection.filters import template_cache
+        template_cache.invalidate()
+        conn = self._makeConnection()
+        compiled = Template('(cn={cn})').compile(conn)
+        self.assertEqual(compiled, (b'(cn=', 'cn', b')'))
+        self.assertTrue(Template('(cn={cn})').compile(conn) is compiled)
+
+        other = self._makeConnection(api_encoding='iso-8859-1')
+        self.assertFalse(Template('(cn={cn})').compile(other) is compiled)
+
+    def test_parse_filter(self):
+        from dataflake.ldapconnection.filters import parse_filter
+        conn = self._makeConnection()
+        for fltr in (b'(&(objectClass=person)(|(cn=a*b*c)(!(uid=\\2a))))',
+                     b'(age>=10)', b'(age<=10)', b'(cn~=foo)', b'(mail=*)'):
+            self.assertEqual(parse_filter(fltr).encode(conn), fltr)
+        self.assertEqual(parse_filter('cn=foo').encode(conn), b'(cn=foo)')
+        self.assertEqual(parse_filter(b'(cn=\\2a)').value, u'*')
+
+        for fltr in ('(cn:dn:=foo)', '(&)', '(cn=foo', '(cn=a)(cn=b)'):
+            self.assertRaises(ValueError, parse_filter, fltr)
+
+    def test_match(self):
+        from dataflake.ldapconnection.filters import parse_filter
+        from dataflake.ldapconnection.filters import Template
+        record = {b'cn': [b'Jonathan'], b'uid': [b'jd'], b'age': [b'9'],
+                  'dn': b'cn=Jonathan,dc=localhost'}
+
+        def match(fltr):
+            return parse_filter(fltr).match(record)
+
+        self.assertTrue(match('(cn=jonathan)'))
+        self.assertTrue(match('(CN=Jo*at*an)'))
+        self.assertFalse(match('(cn=Jon*n*th)'))
+        self.assertFalse(match('(cn=Jonathan*nathan)'))
+        self.assertTrue(match('(&(objectClass=*)(uid=*)(!(mail=*)))'))
+        self.assertTrue(match('(|(uid=x)(age<=10))'))
+        # Numbers are compared as numbers
+        self.assertFalse(match('(age>=10)'))
+
+        greek = {b'cn': [UNENCODED_GREEK.upper().encode('UTF-8')]}
+        fltr = parse_filter(u'(cn=%s)' % UNENCODED_GREEK)
+        self.assertTrue(fltr.match(greek))
+
+        template = Template('(&(uid={uid})(cn={cn}*))')
+        self.assertTrue(template(uid=b'jd', cn='jon').match(record))
+        self.assertFalse(template(uid='jd', cn='*').match(record))
+
+
+class ConnectionFilterSearchTests(LDAPConnectionTests):
+
+    def test_search_filter_object(self):
+        from dataflake.ldapconnection.filters import Equality
+        from dataflake.ldapconnection.filters import Template
+        conn = self._makeSimple()
+        conn.insert('dc=localhost', 'cn=foo', attrs={'a': 'a'})
+        response = conn.search('dc=localhost', fltr=Equality('cn', 'foo'))
+        self.assertEqual(response['size'], 1)
+        self.assertEqual(response['results'][0]['dn'],
+                         b'cn=foo,dc=localhost')
+
+        response = conn.search('dc=localhost',
+                               fltr=Template('(cn={cn})')(cn='foo'))
+        self.assertEqual(response['size'], 1)
@@ -0,0 +1,133 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_groups: Tests for the nested group expansion
+"""
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+GROUPS = 'ou=groups,dc=localhost'
+USER = 'cn=user,dc=localhost'
+
+
+class GroupExpanderTests(LDAPConnectionTests):
+
+    def _makeExpander(self, conn, **kw):
+        from dataflake.ldapconnection.groups import GroupExpander
+        kw.setdefault('member_attrs', ('member',))
+        kw.setdefault('group_classes', ())
+        kw.setdefault('in_chain', False)
+        return GroupExpander(conn, GROUPS, **kw)
+
+    def _populate(self, conn):
+        self.db.addTreeItems(GROUPS)
+        conn.insert('dc=localhost', 'cn=user')
+        conn.insert(GROUPS, 'cn=direct', attrs={'member': USER})
+        conn.insert(GROUPS, 'cn=parent',
+                    attrs={'member': 'cn=direct,%s' % GROUPS})
+        conn.insert(GROUPS, 'cn=top',
+                    attrs={'member': 'cn=parent,%s' % GROUPS})
+        conn.insert(GROUPS, 'cn=unrelated', attrs={'member': 'cn=x'})
+
+    def test_getGroups_nested(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        expander = self._makeExpander(conn)
+        self.assertEqual(expander.getGroups(USER),
+                         set([b'cn=direct,ou=groups,dc=localhost',
+                              b'cn=parent,ou=groups,dc=localhost',
+                              b'cn=top,ou=groups,dc=localhost']))
+        # One search per level plus one to find the end of the nesting
+        self.assertEqual(len(ldap_connection.submitted), 4)
+
+    def test_getGroups_cycle(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        conn.modify('cn=direct,%s' % GROUPS,
+                    attrs={'member': [USER, 'cn=top,%s' % GROUPS]})
+        expander = self._makeExpander(conn)
+        self.assertEqual(len(expander.getGroups(USER)), 3)
+
+    def test_getGroups_memoized(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        expander = self._makeExpander(conn)
+        expander.getGroups(USER)
+        submitted = len(ldap_connection.submitted)
+
+        expander.getGroups(USER)
+        self.assertEqual(len(ldap_connection.submitted), submitted)
+
+        # The group graph survives invalidating the closures
+        expander.invalidate(USER)
+        expander.getGroups(USER)
+        self.assertEqual(len(ldap_connection.submitted), submitted + 1)
+
+    def test_getGroups_memberof(self):
+        conn, ldap_connection = self._makeAsync()
+        self.db.addTreeItems(GROUPS)
+        conn.insert('dc=localhost', 'cn=user',
+                    attrs={'memberOf': 'cn=direct,%s' % GROUPS})
+        conn.insert(GROUPS, 'cn=direct',
+                    attrs={'memberOf': 'cn=top,%s' % GROUPS})
+        conn.insert(GROUPS, 'cn=top')
+        expander = self._makeExpander(conn, memberof_attr=b'memberOf')
+        self.assertEqual(expander.getGroups(USER),
+                         set([b'cn=direct,ou=groups,dc=localhost',
+                              b'cn=top,ou=groups,dc=localhost']))
+
+    def test_in_chain_filter(self):
+        conn = self._makeFixedResultConnection(
+            [('cn=top,ou=groups,dc=localhost', {})])
+        expander = self._makeExpander(conn, in_chain=True)
+        self.assertEqual(expander.getGroups(USER),
+                         set([b'cn=top,ou=groups,dc=localhost']))
+
+    def test_in_chain_detection(self):
+        conn = self._makeFixedResultConnection(
+            [('', {b'supportedCapabilities': [b'1.2.840.113556.1.4.800']})])
+        expander = self._makeExpander(conn, in_chain=None)
+        self.assertTrue(expander._use_in_chain(None, None))
+
+    def test_in_chain_detection_failure(self):
+        import ldap
+        conn, ldap_connection = self._makeRaising('search_s', ldap.SERVER_DOWN)
+        expander = self._makeExpander(conn, in_chain=None)
+        self.assertFalse(expander._use_in_chain(None, None))
+        # Not remembered, the server is asked again
+        self.assertTrue(expander.in_chain is None)
+
+        conn, ldap_connection = self._makeRaising('search_s',
+                                                  ldap.INSUFFICIENT_ACCESS)
+        expander = self._makeExpander(conn, in_chain=None)
+        self.assertFalse(expander._use_in_chain(None, None))
+        self.assertTrue(expander.in_chain is False)
+
+    def test_getGroups_memoized_per_bind_dn(self):
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        self._addRecord('cn=other,dc=localhost', userPassword='secret')
+        expander = self._makeExpander(conn)
+        expander.getGroups(USER)
+        submitted = len(ldap_connection.submitted)
+
+        groups = expander.getGroups(USER, bind_dn='cn=other,dc=localhost',
+                                    bind_pwd='secret')
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(len(ldap_connection.submitted), submitted * 2)
+
+        # Invalidating a DN covers all bind DNs
+        expander.invalidate(USER)
+        expander.getGroups(USER)
+        expander.getGroups(USER, bind_dn='cn=other,dc=localhost',
+                           bind_pwd='secret')
+        self.assertEqual(len(ldap_connection.submitted), submitted * 2 + 2)
@@ -0,0 +1,109 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_ldifio: Tests for the LDIF export and import functions
+"""
+
+import json
+
+import six
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+class ExportTests(LDAPConnectionTests):
+
+    def _populate(self, conn):
+        conn.insert('dc=localhost', 'cn=a', attrs={'sn': 'A'})
+        conn.insert('dc=localhost', 'cn=b',
+                    attrs={'sn': 'B', 'photo;binary': [b'\xff\x00']})
+
+    def test_export_ldif(self):
+        from dataflake.ldapconnection.ldifio import export
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        out = six.StringIO()
+        result = export(conn, 'dc=localhost', out, fltr='(cn=*)')
+        self.assertEqual(result['size'], 2)
+        self.assertFalse(result['cookie'])
+        ldif = out.getvalue()
+        self.assertTrue('dn: cn=a,dc=localhost\ncn: a\nsn: A\n' in ldif)
+        self.assertTrue('photo:: /wA=\n' in ldif)
+
+    def test_export_jsonl(self):
+        from dataflake.ldapconnection.ldifio import export
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        out = six.StringIO()
+        export(conn, 'dc=localhost', out, fltr='(cn=*)', format='jsonl')
+        lines = [json.loads(x) for x in out.getvalue().splitlines()]
+        self.assertEqual(lines[0], {'dn': 'cn=a,dc=localhost',
+                                    'attributes': {'cn': ['a'],
+                                                   'sn': ['A']}})
+        self.assertEqual(lines[1]['attributes']['photo;binary'], ['/wA='])
+
+    def test_export_checkpoint_resume(self):
+        from dataflake.ldapconnection.ldifio import export
+        conn, ldap_connection = self._makeAsync()
+        self._populate(conn)
+        cookies = []
+        out = six.StringIO()
+        export(conn, 'dc=localhost', out, fltr='(cn=*)', page_size=1,
+               checkpoint=cookies.append)
+        self.assertEqual(cookies, [b'1', b''])
+
+        out = six.StringIO()
+        result = export(conn, 'dc=localhost', out, fltr='(cn=*)',
+                        page_size=1, cookie=cookies[0])
+        self.assertEqual(result['size'], 1)
+        self.assertTrue(out.getvalue().startswith('dn: cn=b,dc=localhost'))
+
+
+class ImportTests(LDAPConnectionTests):
+
+    def test_import_ldif(self):
+        from dataflake.ldapconnection.ldifio import import_ldif
+        conn, ldap_connection = self._makeAsync()
+        conn.insert('dc=localhost', 'cn=b')
+        infile = six.StringIO(u'dn: cn=a,dc=localhost\n'
+                              u'cn: a\n'
+                              u'sn: A\n'
+                              u'\n'
+                              u'dn: cn=b,dc=localhost\n'
+                              u'cn: b\n'
+                              u'\n'
+                              u'dn: cn=c,dc=localhost\n'
+                              u'cn: c\n'
+                              u'photo:: /wA=\n')
+        report = import_ldif(conn, infile, window=1)
+        self.assertEqual(report['size'], 3)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['results'][1][0], b'cn=b,dc=localhost')
+        rec = conn.search('dc=localhost', fltr='(cn=a)')['results'][0]
+        self.assertEqual(rec[b'sn'], [b'A'])
+        rec = conn.search('dc=localhost', fltr='(cn=c)', raw=True)
+        self.assertEqual(rec['results'][0][b'photo'], [b'\xff\x00'])
+
+    def test_roundtrip(self):
+        from dataflake.ldapconnection.ldifio import export
+        from dataflake.ldapconnection.ldifio import import_ldif
+        conn, ldap_connection = self._makeAsync()
+        self.db.addTreeItems('ou=copy,dc=localhost')
+        conn.insert('dc=localhost', 'cn=a', attrs={'sn': 'A'})
+        out = six.StringIO()
+        export(conn, 'dc=localhost', out, fltr='(cn=*)')
+        infile = six.StringIO(out.getvalue().replace('dc=localhost',
+                                                     'ou=copy,dc=localhost'))
+        report = import_ldif(conn, infile)
+        self.assertEqual(report['succeeded'], 1)
+        rec = conn.search('ou=copy,dc=localhost', fltr='(cn=a)')
+        self.assertEqual(rec['results'][0][b'sn'], [b'A'])
@@ -0,0 +1,107 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_metrics: Tests for operation metrics
+"""
+
+import unittest
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from dataflake.ldapconnection.metrics import MetricsRegistry
+        return MetricsRegistry(*args, **kw)
+
+    def test_snapshot(self):
+        registry = self._makeOne(buckets=(0.1, 1.0))
+        registry.increment('errors_total', operation='search')
+        registry.increment('errors_total', 2, operation='search')
+        registry.gauge('servers', 3)
+        registry.observe('operation_seconds', 0.05, operation='search')
+        registry.observe('operation_seconds', 0.1, operation='search')
+        registry.observe('operation_seconds', 5, operation='search')
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['counters']['errors_total'],
+                         [{'labels': {'operation': 'search'}, 'value': 3}])
+        self.assertEqual(snapshot['gauges']['servers'],
+                         [{'labels': {}, 'value': 3}])
+        histogram = snapshot['histograms']['operation_seconds'][0]
+        self.assertEqual(histogram['count'], 3)
+        self.assertAlmostEqual(histogram['sum'], 5.15)
+        self.assertEqual(histogram['buckets'],
+                         [(0.1, 2), (1.0, 2), (float('inf'), 3)])
+
+    def test_prometheus(self):
+        registry = self._makeOne(buckets=(0.5,))
+        registry.increment('binds_total', result='success')
+        registry.observe('operation_seconds', 0.25, operation='bind',
+                         server='ldap://a"b:389')
+
+        lines = registry.prometheus().splitlines()
+        self.assertIn('# TYPE dataflake_ldap_binds_total counter', lines)
+        self.assertIn('dataflake_ldap_binds_total{result="success"} 1',
+                      lines)
+        self.assertIn('dataflake_ldap_operation_seconds_bucket{le="+Inf",'
+                      'operation="bind",server="ldap://a\\"b:389"} 1', lines)
+        self.assertIn('dataflake_ldap_operation_seconds_sum{'
+                      'operation="bind",server="ldap://a\\"b:389"} 0.25',
+                      lines)
+
+    def test_pickle(self):
+        from six.moves import cPickle
+        registry = self._makeOne()
+        registry.increment('binds_total')
+        copy = cPickle.loads(cPickle.dumps(registry))
+        self.assertEqual(copy.snapshot()['counters'], {})
+        copy.increment('binds_total')
+
+
+class ConnectionMetricsTests(LDAPConnectionTests):
+
+    def test_operations(self):
+        conn = self._makeSimple()
+        conn.insert('dc=localhost', 'cn=foo', attrs={'sn': 'Foo'})
+        conn.search('dc=localhost', fltr='(cn=foo)')
+
+        snapshot = conn.metrics.snapshot()
+        operations = dict((x['labels']['operation'], x)
+                          for x in snapshot['histograms']['operation_seconds'])
+        self.assertEqual(operations['search']['count'], 1)
+        self.assertEqual(operations['insert']['count'], 1)
+        self.assertEqual(operations['search']['labels']['server'],
+                         'ldap://host:636')
+        self.assertEqual(operations['connect']['count'], 1)
+        self.assertEqual(snapshot['counters']['binds_total'],
+                         [{'labels': {'result': 'success'}, 'value': 1}])
+        self.assertEqual(snapshot['gauges']['connections_open'][0]['value'],
+                         1)
+
+    def test_errors(self):
+        import ldap
+        conn, ldap_connection = self._makeRaising('search_s',
+                                                  ldap.NO_SUCH_OBJECT)
+        self.assertRaises(ldap.NO_SUCH_OBJECT, conn.search, 'dc=localhost')
+
+        counters = conn.metrics.snapshot()['counters']
+        self.assertEqual(counters['errors_total'],
+                         [{'labels': {'error': 'NO_SUCH_OBJECT',
+                                      'operation': 'search'},
+                           'value': 1}])
+
+    def test_disabled(self):
+        conn = self._makeSimple()
+        conn.metrics = None
+        conn.search('dc=localhost', fltr='(cn=foo)')
@@ -0,0 +1,168 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_observers: Tests for operation observers
+"""
+
+import unittest
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+try:
+    import opentelemetry
+except ImportError:  # pragma: no cover
+    opentelemetry = None
+
+
+class RecordingObserver(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def started(self, event):
+        self.calls.append(('started', event.operation))
+
+    def finished(self, event):
+        self.calls.append(('finished', event.operation))
+        self.last = event
+
+
+class ObserverTests(LDAPConnectionTests):
+
+    def test_interface(self):
+        from zope.interface.verify import verifyClass
+        from dataflake.ldapconnection.interfaces import IOperationObserver
+        from dataflake.ldapconnection.observers import OpenTelemetryObserver
+        verifyClass(IOperationObserver, OpenTelemetryObserver)
+
+    def test_search(self):
+        conn = self._makeSimple()
+        conn.insert('dc=localhost', 'cn=foo', attrs={'sn': 'Foo'})
+        observer = RecordingObserver()
+        conn.addObserver(observer)
+        conn.disconnect()
+
+        conn.search('dc=localhost', fltr='(cn=foo)', attrs=['sn'])
+        self.assertEqual(observer.calls, [('started', 'search'),
+                                          ('started', 'connect'),
+                                          ('finished', 'connect'),
+                                          ('started', 'bind'),
+                                          ('finished', 'bind'),
+                                          ('finished', 'search')])
+        event = observer.last
+        self.assertEqual(event.base, 'dc=localhost')
+        self.assertEqual(event.fltr, '(cn=foo)')
+        self.assertEqual(event.attrs, ['sn'])
+        self.assertEqual(event.server, 'ldap://host:636')
+        self.assertEqual(event.size, 1)
+        self.assertEqual(event.exception, None)
+        self.assertTrue(event.duration >= 0)
+
+        conn.removeObserver(observer)
+        conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(len(observer.calls), 6)
+
+    def test_exception(self):
+        import ldap
+        conn, ldap_connection = self._makeRaising('delete_s',
+                                                  ldap.NO_SUCH_OBJECT)
+        observer = RecordingObserver()
+        conn.addObserver(observer)
+
+        self.assertRaises(ldap.NO_SUCH_OBJECT, conn.delete,
+                          'cn=foo,dc=localhost')
+        self.assertEqual(observer.last.operation, 'delete')
+        self.assertEqual(observer.last.base, 'cn=foo,dc=localhost')
+        self.assertTrue(isinstance(observer.last.exception,
+                                   ldap.NO_SUCH_OBJECT))
+
+    def test_connect_exception(self):
+        import ldap
+        from dataflake.ldapconnection.observers import current_event
+        conn, ldap_connection = self._makeRaising('start_tls_s',
+                                                  ldap.CONNECT_ERROR)
+        observer = RecordingObserver()
+        conn.addObserver(observer)
+
+        self.assertRaises(ldap.CONNECT_ERROR, conn.connect)
+        self.assertEqual(observer.calls, [('started', 'connect'),
+                                          ('finished', 'connect')])
+        self.assertTrue(isinstance(observer.last.exception,
+                                   ldap.CONNECT_ERROR))
+        self.assertEqual(current_event(), None)
+
+        ldap_connection.setExceptionAndMethod('simple_bind_s', ValueError)
+        self.assertRaises(ValueError, conn.connect)
+        self.assertEqual(observer.last.operation, 'bind')
+        self.assertTrue(isinstance(observer.last.exception, ValueError))
+        self.assertEqual(current_event(), None)
+
+    def test_failing_observer(self):
+        conn = self._makeSimple()
+
+        class Failing(object):
+            def started(self, event):
+                raise ValueError(event.operation)
+            finished = started
+
+        conn.addObserver(Failing())
+        response = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(response['size'], 0)
+
+    def test_pickle(self):
+        from six.moves import cPickle
+        conn = self._makeSimple()
+        conn.addObserver(RecordingObserver())
+        copy = cPickle.loads(cPickle.dumps(conn))
+        self.assertEqual(copy.observers, ())
+
+    def test_slow_operation_log(self):
+        import logging
+        from dataflake.ldapconnection.observers import SlowOperationLog
+
+        class Logger(object):
+            messages = []
+
+            def log(self, level, msg):
+                self.messages.append((level, msg))
+
+        conn = self._makeSimple()
+        conn.insert('dc=localhost', 'cn=foo', attrs={'sn': 'Foo'})
+        conn.disconnect()
+        slow_log = SlowOperationLog(threshold=0, logger=Logger())
+        conn.addObserver(slow_log)
+
+        conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(len(slow_log.entries), 1)
+        entry = slow_log.entries[0]
+        self.assertEqual(entry['operation'], 'search')
+        self.assertEqual(entry['size'], 1)
+        self.assertEqual(sorted(entry['phases']),
+                         ['bind', 'connect', 'decode', 'network'])
+
+        level, msg = Logger.messages[0]
+        self.assertEqual(level, logging.WARNING)
+        self.assertTrue(msg.startswith('Slow LDAP search ('))
+        self.assertIn('filter (cn=foo), 1 records (bind ', msg)
+
+        # Fast operations are not logged
+        slow_log.threshold = 60
+        conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(len(slow_log.entries), 1)
+
+    @unittest.skipIf(opentelemetry is None, 'opentelemetry-api is missing')
+    def test_opentelemetry(self):
+        from dataflake.ldapconnection.observers import OpenTelemetryObserver
+        conn = self._makeSimple()
+        conn.addObserver(OpenTelemetryObserver())
+        response = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(response['size'], 0)
@@ -0,0 +1,120 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_profiling: Tests for profiling connection operations
+"""
+
+import os
+import pickle
+import pstats
+import shutil
+import tempfile
+
+import six
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+class ProfilingTests(LDAPConnectionTests):
+
+    def setUp(self):
+        super(ProfilingTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(ProfilingTests, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _makeConnection(self, profiler, **kw):
+        from dataflake.ldapconnection.testing import FaultInjectingFactory
+        conn = self._makeOne('host', 389, 'ldap',
+                             FaultInjectingFactory(**kw))
+        conn.profiler = profiler
+        self._addRecord('cn=foo,dc=localhost', cn=b'foo', sn=b'Foo')
+        return conn
+
+    def test_interface(self):
+        from zope.interface.verify import verifyClass
+        from dataflake.ldapconnection.interfaces import IProfiler
+        from dataflake.ldapconnection.profiling import CProfileProfiler
+        from dataflake.ldapconnection.profiling import SamplingProfiler
+        verifyClass(IProfiler, CProfileProfiler)
+        verifyClass(IProfiler, SamplingProfiler)
+
+    def test_cprofile(self):
+        from dataflake.ldapconnection.profiling import CProfileProfiler
+        profiler = CProfileProfiler(rate=1.0)
+        conn = self._makeConnection(profiler)
+        conn.search('dc=localhost', fltr='(cn=foo)')
+        conn.search('dc=localhost', fltr='(cn=bar)')
+        conn.modify_many([('cn=foo,dc=localhost', {'sn': 'Bar'})])
+
+        # The searches run by modify_many are part of its profile
+        self.assertEqual(profiler.calls, {'search': 2, 'modify_many': 1})
+        self.assertEqual(profiler.profiled, profiler.calls)
+
+        out = six.StringIO()
+        profiler.report(out, limit=5)
+        self.assertIn('search: 2 of 2 calls profiled', out.getvalue())
+        functions = [x[2] for x in profiler.stats['modify_many'].stats]
+        self.assertIn('lookup_many', functions)
+
+        paths = profiler.dump(self.tmpdir)
+        self.assertEqual([os.path.basename(x) for x in paths],
+                         ['modify_many.prof', 'search.prof'])
+        self.assertTrue(pstats.Stats(paths[1]).total_calls > 0)
+
+        profiler.reset()
+        self.assertEqual(profiler.stats, {})
+        self.assertEqual(profiler.calls, {})
+
+    def test_rate(self):
+        from dataflake.ldapconnection.profiling import CProfileProfiler
+        conn = self._makeSimple()
+        conn.profiler = profiler = CProfileProfiler(rate=0.0)
+        conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(profiler.calls, {'search': 1})
+        self.assertEqual(profiler.profiled, {})
+        self.assertEqual(profiler.stats, {})
+
+        # Profilers are not pickled with the connection
+        clone = pickle.loads(pickle.dumps(conn))
+        self.assertEqual(clone.profiler, None)
+
+    def test_sampling(self):
+        from dataflake.ldapconnection.profiling import SamplingProfiler
+        profiler = SamplingProfiler(interval=0.001)
+        conn = self._makeConnection(profiler, latency={'search': 0.05})
+        try:
+            conn.search('dc=localhost', fltr='(cn=foo)')
+        finally:
+            profiler.close()
+
+        self.assertEqual(profiler.profiled, {'search': 1})
+        samples = sum(profiler.stacks['search'].values())
+        self.assertTrue(samples > 1)
+        functions = profiler.functions('search')
+        self.assertEqual(functions[0][1], max(x[1] for x in functions))
+        self.assertTrue([x for x in functions
+                         if x[0].startswith('_wait ') and x[2] > 1])
+
+        out = six.StringIO()
+        profiler.report(out)
+        self.assertIn('search: 1 of 1 calls profiled, %i samples' % samples,
+                      out.getvalue())
+
+        path = profiler.dump(os.path.join(self.tmpdir, 'stacks.txt'))
+        with open(path) as fp:
+            lines = fp.read().splitlines()
+        self.assertTrue(all(x.startswith('search;') for x in lines))
+        self.assertEqual(sum(int(x.rsplit(' ', 1)[1]) for x in lines),
+                         samples)
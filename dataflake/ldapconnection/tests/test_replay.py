@@ -0,0 +1,128 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_replay: Tests for recording and replaying operations
+"""
+
+import os
+import re
+import shutil
+import tempfile
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+class ReplayTests(LDAPConnectionTests):
+
+    def setUp(self):
+        super(ReplayTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'trace.jsonl')
+
+    def tearDown(self):
+        super(ReplayTests, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _record(self, **kw):
+        from dataflake.ldapconnection.filters import Equality
+        from dataflake.ldapconnection.replay import TraceRecorder
+        conn, ldap_connection = self._makeAsync()
+        recorder = TraceRecorder(self.path, **kw)
+        conn.addObserver(recorder)
+
+        conn.insert('dc=localhost', 'cn=foo',
+                    attrs={'sn': 'Foo', 'objectClass': ['top', 'person']})
+        conn.search('dc=localhost', fltr='(&(objectClass=person)(cn=fo*))',
+                    attrs=['sn'])
+        conn.search('cn=foo,dc=localhost', fltr=Equality('sn', 'Foo'))
+        conn.lookup_many(['cn=foo,dc=localhost'])
+        conn.delete('cn=foo,dc=localhost')
+        recorder.close()
+        return conn
+
+    def test_interface(self):
+        from zope.interface.verify import verifyClass
+        from dataflake.ldapconnection.interfaces import IOperationObserver
+        from dataflake.ldapconnection.replay import TraceRecorder
+        verifyClass(IOperationObserver, TraceRecorder)
+
+    def test_server(self):
+        from dataflake.ldapconnection.replay import _server
+        self.assertEqual(_server('ldap://host'), ('host', '389', 'ldap'))
+        self.assertEqual(_server('ldaps://host'), ('host', '636', 'ldaps'))
+        self.assertEqual(_server('ldaps://host:1636'),
+                         ('host', '1636', 'ldaps'))
+
+    def test_record(self):
+        from dataflake.ldapconnection.replay import load_trace
+        self._record()
+        with open(self.path) as fp:
+            trace = fp.read()
+        self.assertNotIn('foo', trace.lower())
+
+        records = load_trace(self.path)
+        self.assertEqual([x['operation'] for x in records],
+                         ['insert', 'search', 'search', 'lookup_many',
+                          'delete'])
+        insert, search, fltr_search = records[:3]
+        token = insert['base'].split(',')[0]
+        self.assertTrue(token.startswith('cn=r'))
+        self.assertEqual(insert['base'].count(','), 1)
+        self.assertEqual(insert['attrs']['objectClass'], ['top', 'person'])
+        self.assertNotEqual(insert['attrs']['sn'], ['Foo'])
+        self.assertEqual(fltr_search['base'], insert['base'])
+
+        self.assertTrue(re.match(r'^\(&\(objectClass=person\)'
+                                 r'\(cn=r[0-9a-f]{12}\*\)\)$',
+                                 search['filter']))
+        self.assertEqual(search['attrs'], ['sn'])
+        self.assertEqual(search['size'], 1)
+        self.assertEqual(fltr_search['filter'],
+                         '(sn=%s)' % insert['attrs']['sn'][0])
+        self.assertEqual(records[-1]['error'], None)
+        self.assertTrue(0 <= records[0]['offset'] <= records[-1]['offset'])
+
+    def test_record_unredacted(self):
+        from dataflake.ldapconnection.replay import load_trace
+        self._record(redact=False)
+        records = load_trace(self.path)
+        self.assertEqual(records[0]['base'], 'cn=foo,dc=localhost')
+        self.assertEqual(records[1]['filter'],
+                         '(&(objectClass=person)(cn=fo*))')
+
+    def test_replay(self):
+        from dataflake.ldapconnection.replay import load_trace
+        from dataflake.ldapconnection.replay import populate
+        from dataflake.ldapconnection.replay import replay
+        from dataflake.ldapconnection.testing import FaultInjectingFactory
+        self._record()
+        records = load_trace(self.path)
+        self.db.clear()
+        populate(records)
+
+        factory = FaultInjectingFactory(latency=0.01)
+        conn = self._makeOne('host', 389, 'ldap', factory)
+        report = replay(conn, records, speed=100, workers=2)
+        self.assertEqual(report['operations'], 2)
+        self.assertEqual(report['skipped'], 3)
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(report['by_operation']['search']['count'], 2)
+        self.assertTrue(report['latency']['p50'] >= 0.01)
+        self.assertTrue(report['throughput'] > 0)
+        self.assertEqual(factory.operations['search'], 2)
+
+        report = replay(conn, records, speed=100, workers=2, writes=True,
+                        share_connection=True)
+        self.assertEqual(report['operations'], 4)
+        self.assertEqual(report['skipped'], 1)
+        self.assertEqual(factory.operations['add'], 1)
+        self.assertEqual(factory.operations['delete'], 1)
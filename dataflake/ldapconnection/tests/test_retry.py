@@ -0,0 +1,142 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_retry: Tests for the retry policy
+"""
+
+import logging
+import time
+
+import ldap
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+PRIMARY = 'ldap://host:389'
+BACKUP = 'ldap://backup:389'
+
+
+class RetryPolicyTests(LDAPConnectionTests):
+
+    def setUp(self):
+        super(RetryPolicyTests, self).setUp()
+        self.logger = logging.getLogger('dataflake.ldapconnection.tests')
+        self.logger.disabled = True
+
+    def tearDown(self):
+        super(RetryPolicyTests, self).tearDown()
+        self.logger.disabled = False
+
+    def _makePolicy(self, **kw):
+        from dataflake.ldapconnection.retry import RetryPolicy
+        kw.setdefault('base_delay', 0.001)
+        return RetryPolicy(**kw)
+
+    def _makeConnection(self, policy, **kw):
+        from dataflake.ldapconnection.testing import FaultInjectingFactory
+        factory = FaultInjectingFactory(**kw)
+        conn = self._makeOne('host', 389, 'ldap', factory,
+                             logger=self.logger)
+        conn.addServer('backup', 389, 'ldap')
+        conn.retry_policy = policy
+        self._addRecord('cn=foo,dc=localhost', cn=b'foo', sn=b'Foo')
+        return conn, factory
+
+    def _retries(self, conn):
+        counters = conn.metrics.snapshot()['counters']
+        return dict((x['labels']['operation'], x['value'])
+                    for x in counters.get('retries_total', ()))
+
+    def test_search_moves_to_other_server(self):
+        conn, factory = self._makeConnection(self._makePolicy())
+        conn.connect()
+        factory.down.add(PRIMARY)
+
+        response = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(response['size'], 1)
+        self.assertEqual(factory.connections, [PRIMARY, BACKUP])
+        self.assertEqual(self._retries(conn), {'search': 1})
+        self.assertEqual(list(conn.retry_policy.failed), [PRIMARY])
+
+        # The failed server is tried last for a while
+        conn.disconnect()
+        factory.down.clear()
+        conn.search('dc=localhost')
+        self.assertEqual(factory.connections, [PRIMARY, BACKUP, BACKUP])
+
+    def test_write_not_retried(self):
+        conn, factory = self._makeConnection(self._makePolicy())
+        conn.connect()
+        factory.down.add(PRIMARY)
+
+        self.assertRaises(ldap.SERVER_DOWN, conn.insert, 'dc=localhost',
+                          'cn=bar', attrs={'sn': 'Bar'})
+        self.assertEqual(self._retries(conn), {})
+
+        conn.retry_policy.retry_writes = True
+        conn.insert('dc=localhost', 'cn=bar', attrs={'sn': 'Bar'})
+        self.assertEqual(self._retries(conn), {'insert': 1})
+        self.assertEqual(factory.connections[-1], BACKUP)
+
+    def test_write_retried_before_connecting(self):
+        policy = self._makePolicy()
+        conn, factory = self._makeConnection(policy,
+                                             down=[PRIMARY, BACKUP])
+        policy._sleep = lambda seconds: factory.down.clear()
+
+        conn.delete('cn=foo,dc=localhost')
+        self.assertEqual(self._retries(conn), {'delete': 1})
+        self.assertEqual(factory.operations, {'bind': 1, 'delete': 1})
+
+    def test_limits(self):
+        conn, factory = self._makeConnection(self._makePolicy(attempts=3),
+                                             failure_rate=1.0)
+        self.assertRaises(ldap.SERVER_DOWN, conn.search, 'dc=localhost')
+        self.assertEqual(factory.operations, {'bind': 3})
+        self.assertEqual(self._retries(conn), {'search': 2})
+
+        conn, factory = self._makeConnection(self._makePolicy(max_time=0),
+                                             failure_rate=1.0)
+        self.assertRaises(ldap.SERVER_DOWN, conn.search, 'dc=localhost')
+        self.assertEqual(factory.operations, {'bind': 1})
+
+        # The retries must fit into the timeout of the call
+        policy = self._makePolicy(base_delay=10, max_delay=10, max_time=60,
+                                  seed=1)
+        conn, factory = self._makeConnection(policy, failure_rate=1.0)
+        started = time.time()
+        self.assertRaises(ldap.SERVER_DOWN, conn.search, 'dc=localhost',
+                          timeout=1)
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(factory.operations, {'bind': 1})
+
+        # Also if the timeout is passed as a positional argument
+        conn, factory = self._makeConnection(policy, failure_rate=1.0)
+        self.assertRaises(ldap.SERVER_DOWN, conn.delete,
+                          'cn=foo,dc=localhost', None, None, 1)
+        self.assertEqual(factory.operations, {'bind': 1})
+
+    def test_positional_timeout(self):
+        conn, factory = self._makeConnection(self._makePolicy())
+        conn.connect()
+        factory.down.add(PRIMARY)
+
+        response = conn.search('dc=localhost', ldap.SCOPE_SUBTREE,
+                               '(cn=foo)', None, True, None, None, False, 5)
+        self.assertEqual(response['size'], 1)
+        self.assertEqual(self._retries(conn), {'search': 1})
+
+    def test_backoff(self):
+        policy = self._makePolicy(base_delay=0.1, max_delay=0.3, seed=1)
+        for attempt, ceiling in ((1, 0.1), (2, 0.2), (3, 0.3), (8, 0.3)):
+            delays = [policy.backoff(attempt) for i in range(50)]
+            self.assertTrue(0 <= min(delays) < max(delays) <= ceiling)
@@ -0,0 +1,148 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_schema: Tests for the schema-driven attribute handling
+"""
+
+import ldap
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+SYNTAX = '1.3.6.1.4.1.1466.115.121.1.'
+DEFINITIONS = [
+    "( 2.5.4.41 NAME 'name' EQUALITY caseIgnoreMatch "
+    "SYNTAX %s15{32768} )" % SYNTAX,
+    "( 2.5.4.3 NAME ( 'cn' 'commonName' ) SUP name )",
+    "( 2.5.4.49 NAME 'distinguishedName' SYNTAX %s12 )" % SYNTAX,
+    "( 2.5.4.31 NAME 'member' SUP distinguishedName )",
+    "( 2.5.4.36 NAME 'userCertificate' SYNTAX %s8 )" % SYNTAX,
+    "( 1.3.6.1.1.1.1.0 NAME 'uidNumber' SYNTAX %s27 SINGLE-VALUE )"
+    % SYNTAX,
+    "( 2.5.18.1 NAME 'createTimestamp' SYNTAX %s24 SINGLE-VALUE "
+    "NO-USER-MODIFICATION USAGE directoryOperation )" % SYNTAX,
+    "( 1.3.6.1.4.1.42.2.27.8.1.5 NAME 'pwdLockout' SYNTAX %s7 )" % SYNTAX,
+    "( 1.2.3.4 NAME 'mySecret' SYNTAX %s40 )" % SYNTAX,
+]
+SECRET = b'\xff;\x00\xfe'
+
+
+class AttributeSchemaTests(LDAPConnectionTests):
+
+    def tearDown(self):
+        from dataflake.ldapconnection import schema
+        super(AttributeSchemaTests, self).tearDown()
+        schema._schemas.clear()
+
+    def _makeSchema(self, definitions=DEFINITIONS):
+        from dataflake.ldapconnection.schema import AttributeSchema
+        return AttributeSchema.fromAttributeTypes(definitions)
+
+    def test_isBinary(self):
+        attributes = self._makeSchema()
+
+        self.assertTrue(attributes.isBinary('usercertificate'))
+        self.assertTrue(attributes.isBinary(b'MYSECRET'))
+        self.assertTrue(attributes.isBinary('mySecret;x-tag'))
+        self.assertTrue(attributes.isBinary('cn;binary'))
+        # Well-known binary attributes even if the server omits them
+        self.assertTrue(attributes.isBinary('jpegPhoto'))
+        self.assertFalse(attributes.isBinary('cn'))
+        self.assertFalse(attributes.isBinary('cn;lang-de'))
+        self.assertFalse(attributes.isBinary('member'))
+        self.assertFalse(attributes.isBinary('uidNumber'))
+
+    def test_search_binary_values(self):
+        from dataflake.fakeldap import FakeLDAPConnection
+        conn = self._makeOne('host', 636, 'ldap', FakeLDAPConnection,
+                             api_encoding=None)
+        self._addRecord('cn=foo,dc=localhost', cn=b'foo', mySecret=SECRET)
+        self.assertRaises(UnicodeDecodeError, conn.search, 'dc=localhost',
+                          fltr='(cn=foo)')
+
+        conn.schema = self._makeSchema()
+        response = conn.search('dc=localhost', fltr='(cn=foo)')
+        record = response['results'][0]
+        self.assertEqual(record[b'cn'], [u'foo'])
+        self.assertEqual(record[b'mySecret'], [SECRET])
+
+    def test_search_binary_options(self):
+        from dataflake.fakeldap import FakeLDAPConnection
+        certificate = b'0\x82\x01\xff'
+        conn = self._makeOne('host', 636, 'ldap', FakeLDAPConnection,
+                             api_encoding='iso-8859-1')
+        self._addRecord('cn=foo,dc=localhost', cn=b'foo')
+        self.db.getElementByDN('cn=foo,dc=localhost')[
+            b'userCertificate;binary'] = [certificate]
+
+        for schema in (None, self._makeSchema()):
+            conn.schema = schema
+            response = conn.search('dc=localhost', fltr='(cn=foo)')
+            record = response['results'][0]
+            self.assertEqual(record[b'userCertificate;binary'],
+                             [certificate])
+
+        self.db.getElementByDN('cn=foo,dc=localhost')[
+            b'mySecret;x-tag'] = [SECRET]
+        response = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(response['results'][0][b'mySecret;x-tag'], [SECRET])
+
+    def test_write_binary_values(self):
+        conn = self._makeSimple()
+        conn.schema = self._makeSchema()
+        self._addRecord('cn=foo,dc=localhost', cn=b'foo')
+
+        conn.insert('dc=localhost', 'cn=bar', attrs={'mySecret': [SECRET]})
+        conn.modify('cn=foo,dc=localhost', attrs={'mySecret': [SECRET]})
+        for cn in ('foo', 'bar'):
+            record = conn.search('dc=localhost', fltr='(cn=%s)' % cn,
+                                 raw=True)['results'][0]
+            # Neither split at the semicolon nor encoded
+            self.assertEqual(record[b'mySecret'], [SECRET])
+
+    def test_write_binary_text_values(self):
+        from dataflake.ldapconnection.schema import AttributeSchema
+        conn = self._makeSimple()
+        conn.schema = AttributeSchema.fromAttributeTypes(
+            ["( 2.5.4.35 NAME 'userPassword' SYNTAX %s40 )" % SYNTAX])
+        self._addRecord('cn=foo,dc=localhost', cn=b'foo')
+
+        dn, attrs = conn._prepare_insert('dc=localhost', 'cn=bar',
+                                         {'userPassword': u'se;cret'})
+        self.assertEqual(attrs, [(b'userPassword', [b'se;cret'])])
+
+        cur_rec = {b'cn': [b'foo'], b'userPassword': [b'old']}
+        dn, new_rdn, new_dn, mod_list = conn._prepare_modify(
+            b'cn=foo,dc=localhost', ldap.MOD_REPLACE,
+            {'userPassword': u'secret'}, cur_rec)
+        self.assertEqual(mod_list,
+                         [(ldap.MOD_REPLACE, b'userPassword', [b'secret'])])
+
+        conn.insert('dc=localhost', 'cn=bar', attrs={'userPassword': u'a'})
+        conn.modify('cn=foo,dc=localhost', attrs={'userPassword': u'b'})
+        for cn, password in (('foo', b'b'), ('bar', b'a')):
+            record = conn.search('dc=localhost', fltr='(cn=%s)' % cn,
+                                 raw=True)['results'][0]
+            self.assertEqual(record[b'userPassword'], [password])
+
+    def test_fetch_schema(self):
+        from dataflake.ldapconnection.schema import fetch_schema
+        record = ('cn=Subschema',
+                  {'subschemaSubentry': [b'cn=Subschema'],
+                   'attributeTypes': [x.encode('UTF-8')
+                                      for x in DEFINITIONS]})
+        conn = self._makeFixedResultConnection([record])
+
+        attributes = fetch_schema(conn)
+        self.assertTrue(attributes.isBinary('userCertificate'))
+        self.assertTrue(fetch_schema(conn) is attributes)
+        self.assertFalse(fetch_schema(conn, refresh=True) is attributes)
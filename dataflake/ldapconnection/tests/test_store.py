@@ -0,0 +1,101 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_store: Tests for the indexed in-memory entry store
+"""
+
+import unittest
+
+import ldap
+
+BASE = b'ou=people,dc=localhost'
+
+
+class EntryStoreTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from dataflake.ldapconnection.store import EntryStore
+        store = EntryStore(*args, **kw)
+        store.add(BASE, {b'ou': [b'people']})
+        for name, mail, sn in (('a', 'a@example.org', 'Smith'),
+                               ('b', 'B@example.org', 'Jones'),
+                               ('c', None, 'Smith')):
+            record = {b'cn': [name.encode('UTF-8')], b'sn': [sn.encode()]}
+            if mail:
+                record[b'mail'] = [mail.encode('UTF-8')]
+            store.add(b'cn=%s,%s' % (name.encode('UTF-8'), BASE), record)
+        return store
+
+    def _search(self, store, fltr, base=BASE, scope=ldap.SCOPE_SUBTREE):
+        return sorted(dn for dn, record in store.search(base, scope, fltr))
+
+    def test_search(self):
+        store = self._makeOne()
+        self.assertEqual(len(store), 4)
+        self.assertEqual(self._search(store, '(mail=b@example.org)'),
+                         [b'cn=b,' + BASE])
+        self.assertEqual(self._search(store, '(&(sn=smith)(mail=*))'),
+                         [b'cn=a,' + BASE])
+        self.assertEqual(self._search(store, '(|(cn=a)(cn=c))'),
+                         [b'cn=a,' + BASE, b'cn=c,' + BASE])
+        self.assertEqual(self._search(store, '(!(sn=Smith))'),
+                         [b'cn=b,' + BASE, BASE])
+        self.assertEqual(self._search(store, '(objectClass=*)',
+                                      scope=ldap.SCOPE_ONELEVEL),
+                         [b'cn=a,' + BASE, b'cn=b,' + BASE, b'cn=c,' + BASE])
+        self.assertRaises(ValueError, store.search, BASE,
+                          ldap.SCOPE_SUBTREE, '(cn:dn:=a)')
+
+        dn, record = store.search(BASE, ldap.SCOPE_SUBTREE, '(cn=a)',
+                                  attrs=['SN'])[0]
+        self.assertEqual(record, {b'sn': [b'Smith']})
+
+    def test_plan(self):
+        from dataflake.ldapconnection.filters import Equality
+        from dataflake.ldapconnection.filters import parse_filter
+        store = self._makeOne()
+
+        def plan(fltr):
+            found = store._plan(parse_filter(fltr))
+            return found if found is None else len(found)
+
+        self.assertEqual(plan('(CN=A)'), 1)
+        self.assertEqual(plan('(mail=*)'), 2)
+        self.assertEqual(plan('(&(sn=Smith)(cn=c))'), 1)
+        self.assertEqual(plan('(|(cn=a)(mail=*))'), 2)
+        self.assertEqual(plan('(cn=x)'), 0)
+
+        # Filter values need not be strings
+        store = self._makeOne(indexes=('uidNumber',))
+        store.add(b'cn=d,' + BASE, {b'cn': [b'd'], b'uidNumber': [b'5']})
+        self.assertEqual(len(store._plan(Equality('uidNumber', 5))), 1)
+        self.assertEqual(self._search(store, Equality('uidNumber', 5)),
+                         [b'cn=d,' + BASE])
+
+        # Terms on attributes without an index need a full scan
+        self.assertEqual(plan('(sn=Smith)'), None)
+        self.assertEqual(plan('(|(cn=a)(sn=Smith))'), None)
+        self.assertEqual(plan('(objectClass=*)'), None)
+
+    def test_add_and_remove(self):
+        store = self._makeOne()
+        store.add(b'CN=A,' + BASE, {b'cn': [b'a'], b'mail': [b'x@y.org']})
+        self.assertEqual(len(store), 4)
+        self.assertEqual(self._search(store, '(mail=a@example.org)'), [])
+        self.assertEqual(self._search(store, '(mail=x@y.org)'),
+                         [b'CN=A,' + BASE])
+
+        dn, record = store.remove(b'cn=a,' + BASE)
+        self.assertEqual(dn, b'CN=A,' + BASE)
+        self.assertEqual(store.remove(b'cn=a,' + BASE), None)
+        self.assertEqual(self._search(store, '(mail=x@y.org)'), [])
+        self.assertEqual(store.index['cn'].get(u'a'), None)
@@ -0,0 +1,180 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_sync: Tests for the syncrepl mirror
+"""
+
+import os
+import shutil
+import tempfile
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+BASE = 'ou=people,dc=localhost'
+
+
+def _entry(name, uuid, **attrs):
+    record = {b'cn': [name.encode('UTF-8')], b'objectClass': [b'person']}
+    for key, value in attrs.items():
+        record[key.encode('UTF-8')] = [value.encode('UTF-8')]
+    return ('entry', 'cn=%s,%s' % (name, BASE), record, uuid)
+
+
+class SyncMirrorTests(LDAPConnectionTests):
+
+    def setUp(self):
+        super(SyncMirrorTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(SyncMirrorTests, self).tearDown()
+
+    def _makeMirror(self, conn, events=(), **kw):
+        from dataflake.ldapconnection.sync import SyncMirror
+        from dataflake.ldapconnection.tests.dummy import FakeSyncConsumer
+        mirror = SyncMirror(conn, BASE, **kw)
+        mirror.searches = []
+        mirror.events = list(events)
+
+        def factory(conn_string):
+            return FakeSyncConsumer(conn_string, mirror.events,
+                                    mirror.searches)
+        mirror.consumer_factory = factory
+        return mirror
+
+    def _initialEvents(self):
+        return [('entry', BASE, {b'ou': [b'people']}, b'u0'),
+                _entry('a', b'u1', mail='a@example.org'),
+                _entry('b', b'u2', mail='b@example.org'),
+                ('set_cookie', b'cookie1')]
+
+    def test_sync(self):
+        conn = self._makeSimple()
+        mirror = self._makeMirror(conn, self._initialEvents())
+        self.assertFalse(mirror.ready)
+        self.assertEqual(mirror.search(BASE, 2, '(cn=a)'), None)
+
+        mirror.sync()
+        self.assertTrue(mirror.ready)
+        self.assertEqual(mirror.cookie, b'cookie1')
+        self.assertEqual(len(mirror.entries), 3)
+        self.assertEqual(mirror.searches[0][2], 'refreshOnly')
+
+    def test_search(self):
+        import ldap
+        conn = self._makeSimple()
+        mirror = self._makeMirror(conn, self._initialEvents())
+        mirror.sync()
+
+        res = mirror.search(BASE.encode('UTF-8'), ldap.SCOPE_SUBTREE,
+                            b'(mail=*@example.org)', attrs=['mail'])
+        self.assertEqual(sorted(res), [
+            (b'cn=a,ou=people,dc=localhost', {b'mail': [b'a@example.org']}),
+            (b'cn=b,ou=people,dc=localhost', {b'mail': [b'b@example.org']})])
+
+        res = mirror.search(b'cn=A,ou=people,dc=localhost', ldap.SCOPE_BASE,
+                            b'(objectClass=*)')
+        self.assertEqual(res[0][1][b'cn'], [b'a'])
+        res = mirror.search(BASE.encode('UTF-8'), ldap.SCOPE_ONELEVEL,
+                            b'(objectClass=*)')
+        self.assertEqual(len(res), 2)
+
+        # Searches the mirror cannot answer
+        self.assertEqual(mirror.search(b'dc=localhost', ldap.SCOPE_SUBTREE,
+                                       b'(cn=a)'), None)
+        self.assertEqual(mirror.search(BASE.encode('UTF-8'),
+                                       ldap.SCOPE_SUBTREE,
+                                       b'(cn:dn:=people)'), None)
+
+    def test_search_onelevel_mirror(self):
+        import ldap
+        conn = self._makeSimple()
+        events = self._initialEvents()[1:]
+        mirror = self._makeMirror(conn, events, scope=ldap.SCOPE_ONELEVEL)
+        mirror.sync()
+
+        res = mirror.search(b'cn=a,ou=people,dc=localhost', ldap.SCOPE_BASE,
+                            b'(objectClass=*)')
+        self.assertEqual(res[0][1][b'cn'], [b'a'])
+
+        # Records below the mirrored records are not mirrored
+        for scope in (ldap.SCOPE_ONELEVEL, ldap.SCOPE_SUBTREE):
+            self.assertEqual(mirror.search(b'cn=a,ou=people,dc=localhost',
+                                           scope, b'(objectClass=*)'), None)
+        self.assertEqual(mirror.search(BASE.encode('UTF-8'),
+                                       ldap.SCOPE_BASE, b'(objectClass=*)'),
+                         None)
+
+    def test_connection_search(self):
+        import ldap
+        conn = self._makeSimple()
+        conn.mirror = self._makeMirror(conn, self._initialEvents())
+        conn.mirror.sync()
+
+        # The record only exists in the mirror
+        res = conn.search(BASE, ldap.SCOPE_SUBTREE, fltr='(cn=b)')
+        self.assertEqual(res['size'], 1)
+        self.assertEqual(res['results'][0]['dn'],
+                         b'cn=b,ou=people,dc=localhost')
+        self.assertEqual(res['results'][0][b'mail'], [b'b@example.org'])
+
+        # Other credentials may see something else, ask the server
+        self.assertRaises(ldap.NO_SUCH_OBJECT, conn.search, BASE,
+                          ldap.SCOPE_SUBTREE, fltr='(cn=b)', bind_dn='',
+                          bind_pwd='')
+
+    def test_changes(self):
+        conn = self._makeSimple()
+        mirror = self._makeMirror(conn, self._initialEvents())
+        mirror.sync()
+        changes = []
+        mirror.subscribe(lambda *args: changes.append(args[:2]))
+
+        # An incremental refresh without explicit deletes: records that
+        # are not reported present anymore have been deleted
+        mirror.events[:] = [('present', [b'u0', b'u1'], False),
+                            ('entry', 'cn=c,%s' % BASE, {b'cn': [b'c']},
+                             b'u1'),
+                            ('present', None, False)]
+        mirror.sync()
+        self.assertEqual(mirror.searches[-1][3], b'cookie1')
+        self.assertEqual(sorted(changes), [
+            ('delete', b'cn=b,ou=people,dc=localhost'),
+            ('modify', b'cn=c,ou=people,dc=localhost')])
+        # The renamed record is only found under its new DN
+        self.assertEqual(sorted(x[1][0] for x in mirror.entries.items()),
+                         [b'cn=c,ou=people,dc=localhost',
+                          b'ou=people,dc=localhost'])
+
+        mirror.events[:] = [('delete', [b'u1'])]
+        mirror.sync()
+        self.assertEqual(len(mirror.entries), 1)
+
+    def test_save_and_load(self):
+        conn = self._makeSimple()
+        path = os.path.join(self.tmpdir, 'mirror.pickle')
+        mirror = self._makeMirror(conn, self._initialEvents(), path=path)
+        mirror.sync()
+        self.assertTrue(os.path.exists(path))
+
+        loaded = self._makeMirror(conn, path=path)
+        self.assertTrue(loaded.ready)
+        self.assertEqual(loaded.cookie, b'cookie1')
+        self.assertEqual(sorted(loaded.entries.items()),
+                         sorted(mirror.entries.items()))
+
+        # A file for another subtree is ignored
+        from dataflake.ldapconnection.sync import SyncMirror
+        other = SyncMirror(conn, 'ou=groups,dc=localhost', path=path)
+        self.assertFalse(other.ready)
+        self.assertEqual(len(other.entries), 0)
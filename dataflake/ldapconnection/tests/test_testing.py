@@ -0,0 +1,134 @@
+##############################################################################
+#
+# Copyright (c) 2008-2012 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" test_testing: Tests for the fault injecting fake server
+"""
+
+import threading
+import time
+
+import ldap
+
+from dataflake.ldapconnection.tests.base import LDAPConnectionTests
+
+
+class FaultInjectingFactoryTests(LDAPConnectionTests):
+
+    def _makeFactory(self, **kw):
+        from dataflake.ldapconnection.testing import FaultInjectingFactory
+        return FaultInjectingFactory(**kw)
+
+    def _makeConnection(self, factory, **kw):
+        conn = self._makeOne('host', 389, 'ldap', factory, **kw)
+        self._addRecord('cn=foo,dc=localhost', cn=b'foo', sn=b'Foo')
+        return conn
+
+    def test_latency(self):
+        from dataflake.ldapconnection.testing import constant
+        factory = self._makeFactory(latency={'search': constant(0.05),
+                                             'default': 0})
+        conn = self._makeConnection(factory)
+        conn.connect()
+
+        started = time.time()
+        response = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertTrue(time.time() - started >= 0.05)
+        self.assertEqual(response['size'], 1)
+        self.assertEqual(factory.operations, {'bind': 1, 'search': 1})
+
+        # Pipelined operations wait for their answers in parallel
+        started = time.time()
+        found = conn.lookup_many(['cn=foo,dc=localhost',
+                                  'cn=bar,ou=people,dc=localhost'])
+        self.assertTrue(0.05 <= time.time() - started < 0.1)
+        self.assertEqual(list(found), ['cn=foo,dc=localhost'])
+
+    def test_concurrency(self):
+        def elapsed(concurrency):
+            factory = self._makeFactory(latency=0.05,
+                                        concurrency=concurrency)
+            conns = [self._makeConnection(factory) for i in range(4)]
+            threads = [threading.Thread(target=x.search,
+                                        args=('dc=localhost',))
+                       for x in conns]
+            started = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # Each connection binds and searches once
+            self.assertEqual(factory.operations, {'bind': 4, 'search': 4})
+            return time.time() - started
+
+        self.assertTrue(elapsed(1) >= 0.4)
+        self.assertTrue(elapsed(None) < 0.4)
+
+    def test_timeout(self):
+        factory = self._makeFactory(latency={'search': 0.2})
+        conn = self._makeConnection(factory, op_timeout=0.05)
+        self.assertRaises(ldap.TIMEOUT, conn.search, 'dc=localhost')
+
+        factory = self._makeFactory(timeout_rate=1.0)
+        conn = self._makeConnection(factory)
+        self.assertRaises(ldap.TIMEOUT, conn.search, 'dc=localhost')
+        self.assertEqual(factory.injected, {'timeout': 1})
+
+    def test_server_down(self):
+        factory = self._makeFactory(failure_rate=1.0)
+        conn = self._makeConnection(factory)
+        self.assertRaises(ldap.SERVER_DOWN, conn.search, 'dc=localhost')
+
+    def test_failover(self):
+        factory = self._makeFactory(down=['ldap://host:389'])
+        conn = self._makeConnection(factory)
+        conn.addServer('backup', 389, 'ldap')
+
+        response = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(response['size'], 1)
+        self.assertEqual(factory.connections, ['ldap://backup:389'])
+        self.assertEqual(factory.injected, {'server_down': 1})
+
+    def test_referral(self):
+        factory = self._makeFactory(referral_rate=1.0)
+        conn = self._makeConnection(factory)
+
+        response = conn.search('dc=localhost', fltr='(cn=foo)')
+        self.assertEqual(response['size'], 1)
+        self.assertEqual(factory.connections,
+                         ['ldap://host:389', 'ldap://referral:389'])
+        self.assertEqual(factory.injected, {'referral': 1})
+
+
+class AsyncFakeLDAPConnectionTests(LDAPConnectionTests):
+
+    def test_search_subtree(self):
+        conn, ldap_connection = self._makeAsync()
+        self._addRecord('cn=foo,ou=people,dc=localhost', cn=b'foo')
+        self._addRecord('cn=bar,dc=localhost', cn=b'bar', sn=b'Bar')
+
+        msgid = ldap_connection.search_ext(b'dc=localhost',
+                                           ldap.SCOPE_SUBTREE, b'(cn=*)',
+                                           [b'cn'])
+        res = ldap_connection.result3(msgid)[1]
+        self.assertEqual(sorted(res),
+                         [(b'cn=bar,dc=localhost', {b'cn': [b'bar']}),
+                          (b'cn=foo,ou=people,dc=localhost',
+                           {b'cn': [b'foo']})])
+
+        # Records are returned without the records below them
+        msgid = ldap_connection.search_ext(b'ou=people,dc=localhost',
+                                           ldap.SCOPE_SUBTREE)
+        res = ldap_connection.result3(msgid)[1]
+        self.assertEqual(sorted(res),
+                         [(b'cn=foo,ou=people,dc=localhost',
+                           {b'cn': [b'foo']}),
+                          (b'ou=people,dc=localhost', {})])
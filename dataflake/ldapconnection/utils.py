@@ -14,10 +14,57 @@
 """
 
 import ldap
+import re
 import six
 
 
-BINARY_ATTRIBUTES = (b'objectguid', b'jpegphoto')
+FILTER_SPECIALS_BYTES = re.compile(b'[\\\\*()\x00]')
+FILTER_SPECIALS_TEXT = re.compile(u'[\\\\*()\x00]')
+
+
+def _names(*names):
+    """ A set of lowercase attribute names as encoded and text strings
+    """
+    return frozenset(names).union(x.decode('UTF-8') for x in names)
+
+
+# Attributes with binary values even if the server schema is not known
+BINARY_ATTRIBUTES = _names(b'audio', b'authorityrevocationlist',
+                           b'cacertificate', b'certificaterevocationlist',
+                           b'crosscertificatepair', b'jpegphoto',
+                           b'objectguid', b'objectsid', b'photo',
+                           b'thumbnailphoto', b'usercertificate',
+                           b'userpkcs12', b'usersmimecertificate')
+
+
+def has_binary_values(name, binary=BINARY_ATTRIBUTES):
+    """ Find out if an attribute has binary values
+
+    `name` may carry options like ``;lang-de``, which are ignored unless
+    one of them is ``binary``. `binary` is a set of lowercase attribute
+    names.
+    """
+    if isinstance(name, six.binary_type):
+        name = name.decode('UTF-8')
+    parts = name.lower().split(';')
+    return parts[0] in binary or 'binary' in parts[1:]
+
+
+def escape_filter_value(value):
+    """ Escape all characters that need escaping in a filter value
+
+    See RFC 4515. Both encoded and unicode strings are supported, the
+    return value has the same type as the passed-in value.
+    """
+    if not value:
+        return value
+
+    if isinstance(value, six.binary_type):
+        return FILTER_SPECIALS_BYTES.sub(
+                    lambda m: b'\\%02x' % ord(m.group()), value)
+
+    return FILTER_SPECIALS_TEXT.sub(
+                    lambda m: u'\\%02x' % ord(m.group()), value)
 
 
 def escape_dn(dn, encoding='UTF-8'):
@@ -52,3 +99,33 @@ def dn2str(dn_parts, encoding='UTF-8'):
         dn_list.append(b'%s=%s' % (key, value))
 
     return b','.join(dn_list)
+
+
+def normalize_dn(dn, encoding='UTF-8'):
+    """ Split a DN into a tuple of normalized lowercase RDN strings
+
+    Normalized DNs can be compared directly. A DN is below another DN if
+    its normalized tuple ends with the other DN's normalized tuple.
+    """
+    if not dn:
+        return ()
+
+    if isinstance(dn, six.binary_type):
+        dn = dn.decode(encoding or 'UTF-8')
+
+    return tuple(ldap.dn.dn2str([rdn]).lower()
+                 for rdn in ldap.dn.str2dn(dn))
+
+
+def dn_in_scope(dn_parts, base_parts, scope):
+    """ Find out if a DN is found by a search with the given base and scope
+
+    Both DNs are expected as tuples returned by `normalize_dn`.
+    """
+    if scope == ldap.SCOPE_BASE:
+        return dn_parts == base_parts
+    elif scope == ldap.SCOPE_ONELEVEL:
+        return dn_parts[1:] == base_parts
+
+    return len(dn_parts) >= len(base_parts) and \
+        dn_parts[len(dn_parts) - len(base_parts):] == base_parts
@@ -71,5 +71,6 @@ setup(name=NAME,
       extras_require={
         'docs': ['sphinx', 'repoze.sphinx.autointerface'],
         'testing': ['nose', 'coverage'],
+        'opentelemetry': ['opentelemetry-api'],
         },
       )